@@ -1,59 +1,64 @@
-import pandas as pd
-from flask import Flask, jsonify, render_template
+import numpy as np
+from flask import Flask, render_template, request
+from log_parser import cached_log_file
+from log_response import BINARY_FORMATS, api_response
+from result_cache import file_fingerprint
+
+# --- 設定項目 ---
+LOG_FILE = "thread_messages.log" # 解析するログファイル (書式は log_parser.LOG_DELIMITER / LOG_PATTERN を参照)
+# --- 設定項目ここまで ---
 
 app = Flask(__name__)
 
-def get_log_data_for_timeline():
+def get_log_data_for_timeline(columnar=False, heap=False):
     """
-    ログを解析し、Vis.js Timeline用の形式に変換する
+    ログファイルを解析し、Vis.js Timeline用の形式に変換する
     """
-    # サンプルデータ（実際のログに合わせて修正してください）
-    data = {
-        'timestamp': [
-            '2023-10-27 10:00:01.123', '2023-10-27 10:00:02.456',
-            '2023-10-27 10:00:03.789', '2023-10-27 10:00:05.200'
-        ],
-        'from_thread': ['ThreadA', 'ThreadB', 'ThreadA', 'ThreadC'],
-        'to_thread': ['ThreadB', 'ThreadC', 'ThreadC', 'ThreadA'],
-        'message': ['Do something', 'Task received', 'Finalize', 'Acknowledge'],
-        'full_log': [
-            'DEBUG: ThreadA sent "Do something" to ThreadB.',
-            'INFO: ThreadB got "Task received" from ThreadA.',
-            'DEBUG: ThreadA sent "Finalize" to ThreadC.',
-            'INFO: ThreadC confirmed "Acknowledge" to ThreadA.'
-        ]
-    }
-    df = pd.DataFrame(data)
-    # タイムスタンプをdatetimeオブジェクトに変換
-    df['timestamp'] = pd.to_datetime(df['timestamp'])
+    # 解析結果はファイルが更新されるまで使い回す
+    logs = cached_log_file(LOG_FILE)
+    columns = logs.to_columnar(heap=heap)
 
-    # 1. groupsの作成 (Y軸のスレッドリスト)
-    all_threads = pd.concat([df['from_thread'], df['to_thread']]).unique()
+    # 1. groupsの作成 (Y軸のスレッドリスト、ログに現れた順)
+    codes = np.concatenate([columns['from_thread'], columns['to_thread']])
+    _, first_seen = np.unique(codes, return_index=True)
+    all_threads = [columns['threads'][code] for code in codes[np.sort(first_seen)]]
     groups = [{'id': thread, 'content': thread} for thread in all_threads]
 
+    if columnar:
+        # 列形式: itemsはフロントエンドで作る (timestamp はエポックミリ秒、スレッドは threads のインデックス)
+        return groups, columns
+
     # 2. itemsの作成 (タイムライン上のイベント)
+    # 文字列の列は配列の演算でまとめて作り、行ごとには辞書を組み立てるだけにする
+    timestamps = np.datetime_as_string(
+        columns['timestamp'].astype('datetime64[ms]'), unit='ms'
+    ).tolist()
+    from_threads = logs.thread_names(columns['from_thread']).tolist()
+    to_threads = logs.thread_names(columns['to_thread']).tolist()
     items = []
-    for index, row in df.iterrows():
+    for index, (timestamp, from_thread, to_thread, message, full_log) in enumerate(
+        zip(timestamps, from_threads, to_threads, columns['message'], columns['full_log'])
+    ):
+        title = f"<pre>{full_log}</pre>" # ホバー時に表示されるツールチップ
         # 送信元スレッドにイベントを配置
         items.append({
             'id': f"{index}-from",
-            'group': row['from_thread'], # Y軸のどのグループに属するか
-            'content': f"➡ {row['to_thread']}: {row['message']}", # 表示内容
-            'start': row['timestamp'].isoformat(), # X軸の位置
+            'group': from_thread, # Y軸のどのグループに属するか
+            'content': f"➡ {to_thread}: {message}", # 表示内容
+            'start': timestamp, # X軸の位置
             'type': 'box', # 表示形式
-            'title': f"<pre>{row['full_log']}</pre>" # ホバー時に表示されるツールチップ
+            'title': title
         })
         # 受信側にも点を打つと分かりやすい (オプション)
         items.append({
             'id': f"{index}-to",
-            'group': row['to_thread'],
-            'content': f"⬅ {row['from_thread']}",
-            'start': row['timestamp'].isoformat(),
+            'group': to_thread,
+            'content': f"⬅ {from_thread}",
+            'start': timestamp,
             'type': 'point', # 表示形式を点にする
-            'title': f"<pre>{row['full_log']}</pre>"
+            'title': title
         })
 
-
     return groups, items
 
 @app.route('/')
@@ -63,11 +68,15 @@ def index():
 # APIエンドポイント
 @app.route('/api/timeline-logs')
 def get_timeline_logs():
-    groups, items = get_log_data_for_timeline()
-    return jsonify({
-        'groups': groups,
-        'items': items
-    })
+    # format (columnar / binary / arrow) か Accept ヘッダで列形式を選ぶと、
+    # items の代わりに列形式のログ (logs) を返す
+    # ETag はログファイルの指紋から作り、圧縮は Accept-Encoding に合わせる
+    def build(response_format):
+        columnar = response_format != 'records'
+        groups, items = get_log_data_for_timeline(columnar, response_format in BINARY_FORMATS)
+        return {'groups': groups, ('logs' if columnar else 'items'): items}
+
+    return api_response(build, file_fingerprint(LOG_FILE), request.path)
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,538 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+import main
+from image_io import imread_for_width, imwrite_params
+from instrumentation import METRICS
+from main import MIN_HOLE_AREA_RATIO, Preprocessor, find_donut_pair, resize_image
+
+# ベンチマークで計測するステージ (処理順)
+STAGES = (
+    "decode",
+    "resize",
+    "blur",
+    "threshold",
+    "morphology",
+    "find_contours",
+    "pair_selection",
+    "mask_draw",
+    "encode",
+)
+
+# 既定のデータセット: (幅, 高さ) ごとに条件を変えた合成画像を生成する
+DEFAULT_SIZES = ((800, 600), (1600, 1200), (4000, 3000))
+
+
+def _find_donut_pair_loop(contours, hierarchy, image_area):
+    """
+    比較用: ベクトル化前の find_donut_pair (Python のループで階層をたどる実装)。
+    """
+    donut_contours_pairs = []
+    for i in range(len(contours)):
+        if hierarchy[0][i][2] != -1 and (
+            hierarchy[0][i][3] == -1 or hierarchy[0][hierarchy[0][i][3]][3] == -1
+        ):
+            inner_contour_idx = hierarchy[0][i][2]
+            if hierarchy[0][inner_contour_idx][2] == -1:
+                area_outer = cv2.contourArea(contours[i])
+                area_inner = cv2.contourArea(contours[inner_contour_idx])
+                if (
+                    area_outer > area_inner
+                    and area_inner > image_area * MIN_HOLE_AREA_RATIO
+                ):
+                    donut_contours_pairs.append(
+                        (contours[i], contours[inner_contour_idx])
+                    )
+    if not donut_contours_pairs:
+        return None
+    donut_contours_pairs.sort(key=lambda pair: cv2.contourArea(pair[0]), reverse=True)
+    return donut_contours_pairs[0]
+
+
+def make_cluttered_binary(width=800, height=600, num_rings=400, num_blobs=3000, seed=0):
+    """
+    輪郭が大量に出る二値画像 (小さなリングと点状のノイズ) を生成します。
+    """
+    rng = np.random.default_rng(seed)
+    binary = np.zeros((height, width), np.uint8)
+    for _ in range(num_blobs):
+        x, y = rng.integers(0, width), rng.integers(0, height)
+        cv2.circle(binary, (int(x), int(y)), int(rng.integers(1, 3)), 255, -1)
+    for _ in range(num_rings):
+        x, y = rng.integers(0, width), rng.integers(0, height)
+        r = int(rng.integers(4, 15))
+        cv2.circle(binary, (int(x), int(y)), r, 255, 2)
+    # 大きなドーナツを1つ
+    cv2.circle(binary, (width // 2, height // 2), min(width, height) // 3, 255, 12)
+    return binary
+
+
+def bench_find_donut_pair(repeat=20):
+    """
+    輪郭数の多い合成画像で、ドーナツの輪郭ペア選択の処理時間を比較します。
+    """
+    binary = make_cluttered_binary()
+    contours, hierarchy = cv2.findContours(
+        binary, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE
+    )
+    image_area = binary.shape[0] * binary.shape[1]
+    print(f"輪郭数: {len(contours)}")
+
+    expected = _find_donut_pair_loop(contours, hierarchy, image_area)
+    actual = find_donut_pair(contours, hierarchy, image_area)
+    assert expected is not None and actual is not None
+    assert np.array_equal(expected[0], actual[0])
+    assert np.array_equal(expected[1], actual[1])
+
+    timings = {}
+    for label, func in (
+        ("ループ版", _find_donut_pair_loop),
+        ("ベクトル化版", find_donut_pair),
+    ):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func(contours, hierarchy, image_area)
+        timings[label] = (time.perf_counter() - start) / repeat
+        print(f"{label}: {timings[label] * 1000:.2f} ms")
+    print(f"速度向上: {timings['ループ版'] / timings['ベクトル化版']:.2f} 倍")
+
+
+def generate_donut_image(
+    width,
+    height,
+    hole_ratio=0.25,
+    noise=8.0,
+    num_donuts=1,
+    clutter=0,
+    seed=0,
+    resize_width=main.RESIZE_WIDTH,
+):
+    """
+    明るい背景に暗いリング (ドーナツ) を描いた合成画像と、正解マスクを返します。
+
+    hole_ratio は最大のドーナツの穴の半径 (画像の短辺に対する比)、
+    num_donuts は描くドーナツの数 (2つ目以降は小さく、正解は最大のもの)、
+    clutter は背景に散らす線や点の数、noise はガウスノイズの標準偏差です。
+    リングの幅は resize_width に縮小した後で約7画素になるようにしています
+    (検出器の前処理はこの程度の幅の暗い線を物体として検出するため)。
+    正解マスクは resize_width に縮小した座標系で
+    {"inner": ..., "outer": ..., "donut_body": ...} (0 または 255) として返します。
+    """
+    rng = np.random.default_rng(seed)
+    scale = width / resize_width
+    ring_width = 7 * scale
+    img = np.full((height, width, 3), 200, np.uint8)
+
+    short_side = min(width, height)
+    main_radius = short_side * hole_ratio + ring_width / 2
+
+    # ドーナツ: 1つ目が最大 (中央)。2つ目以降は四隅に小さく置く
+    donuts = [(width / 2, height / 2, main_radius)]
+    corners = ((0.12, 0.17), (0.88, 0.17), (0.12, 0.83), (0.88, 0.83))
+    for i in range(1, num_donuts):
+        fx, fy = corners[(i - 1) % len(corners)]
+        radius = short_side * rng.uniform(0.04, 0.08)
+        donuts.append((width * fx, height * fy, radius))
+
+    # 背景の雑多な物体 (短い線や点)。正解のドーナツには重ならないように置く
+    keep_out = main_radius + ring_width + 20 * scale
+    placed = 0
+    while placed < clutter:
+        x, y = rng.uniform(0, width), rng.uniform(0, height)
+        angle = rng.uniform(0, np.pi)
+        length = rng.uniform(5, 60) * scale
+        x2, y2 = x + np.cos(angle) * length, y + np.sin(angle) * length
+        if (
+            min(
+                np.hypot(x - width / 2, y - height / 2),
+                np.hypot(x2 - width / 2, y2 - height / 2),
+            )
+            < keep_out + length
+        ):
+            continue
+        color = tuple(int(c) for c in rng.integers(40, 140, 3))
+        if rng.random() < 0.5:
+            thickness = max(1, round(rng.uniform(1, 8) * scale))
+            cv2.line(
+                img, (round(x), round(y)), (round(x2), round(y2)), color, thickness
+            )
+        else:
+            radius = max(1, round(rng.uniform(2, 6) * scale))
+            cv2.circle(img, (round(x), round(y)), radius, color, -1)
+        placed += 1
+
+    for cx, cy, radius in donuts:
+        cv2.circle(
+            img,
+            (round(cx * 16), round(cy * 16)),
+            round(radius * 16),
+            (60, 60, 60),
+            max(1, round(ring_width)),
+            lineType=cv2.LINE_AA,
+            shift=4,
+        )
+
+    if noise > 0:
+        # 大きな画像でもメモリを使いすぎないよう float32 で計算する
+        noise_field = rng.standard_normal(img.shape, dtype=np.float32) * noise
+        img = np.clip(img + noise_field, 0, 255).astype(np.uint8)
+
+    # 正解マスク (最大のドーナツ)。リングの外縁と内縁をそれぞれ円として描く
+    resized_height = int(resize_width * (height / width))
+    cx, cy, radius = donuts[0]
+    center = (round(cx / scale * 16), round(cy / scale * 16))
+    outer_radius = round((radius + ring_width / 2) / scale * 16)
+    inner_radius = round((radius - ring_width / 2) / scale * 16)
+    inner = np.zeros((resized_height, resize_width), np.uint8)
+    cv2.circle(inner, center, inner_radius, 255, -1, shift=4)
+    outer = np.full((resized_height, resize_width), 255, np.uint8)
+    cv2.circle(outer, center, outer_radius, 0, -1, shift=4)
+    donut_body = cv2.bitwise_not(cv2.bitwise_or(inner, outer))
+    return img, {"inner": inner, "outer": outer, "donut_body": donut_body}
+
+
+def generate_dataset(output_dir, sizes=DEFAULT_SIZES, per_size=6, ext=".jpg", seed=0):
+    """
+    解像度ごとに per_size 枚の合成画像を、穴の大きさ・ノイズ・ドーナツの数・
+    背景のノイズを変えながら生成し、output_dir に保存します。
+    正解マスクは同じ名前の .npz に保存します。
+    戻り値: [(画像パス, 正解マスクのパス, 条件の辞書), ...]
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    dataset = []
+    for width, height in sizes:
+        for i in range(per_size):
+            conditions = {
+                "width": width,
+                "height": height,
+                "hole_ratio": float(rng.choice([0.08, 0.15, 0.25, 0.35])),
+                "noise": float(rng.choice([0.0, 8.0, 16.0])),
+                "num_donuts": int(rng.integers(1, 4)),
+                "clutter": int(rng.choice([0, 50, 200])),
+                "seed": int(rng.integers(0, 2**31)),
+            }
+            img, gt = generate_donut_image(**conditions)
+            name = f"donut_{width}x{height}_{i:03d}"
+            image_path = os.path.join(output_dir, name + ext)
+            gt_path = os.path.join(output_dir, name + "_gt.npz")
+            cv2.imwrite(image_path, img)
+            np.savez_compressed(gt_path, **gt)
+            dataset.append((image_path, gt_path, conditions))
+    return dataset
+
+
+def _iou(a, b):
+    a = a > 0
+    b = b > 0
+    union = np.logical_or(a, b).sum()
+    return 1.0 if union == 0 else float(np.logical_and(a, b).sum() / union)
+
+
+def run_pipeline_timed(
+    image_path, output_dir, resize_width=main.RESIZE_WIDTH, preprocessor=None
+):
+    """
+    main.py の処理 (読み込み → detect_donut → save_detection) をそのまま実行し、
+    main.py の計測 (METRICS) が記録したステージごとの時間を返します。
+    保存は output_dir に対して行いますが、画像はエンコードするだけでファイルには書きません。
+    戻り値: (ステージごとの秒数の辞書, 3つのマスク または None)
+    """
+    enabled = METRICS.enabled
+    METRICS.enabled = True
+    # 前の計測結果が混ざらないよう、この画像の分だけを集計する
+    METRICS.reset()
+    try:
+        target_width = resize_width if main.REDUCED_DECODE else None
+        with METRICS.time("decode"):
+            img = imread_for_width(image_path, target_width)
+        detection = main.detect_donut(img, resize_width, preprocessor)
+        params = imwrite_params(main.OUTPUT_EXT, main.PNG_COMPRESSION)
+        with METRICS.time("encode"):
+            main.save_detection(
+                detection,
+                os.path.splitext(os.path.basename(image_path))[0],
+                output_dir,
+                write=lambda path, image: cv2.imencode(main.OUTPUT_EXT, image, params),
+            )
+        snapshot = METRICS.collect()
+    finally:
+        METRICS.enabled = enabled
+
+    timings = {
+        hist["labels"]["stage"]: hist["sum"]
+        for hist in snapshot["histograms"]
+        if hist["name"] == "stage_seconds"
+    }
+    if detection.status != "ok":
+        return timings, None
+    return timings, {
+        "inner": detection.mask_inner,
+        "outer": detection.mask_outer,
+        "donut_body": detection.mask_donut_body,
+    }
+
+
+def _summary(values):
+    values = np.asarray(values, dtype=np.float64)
+    if values.size == 0:
+        return None
+    return {
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "min": float(values.min()),
+        "max": float(values.max()),
+    }
+
+
+def run_benchmark(dataset, repeat=3):
+    """
+    データセットの各画像を repeat 回処理し、ステージごとの処理時間 (ミリ秒)、
+    処理速度 (枚/秒)、最大メモリ使用量、正解マスクとの IoU をまとめた辞書を返します。
+    """
+    stage_ms = {stage: [] for stage in STAGES}
+    ious = {"inner": [], "outer": [], "donut_body": []}
+    detected = 0
+    per_size = {}
+
+    # main.py のワーカーと同じく、前処理の配列は画像をまたいで使い回す
+    preprocessor = Preprocessor()
+    # 保存はエンコードのみで、デバッグ用のディレクトリだけが一時ディレクトリに作られる
+    with tempfile.TemporaryDirectory() as output_dir:
+        start = time.perf_counter()
+        for image_path, gt_path, conditions in dataset:
+            with np.load(gt_path) as data:
+                gt = {key: data[key] for key in data.files}
+            size_key = f"{conditions['width']}x{conditions['height']}"
+            for i in range(repeat):
+                timings, masks = run_pipeline_timed(
+                    image_path, output_dir, preprocessor=preprocessor
+                )
+                for stage, seconds in timings.items():
+                    stage_ms.setdefault(stage, []).append(seconds * 1000)
+                per_size.setdefault(size_key, []).append(sum(timings.values()) * 1000)
+                if i > 0:
+                    continue
+                if masks is None:
+                    for values in ious.values():
+                        values.append(0.0)
+                    continue
+                detected += 1
+                for key, values in ious.items():
+                    values.append(_iou(masks[key], gt[key]))
+        elapsed = time.perf_counter() - start
+
+    # ru_maxrss は Linux では KiB、macOS ではバイト単位
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() != "Darwin":
+        peak_rss *= 1024
+
+    return {
+        "num_images": len(dataset),
+        "repeat": repeat,
+        "images_per_sec": len(dataset) * repeat / elapsed,
+        "peak_rss_mb": peak_rss / 1024**2,
+        "detection_rate": detected / max(len(dataset), 1),
+        "stage_ms": {stage: _summary(v) for stage, v in stage_ms.items()},
+        "total_ms_by_size": {k: _summary(v) for k, v in per_size.items()},
+        "iou": {key: _summary(v) for key, v in ious.items()},
+        "environment": {
+            "python": platform.python_version(),
+            "opencv": cv2.__version__,
+            "numpy": np.__version__,
+            "cpu_count": os.cpu_count(),
+            "cv2_threads": cv2.getNumThreads(),
+        },
+    }
+
+
+def synthetic_saliency(gt, grid=7, noise=0.05, seed=0):
+    """
+    正解マスクから、Grad-CAM のヒートマップに似た粗い顕著性マップ (grid x grid) を作ります。
+    """
+    rng = np.random.default_rng(seed)
+    donut = cv2.bitwise_not(gt["outer"]).astype(np.float32) / 255
+    saliency = cv2.resize(donut, (grid, grid), interpolation=cv2.INTER_AREA)
+    saliency = cv2.GaussianBlur(saliency, (3, 3), 0)
+    return saliency + rng.random(saliency.shape, dtype=np.float32) * noise
+
+
+def bench_saliency_roi(dataset, repeat=3, grid=7):
+    """
+    顕著性マップで注目領域を切り出してから検出する場合と、画像全体で検出する場合の
+    処理時間 (リサイズ後の二値化〜マスク作成) と、両者のマスクの一致度 (IoU) を比較します。
+    """
+    full_ms = []
+    roi_ms = []
+    roi_fraction = []
+    agreement = {"inner": [], "outer": [], "donut_body": []}
+    status_match = 0
+    preprocessor = main.Preprocessor()
+    resize_width = main.RESIZE_WIDTH
+    for image_path, gt_path, conditions in dataset:
+        with np.load(gt_path) as data:
+            gt = {key: data[key] for key in data.files}
+        resized = resize_image(imread_for_width(image_path, resize_width), resize_width)
+        saliency = synthetic_saliency(gt, grid, seed=conditions["seed"])
+
+        results = {}
+        for name, kwargs, times in (
+            ("full", {}, full_ms),
+            ("roi", {"saliency": saliency}, roi_ms),
+        ):
+            for _ in range(repeat):
+                start = time.perf_counter()
+                detection = main.detect_donut(
+                    resized, resize_width, preprocessor, **kwargs
+                )
+                times.append((time.perf_counter() - start) * 1000)
+            results[name] = detection
+
+        full, roi = results["full"], results["roi"]
+        if roi.roi is not None:
+            _, _, w, h = roi.roi
+            roi_fraction.append(w * h / (resized.shape[0] * resized.shape[1]))
+        status_match += full.status == roi.status
+        if full.status == "ok" and roi.status == "ok":
+            for key, attr in (
+                ("inner", "mask_inner"),
+                ("outer", "mask_outer"),
+                ("donut_body", "mask_donut_body"),
+            ):
+                agreement[key].append(_iou(getattr(full, attr), getattr(roi, attr)))
+
+    return {
+        "num_images": len(dataset),
+        "full_ms": _summary(full_ms),
+        "roi_ms": _summary(roi_ms),
+        "speedup": float(np.mean(full_ms) / np.mean(roi_ms)),
+        "roi_pixel_fraction": _summary(roi_fraction),
+        "status_agreement": status_match / max(len(dataset), 1),
+        "mask_iou": {key: _summary(v) for key, v in agreement.items()},
+    }
+
+
+def print_saliency_report(report):
+    print(f"画像数: {report['num_images']}")
+    print(
+        f"画像全体: 平均 {report['full_ms']['mean']:.2f} ms / "
+        f"注目領域: 平均 {report['roi_ms']['mean']:.2f} ms "
+        f"({report['speedup']:.2f} 倍)"
+    )
+    if report["roi_pixel_fraction"] is not None:
+        print(
+            f"注目領域の画素の割合: 平均 {report['roi_pixel_fraction']['mean'] * 100:.1f} %"
+        )
+    print(f"検出結果 (status) の一致率: {report['status_agreement'] * 100:.1f} %")
+    for key, summary in report["mask_iou"].items():
+        if summary is not None:
+            print(
+                f"画像全体との IoU ({key}): 平均 {summary['mean']:.4f} / 最小 {summary['min']:.4f}"
+            )
+
+
+def print_report(report, baseline=None):
+    """
+    ベンチマーク結果を表形式で表示します。baseline があれば比較も表示します。
+    """
+
+    def ratio(current, base):
+        if not base:
+            return ""
+        return f"  ({current / base:.2f}x)"
+
+    print(f"画像数: {report['num_images']} x {report['repeat']} 回")
+    base_ips = baseline["images_per_sec"] if baseline else None
+    print(
+        f"処理速度: {report['images_per_sec']:.1f} 枚/秒"
+        + ratio(report["images_per_sec"], base_ips)
+    )
+    print(f"最大メモリ使用量: {report['peak_rss_mb']:.1f} MB")
+    print(f"検出率: {report['detection_rate'] * 100:.1f} %")
+    print("-" * 30)
+    print(f"{'ステージ':<16}{'平均 ms':>10}{'p95 ms':>10}")
+    for stage in STAGES:
+        summary = report["stage_ms"][stage]
+        if summary is None:
+            continue
+        base = baseline["stage_ms"].get(stage) if baseline else None
+        print(
+            f"{stage:<16}{summary['mean']:>10.2f}{summary['p95']:>10.2f}"
+            + ratio(summary["mean"], base["mean"] if base else None)
+        )
+    print("-" * 30)
+    for size, summary in report["total_ms_by_size"].items():
+        print(f"{size}: 1枚あたり平均 {summary['mean']:.2f} ms")
+    for key, summary in report["iou"].items():
+        if summary is not None:
+            print(
+                f"IoU ({key}): 平均 {summary['mean']:.4f} / 最小 {summary['min']:.4f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="合成ドーナツ画像でマスク処理のステージごとの性能と精度を測ります。"
+    )
+    parser.add_argument(
+        "--dataset-dir", help="データセットの保存先 (省略時は一時ディレクトリ)"
+    )
+    parser.add_argument("--per-size", type=int, default=6, help="解像度ごとの画像数")
+    parser.add_argument("--repeat", type=int, default=3, help="各画像の処理回数")
+    parser.add_argument("--ext", default=".jpg", help="データセットの画像形式")
+    parser.add_argument("--json", help="結果を JSON で保存するパス")
+    parser.add_argument("--compare", help="比較対象とする過去の結果 (JSON) のパス")
+    parser.add_argument(
+        "--pair-selection",
+        action="store_true",
+        help="輪郭ペア選択のマイクロベンチマークだけを実行する",
+    )
+    parser.add_argument(
+        "--saliency-roi",
+        action="store_true",
+        help="顕著性マップによる注目領域の切り出しの効果だけを測る",
+    )
+    args = parser.parse_args()
+
+    if args.pair_selection:
+        bench_find_donut_pair()
+    elif args.saliency_roi:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dataset = generate_dataset(
+                args.dataset_dir or tmp_dir, per_size=args.per_size, ext=args.ext
+            )
+            report = bench_saliency_roi(dataset, args.repeat)
+        print_saliency_report(report)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dataset = generate_dataset(
+                args.dataset_dir or tmp_dir, per_size=args.per_size, ext=args.ext
+            )
+            # データセット生成のメモリ使用量が最大メモリ使用量に混ざらないよう、
+            # 計測は新しいプロセスで行う
+            with ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                report = executor.submit(run_benchmark, dataset, args.repeat).result()
+        baseline = None
+        if args.compare:
+            with open(args.compare, encoding="utf-8") as f:
+                baseline = json.load(f)
+        print_report(report, baseline)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
@@ -1,50 +1,37 @@
-import pandas as pd
-from flask import Flask, jsonify, render_template
-import numpy as np # 大規模サンプルデータ生成用
+from flask import Flask, render_template, request
+from log_response import BINARY_FORMATS, api_response, error_response
+from log_store import open_log_store, parse_lod_query, parse_query
+
+# --- 設定項目 ---
+LOG_FILE = "thread_messages.log" # 解析するログファイル (書式は log_parser.LOG_DELIMITER / LOG_PATTERN を参照)
+STORE_DIR = None # 時刻順に並べたログのストア (None の場合は "<LOG_FILE>.store")
+DEFAULT_LIMIT = 100000 # limit を指定しない場合に返す最大件数
+# --- 設定項目ここまで ---
 
 app = Flask(__name__)
 
-def generate_log_data():
+def generate_log_data(start=None, end=None, threads=None, limit=DEFAULT_LIMIT, columnar=False, heap=False):
     """
-    EChartsでの描画に適した形式で、大規模なログデータを生成する
+    ログのストアから指定した時間範囲 (とスレッド) のログを取り出し、
+    EChartsでの描画に適した形式に変換する
     """
-    # --- サンプルデータ生成 (2000件) ---
-    # 実際にはここでログファイルを読み込む
-    num_records = 2000
-    threads = [f"Thread{chr(65+i)}" for i in range(15)]
-    
-    timestamps = pd.to_datetime(np.sort(np.random.uniform(
-        pd.Timestamp('2023-10-27 10:00:00').timestamp(),
-        pd.Timestamp('2023-10-27 10:30:00').timestamp(),
-        num_records
-    )), unit='s')
-
-    from_threads = np.random.choice(threads, num_records)
-    to_threads = np.random.choice(threads, num_records)
-    
-    for i in range(num_records):
-        while from_threads[i] == to_threads[i]:
-            to_threads[i] = np.random.choice(threads)
-            
-    df = pd.DataFrame({
-        'timestamp': timestamps,
-        'from_thread': from_threads,
-        'to_thread': to_threads,
-        'message': [f"Msg-{i}" for i in range(num_records)],
-        'full_log': [f"Full log details for event {i}..." for i in range(num_records)]
-    })
-    # ------------------------------------
+    # ストアはログファイルが更新されるまで使い回す (検索は時刻の索引の二分探索のみ)
+    store = open_log_store(LOG_FILE, STORE_DIR)
+    indices = store.query(start, end, threads=threads, limit=limit)
 
     # Y軸のカテゴリ（スレッド名）を定義
-    y_axis_categories = sorted(threads)
+    y_axis_categories = sorted(store.threads)
 
-    # フロントエンドで直接使えるように、辞書のリストに変換
-    logs_as_dict = df.to_dict(orient='records')
-    for log in logs_as_dict:
-        log['timestamp'] = log['timestamp'].isoformat() # ISO形式の文字列に
+    if columnar:
+        # 列形式: timestamp はエポックミリ秒、from_thread / to_thread は threads のインデックスの配列
+        # (heap ならバイナリの応答用に、文字列の列をデコードせずに UTF-8 のバイト列で返す)
+        logs = store.columns.to_columnar(indices, heap=heap)
+    else:
+        # フロントエンドで直接使えるように、辞書のリストに変換 (タイムスタンプはISO形式の文字列)
+        logs = store.records(indices)
 
     return {
-        'logs': logs_as_dict,
+        'logs': logs,
         'categories': y_axis_categories
     }
 
@@ -54,8 +41,41 @@ def index():
 
 @app.route('/api/logs')
 def get_logs_endpoint():
-    data = generate_log_data()
-    return jsonify(data)
+    # start / end (ISO形式の日時かエポックミリ秒), threads (カンマ区切り), limit で絞り込む
+    # 形式は format (columnar / binary / arrow) か Accept ヘッダで選ぶ (既定は行ごとの JSON)
+    # ETag はストアの指紋とクエリから作る
+    # 解釈できないパラメータは 400 で返す
+    try:
+        query = parse_query(request.args, DEFAULT_LIMIT)
+    except ValueError as e:
+        return error_response(str(e))
+    store = open_log_store(LOG_FILE, STORE_DIR)
+    return api_response(
+        lambda response_format: generate_log_data(
+            columnar=response_format != 'records',
+            heap=response_format in BINARY_FORMATS,
+            **query
+        ),
+        store.meta['fingerprint'], store.meta['version'], request.path, query
+    )
+
+@app.route('/api/logs/lod')
+def get_logs_lod_endpoint():
+    # 表示範囲 (start / end) と画面の幅 (width, 画素) に合わせて、ピラミッドから
+    # ビンごとの件数を返す (ズームしてイベントが少なくなれば元のイベントを返す)
+    try:
+        query = parse_lod_query(request.args)
+    except ValueError as e:
+        return error_response(str(e))
+    store = open_log_store(LOG_FILE, STORE_DIR)
+    return api_response(
+        lambda response_format: store.lod(
+            columnar=response_format != 'records',
+            heap=response_format in BINARY_FORMATS,
+            **query
+        ),
+        store.meta['fingerprint'], store.meta['version'], request.path, query
+    )
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -1,15 +1,28 @@
 class GradCAM:
-    def __init__(self, model, target_layer):
+    def __init__(self, model, target_layer, truncated_backward=False):
         self.model = model
         self.target_layer = target_layer
+        # True にすると、パラメータの勾配は求めず、対象層の出力に対する勾配だけを
+        # torch.autograd.grad で求める (対象層より手前の逆伝播とパラメータの .grad の蓄積が不要になる)
+        self.truncated_backward = truncated_backward
         self.activations = None
         self.gradients = None
+        # 計算グラフにつながったままの対象層の出力 (torch.autograd.grad で勾配を求める対象)
+        self._activation_output = None
 
         self._register_hooks()
 
     def _register_hooks(self):
         def forward_hook(module, input, output):
+            if self.truncated_backward and torch.is_grad_enabled() and not output.requires_grad:
+                # パラメータを凍結している場合は対象層の出力が計算グラフに含まれないため、
+                # ここを起点にして、対象層より後ろだけの計算グラフを作る
+                output = output.detach().requires_grad_(True)
+                self.activations = output.detach()
+                self._activation_output = output
+                return output
             self.activations = output.detach() # 勾配計算に関与しないようにdetach()
+            self._activation_output = output
 
         def backward_hook(module, grad_input, grad_output):
             self.gradients = grad_output[0].detach() # 勾配計算に関与しないようにdetach()
@@ -36,7 +49,7 @@ class GradCAM:
         # weights: (batch, channels)
         return torch.mean(self.gradients, dim=(2, 3), keepdim=True)
 
-    def generate_heatmap(self, class_idx=None):
+    def _compute_cam(self):
         if self.activations is None or self.gradients is None:
             raise RuntimeError("Activations or gradients not found. Ensure forward and backward passes are done.")
 
@@ -52,39 +65,220 @@ class GradCAM:
         cam = torch.sum(weighted_activations, dim=1, keepdim=True)
 
         # 3. ReLUを適用
-        cam = F.relu(cam)
-        
+        return F.relu(cam)
+
+    def generate_heatmap(self, class_idx=None):
         # バッチサイズが1であることを想定して、最初の要素を取り出す
-        cam = cam.squeeze(0).squeeze(0) # (height, width)
+        cam = self._compute_cam().squeeze(0).squeeze(0) # (height, width)
         return cam.cpu().numpy()
 
-    def __call__(self, input_tensor, class_idx=None):
-        self.model.zero_grad()
-        
-        # フォワードパス (フックにより self.activations が設定される)
-        output = self.model(input_tensor) # (batch, num_classes)
+    def generate_heatmaps(self):
+        # バッチ内の全サンプルのヒートマップ (batch, height, width)
+        return self._compute_cam().squeeze(1).cpu().numpy()
 
+    def _resolve_class_idx(self, output, class_idx):
+        # class_idx をサンプルごとのクラス番号のテンソル (batch,) にそろえる
         if class_idx is None:
-            # 指定がない場合は、予測確率最大のクラスを使用
-            class_idx = torch.argmax(output, dim=1).item()
-        
-        # 目的のクラスのスコア
-        target_score = output[:, class_idx]
-
-        # バックワードパス (フックにより self.gradients が設定される)
-        target_score.backward(retain_graph=False) # 通常はretain_graph=Falseで良い
+            # 指定がない場合は、サンプルごとに予測確率最大のクラスを使用
+            return torch.argmax(output, dim=1)
+        class_idx = torch.as_tensor(class_idx, dtype=torch.long, device=output.device)
+        if class_idx.dim() == 0:
+            # 1つだけ指定された場合は全サンプルで同じクラスを使う
+            return class_idx.expand(output.shape[0])
+        if class_idx.shape[0] != output.shape[0]:
+            raise ValueError(f"class_idx の数 ({class_idx.shape[0]}) が画像の枚数 ({output.shape[0]}) と一致しません")
+        return class_idx
+
+    def _freeze_parameters(self):
+        # パラメータの requires_grad を無効にし、元に戻すための (パラメータ, 元の値) のリストを返す
+        saved = [(p, p.requires_grad) for p in self.model.parameters()]
+        for p, _ in saved:
+            p.requires_grad_(False)
+        return saved
+
+    def _restore_parameters(self, saved):
+        for p, requires_grad in saved:
+            p.requires_grad_(requires_grad)
+
+    def _backward(self, target_score, retain_graph=False):
+        # target_score の対象層の出力に対する勾配を self.gradients に設定する
+        if self.truncated_backward:
+            (self.gradients,) = torch.autograd.grad(target_score, self._activation_output, retain_graph=retain_graph)
+        else:
+            self.model.zero_grad()
+            target_score.backward(retain_graph=retain_graph) # フックにより self.gradients が設定される
+
+    def batch(self, input_tensor, class_idx=None, batch_size=None):
+        """
+        N 枚の画像 (N, C, H, W) のヒートマップを、バッチごとに1回のフォワード・バックワードで求めます。
+        class_idx は None (各サンプルの予測クラス)、全サンプル共通の整数、
+        またはサンプルごとのクラス番号の列 (長さ N) です。
+        戻り値: (ヒートマップ (N, h, w) の numpy 配列, 使ったクラス番号 (N,) の numpy 配列)
+
+        各サンプルのスコアの合計を逆伝播すると、サンプル同士は独立なので
+        サンプルごとに逆伝播した場合と同じ勾配が一度に得られます
+        (BatchNorm などがサンプル間で混ざらないよう、model.eval() にしておいてください)。
+        batch_size を指定すると、その枚数ずつに分けて処理します (メモリ使用量の制限用)。
+        """
+        n = input_tensor.shape[0]
+        batch_size = batch_size or n
+        if class_idx is not None and not isinstance(class_idx, int):
+            class_idx = torch.as_tensor(class_idx, dtype=torch.long)
+
+        heatmaps = []
+        classes = []
+        saved = self._freeze_parameters() if self.truncated_backward else None
+        try:
+            for start in range(0, n, batch_size):
+                chunk_class_idx = class_idx
+                if isinstance(class_idx, torch.Tensor) and class_idx.dim() > 0:
+                    chunk_class_idx = class_idx[start:start + batch_size]
+
+                # フォワードパス (フックにより self.activations が設定される)
+                output = self.model(input_tensor[start:start + batch_size]) # (batch, num_classes)
+                idx = self._resolve_class_idx(output, chunk_class_idx)
+
+                # サンプルごとの目的クラスのスコアを取り出し、合計して一度だけ逆伝播する
+                target_score = output.gather(1, idx.unsqueeze(1)).sum()
+                self._backward(target_score)
+
+                heatmaps.append(self.generate_heatmaps())
+                classes.append(idx.cpu().numpy())
+        finally:
+            if saved is not None:
+                self._restore_parameters(saved)
+            self._activation_output = None
+        return np.concatenate(heatmaps), np.concatenate(classes)
+
+    def multi_class(self, input_tensor, class_indices=None, top_k=3):
+        """
+        1回のフォワードで、複数のクラスそれぞれのヒートマップを求めます。
+        class_indices は全サンプル共通のクラス番号 (整数) かその列 (k,)、またはサンプルごとの列 (N, k) です
+        (リストや numpy 配列も使えます)。
+        None の場合は各サンプルの予測スコア上位 top_k クラスを使います。
+        戻り値: (ヒートマップ (N, k, h, w) の numpy 配列, クラス番号 (N, k) の numpy 配列)
+
+        フォワードフックで取得した活性化を使い回し、クラスごとの勾配は
+        torch.autograd.grad で対象層の出力に対してだけ求めます (計算グラフは最後のクラスまで保持)。
+        パラメータの .grad には何も蓄積されません。
+        """
+        saved = self._freeze_parameters() if self.truncated_backward else None
+        try:
+            return self._multi_class(input_tensor, class_indices, top_k)
+        finally:
+            if saved is not None:
+                self._restore_parameters(saved)
+            self._activation_output = None
+
+    def _multi_class(self, input_tensor, class_indices, top_k):
+        output = self.model(input_tensor) # (batch, num_classes)
+        if class_indices is None:
+            idx = torch.topk(output, top_k, dim=1).indices
+        else:
+            idx = torch.as_tensor(class_indices, dtype=torch.long, device=output.device)
+            if idx.dim() > 2 or idx.numel() == 0:
+                raise ValueError(f"class_indices は整数、(k,)、(N, k) のいずれかの形で指定してください (形: {tuple(idx.shape)})")
+            # 整数は全サンプル共通の1クラス、(k,) は全サンプル共通の k クラスとして (N, k) にそろえる
+            if idx.dim() < 2:
+                idx = idx.reshape(1, -1).expand(output.shape[0], -1)
+            if idx.shape[0] != output.shape[0]:
+                raise ValueError(f"class_indices の行数 ({idx.shape[0]}) が画像の枚数 ({output.shape[0]}) と一致しません")
+
+        k = idx.shape[1]
+        heatmaps = []
+        for j in range(k):
+            target_score = output.gather(1, idx[:, j:j + 1]).sum()
+            # 最後のクラス以外は、次のクラスでも使うため計算グラフを残す
+            (self.gradients,) = torch.autograd.grad(target_score, self._activation_output, retain_graph=j < k - 1)
+            heatmaps.append(self.generate_heatmaps())
+        return np.stack(heatmaps, axis=1), idx.cpu().numpy()
 
-        # ヒートマップ生成
-        heatmap = self.generate_heatmap()
-        
-        return heatmap, class_idx
+    def __call__(self, input_tensor, class_idx=None):
+        # バッチサイズ1の画像のヒートマップ (height, width) とクラス番号を返す
+        heatmaps, classes = self.batch(input_tensor, class_idx)
+        return heatmaps[0], int(classes[0])
 
     def remove_hooks(self):
         self.forward_handle.remove()
         self.backward_handle.remove()
         self.activations = None
         self.gradients = None
-        
+        self._activation_output = None
+
+
+import os
+import time
+
+def benchmark_batched_gradcam(model, target_layer, input_tensor, class_idx=None, repeat=3):
+    """
+    input_tensor (N, C, H, W) について、1枚ずつ GradCAM を呼ぶ場合と
+    GradCAM.batch でまとめて処理する場合の時間を比較し、結果が一致するかを確認します。
+    """
+    grad_cam = GradCAM(model, target_layer)
+    try:
+        n = input_tensor.shape[0]
+        if class_idx is None:
+            # 両方で同じクラスを使うよう、先に予測クラスを決めておく
+            with torch.no_grad():
+                class_idx = torch.argmax(model(input_tensor), dim=1)
+        class_idx = torch.as_tensor(class_idx, dtype=torch.long).expand(n)
+
+        def run_loop():
+            return np.stack([grad_cam(input_tensor[i:i + 1], int(class_idx[i]))[0] for i in range(n)])
+
+        def run_batched():
+            return grad_cam.batch(input_tensor, class_idx)[0]
+
+        results = {}
+        for name, func in (("loop", run_loop), ("batched", run_batched)):
+            func() # ウォームアップ
+            start = time.perf_counter()
+            for _ in range(repeat):
+                heatmaps = func()
+            elapsed = (time.perf_counter() - start) / repeat
+            results[name] = (elapsed, heatmaps)
+
+        (loop_time, loop_maps), (batched_time, batched_maps) = results.values()
+        return {
+            "images": n,
+            "loop_images_per_sec": n / loop_time,
+            "batched_images_per_sec": n / batched_time,
+            "speedup": loop_time / batched_time,
+            "max_abs_diff": float(np.max(np.abs(loop_maps - batched_maps))),
+        }
+    finally:
+        grad_cam.remove_hooks()
+
+def check_truncated_backward(model, target_layer, input_tensor, class_idx=None, atol=1e-5):
+    """
+    従来のフックによる逆伝播 (truncated_backward=False) と、対象層までで打ち切る逆伝播
+    (truncated_backward=True) のヒートマップが一致するかを確認します。
+    打ち切る場合にパラメータの .grad が作られていないことと、requires_grad が元に戻ることも確認します。
+    class_idx は batch() と同じく None、全サンプル共通の整数、サンプルごとの列 (N,) のいずれかです。
+    """
+    requires_grad_before = [p.requires_grad for p in model.parameters()]
+
+    full = GradCAM(model, target_layer)
+    try:
+        full_maps, full_classes = full.batch(input_tensor, class_idx)
+    finally:
+        full.remove_hooks()
+
+    model.zero_grad(set_to_none=True)
+    truncated = GradCAM(model, target_layer, truncated_backward=True)
+    try:
+        truncated_maps, truncated_classes = truncated.batch(input_tensor, full_classes)
+    finally:
+        truncated.remove_hooks()
+
+    max_abs_diff = float(np.max(np.abs(full_maps - truncated_maps)))
+    return {
+        "max_abs_diff": max_abs_diff,
+        "equivalent": bool(np.array_equal(full_classes, truncated_classes)) and max_abs_diff <= atol,
+        "param_grads_untouched": all(p.grad is None for p in model.parameters()),
+        "requires_grad_restored": [p.requires_grad for p in model.parameters()] == requires_grad_before,
+    }
+
 # GradCAMインスタンスの作成
 grad_cam = GradCAM(model, target_layer)
 
@@ -106,6 +300,19 @@ if grad_cam.gradients is not None:
 print(f"Raw heatmap shape: {heatmap_raw.shape}")
 print(f"Predicted class index: {predicted_class_idx}")
 
+# (オプション) 複数画像をまとめて処理する場合の速度比較
+# batch_tensor = torch.cat([input_tensor] * 16) # (16, 3, 224, 224)
+# print(benchmark_batched_gradcam(model, target_layer, batch_tensor))
+
+# (オプション) 対象層までで打ち切る逆伝播が従来の結果と一致するかの確認
+# print(check_truncated_backward(model, target_layer, input_tensor))
+# grad_cam = GradCAM(model, target_layer, truncated_backward=True) # 以降はこちらを使うと高速・省メモリ
+
+# (オプション) 予測スコア上位3クラスのヒートマップを1回のフォワードで求める場合
+# grad_cam = GradCAM(model, target_layer)
+# topk_heatmaps, topk_classes = grad_cam.multi_class(input_tensor, top_k=3) # (1, 3, h, w), (1, 3)
+# grad_cam.remove_hooks()
+
 # (オプション) ImageNetクラスラベルの取得 (簡易版)
 # !wget -q https://raw.githubusercontent.com/pytorch/hub/master/imagenet_classes.txt -O imagenet_classes.txt
 # with open("imagenet_classes.txt", "r") as f:
@@ -113,28 +320,73 @@ print(f"Predicted class index: {predicted_class_idx}")
 # print(f"Predicted class name: {imagenet_classes[predicted_class_idx]}")
 
 
-def show_cam_on_image(img_pil, heatmap_np, alpha=0.5):
-    # 1. ヒートマップを0-1に正規化
-    heatmap_normalized = (heatmap_np - np.min(heatmap_np)) / (np.max(heatmap_np) - np.min(heatmap_np) + 1e-8)
-
-    # 2. 元のPIL画像をNumPy配列に変換 (0-255, RGB)
-    img_np = np.array(img_pil)
+def _heatmap_to_color(heatmap_np, size):
+    # ヒートマップを 0-255 に正規化してから画像サイズにリサイズし、JET のカラーマップ (BGR) を適用する
+    # (正規化は線形なので、小さいヒートマップのうちに行ってもリサイズ後に行っても結果はほぼ同じ)
+    heatmap_u8 = cv2.normalize(heatmap_np.astype(np.float32), None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+    heatmap_resized = cv2.resize(heatmap_u8, size, interpolation=cv2.INTER_LINEAR)
+    return heatmap_resized, cv2.applyColorMap(heatmap_resized, cv2.COLORMAP_JET)
+
+
+def overlay_heatmap(img_np, heatmap_np, alpha=0.5, rgb=True):
+    """
+    画像 (H, W, 3) または (H, W) の uint8 配列にヒートマップを重ねた uint8 画像を返します。
+    rgb が True なら入出力を RGB、False なら BGR (cv2.imwrite にそのまま渡せる) として扱います。
+    浮動小数点の中間配列を作らず、cv2.addWeighted で合成します。
+    戻り値: (重ね合わせ画像, 画像サイズにリサイズしたヒートマップ (uint8))
+    """
+    if img_np.ndim == 2: # グレースケール画像の場合
+        img_np = cv2.cvtColor(img_np, cv2.COLOR_GRAY2RGB if rgb else cv2.COLOR_GRAY2BGR)
+    heatmap_resized, heatmap_colored = _heatmap_to_color(heatmap_np, (img_np.shape[1], img_np.shape[0]))
+    if rgb:
+        cv2.cvtColor(heatmap_colored, cv2.COLOR_BGR2RGB, dst=heatmap_colored)
+    superimposed_img = cv2.addWeighted(heatmap_colored, alpha, img_np, 1 - alpha, 0)
+    return superimposed_img, heatmap_resized
+
+
+def render_overlays(images, heatmaps, alpha=0.5, output_dir=None, names=None, rgb=True):
+    """
+    N 枚の画像とヒートマップ (N, h, w) をまとめて重ね合わせます (matplotlib を使わず、画面表示もしません)。
+    images は uint8 配列 (N, H, W, 3) か、サイズの異なる画像の列です。
+    output_dir を指定すると names (省略時は 00000, 00001, ...) の名前で PNG として保存し、
+    保存先のパスのリストを返します。指定しない場合は重ね合わせ画像のリストを返します。
+    """
+    if len(images) != len(heatmaps):
+        raise ValueError(f"画像の枚数 ({len(images)}) とヒートマップの枚数 ({len(heatmaps)}) が一致しません")
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        if names is None:
+            names = [f"{i:05d}" for i in range(len(images))]
+
+    results = []
+    for i, (img_np, heatmap_np) in enumerate(zip(images, heatmaps)):
+        img_np = np.asarray(img_np)
+        if output_dir is None:
+            results.append(overlay_heatmap(img_np, heatmap_np, alpha, rgb)[0])
+            continue
+        # 保存する場合は BGR のまま合成し、色変換を1回で済ませる
+        if rgb and img_np.ndim == 3:
+            img_np = cv2.cvtColor(img_np, cv2.COLOR_RGB2BGR)
+        superimposed_bgr, _ = overlay_heatmap(img_np, heatmap_np, alpha, rgb=False)
+        path = os.path.join(output_dir, f"{names[i]}_gradcam.png")
+        if not cv2.imwrite(path, superimposed_bgr):
+            raise OSError(f"保存に失敗しました: {path}")
+        results.append(path)
+    return results
+
+
+def save_saliency_maps(heatmaps, names, output_dir):
+    # ヒートマップを画像と同じベース名の .npy として保存する
+    # (main.py の SALIENCY_DIR に指定すると、ドーナツ検出の注目領域の切り出しに使われる)
+    os.makedirs(output_dir, exist_ok=True)
+    for name, heatmap_np in zip(names, heatmaps):
+        np.save(os.path.join(output_dir, f"{name}.npy"), np.asarray(heatmap_np, dtype=np.float32))
+
+
+def plot_cam(img_pil, heatmap_resized, superimposed_img):
+    # 元画像・ヒートマップ・重ね合わせ画像を並べて表示 (表示が必要な場合だけ呼ぶ)
+    import matplotlib.pyplot as plt
 
-    # 3. ヒートマップをリサイズし、カラーマップを適用
-    #    OpenCVはBGRを期待するので、img_npもBGRに変換
-    heatmap_resized = cv2.resize(heatmap_normalized, (img_np.shape[1], img_np.shape[0]))
-    heatmap_colored = cv2.applyColorMap(np.uint8(255 * heatmap_resized), cv2.COLORMAP_JET)
-    heatmap_colored_rgb = cv2.cvtColor(heatmap_colored, cv2.COLOR_BGR2RGB) # Matplotlib用にRGBに戻す
-
-    # 4. 重ね合わせ
-    #    img_npがRGBであることを確認
-    if img_np.shape[2] == 3 and heatmap_colored_rgb.shape[2] == 3: # カラー画像の場合
-        superimposed_img = np.uint8(heatmap_colored_rgb * alpha + img_np * (1 - alpha))
-    else: # グレースケール画像などの場合
-        superimposed_img = np.uint8(heatmap_colored_rgb * alpha + np.stack((img_np,)*3, axis=-1) * (1 - alpha) )
-
-
-    # 表示
     plt.figure(figsize=(10, 5))
     plt.subplot(1, 3, 1)
     plt.imshow(img_pil)
@@ -154,11 +406,24 @@ def show_cam_on_image(img_pil, heatmap_np, alpha=0.5):
     plt.tight_layout()
     plt.show()
 
+
+def show_cam_on_image(img_pil, heatmap_np, alpha=0.5, show=True):
+    # 元のPIL画像をNumPy配列に変換 (0-255, RGB) して、ヒートマップを重ね合わせる
+    superimposed_img, heatmap_resized = overlay_heatmap(np.asarray(img_pil), heatmap_np, alpha)
+
+    # 表示 (サーバーなど画面のない環境では show=False にする)
+    if show:
+        plot_cam(img_pil, heatmap_resized, superimposed_img)
+
     return superimposed_img
 
 # 可視化の実行
 superimposed_image = show_cam_on_image(original_img, heatmap_raw)
 
+# (オプション) 複数画像のヒートマップを画面に表示せずにまとめて保存する場合
+# heatmaps, classes = grad_cam.batch(batch_tensor)
+# render_overlays([np.asarray(img) for img in original_imgs], heatmaps, output_dir="gradcam_output")
+
 import torch
 import torch.nn as nn
 
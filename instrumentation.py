@@ -0,0 +1,271 @@
+import json
+import threading
+import time
+from bisect import bisect_left
+
+# 処理段階ごとの時間 (秒) のヒストグラムの区切り
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+# 輪郭数・候補ペア数などの件数のヒストグラムの区切り
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+
+class _NullTimer:
+    """
+    計測が無効なときに返す、何もしないタイマーです (毎回作らずに使い回します)。
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ("_metrics", "_stage", "_start")
+
+    def __init__(self, metrics, stage):
+        self._metrics = metrics
+        self._stage = stage
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._metrics.observe(
+            "stage_seconds",
+            time.perf_counter() - self._start,
+            LATENCY_BUCKETS,
+            stage=self._stage,
+        )
+        return False
+
+
+def _escape(value):
+    # Prometheus のラベル値ではバックスラッシュ・二重引用符・改行をエスケープする
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Metrics:
+    """
+    処理段階ごとの時間・件数のカウンタ・ヒストグラムを集計するレジストリです。
+
+    enabled が False の間は time() が共有の空のタイマーを返し、count() / observe() は
+    すぐに戻るため、計測コードを残したままでもほとんど負荷になりません。
+    複数のスレッドから同時に記録できます。ワーカープロセスでは collect() で集計結果を
+    取り出して親プロセスに返し、親プロセスで merge() すると全体の集計になります。
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def time(self, stage):
+        """
+        with 文で囲んだ区間の時間を stage_seconds{stage=...} に記録するタイマーを返します。
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage)
+
+    def count(self, name, value=1, **labels):
+        """
+        カウンタ name に value を加算します。
+        """
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=COUNT_BUCKETS, **labels):
+        """
+        ヒストグラム name に値を1つ記録します。
+        buckets は同じ name・labels に対して最初に記録したときの区切りが使われます。
+        """
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                # [区切り, 各区間の件数 (最後は上限超え), 合計, 件数]
+                hist = [tuple(buckets), [0] * (len(buckets) + 1), 0.0, 0]
+                self._histograms[key] = hist
+            hist[1][bisect_left(hist[0], value)] += 1
+            hist[2] += value
+            hist[3] += 1
+
+    def snapshot(self):
+        """
+        集計結果を JSON に変換できる辞書で返します (プロセス間の受け渡しにも使います)。
+        """
+        with self._lock:
+            return {
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self._counters.items())
+                ],
+                "histograms": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "buckets": list(bounds),
+                        "counts": list(counts),
+                        "sum": total,
+                        "count": n,
+                    }
+                    for (name, labels), (bounds, counts, total, n) in sorted(
+                        self._histograms.items()
+                    )
+                ],
+            }
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def collect(self):
+        """
+        これまでの集計結果を返し、集計をリセットします。
+        """
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            histograms, self._histograms = self._histograms, {}
+        collected = Metrics()
+        collected._counters = counters
+        collected._histograms = histograms
+        return collected.snapshot()
+
+    def merge(self, snapshot):
+        """
+        snapshot() / collect() の結果を加算します。
+        """
+        with self._lock:
+            for c in snapshot["counters"]:
+                key = (c["name"], _label_key(c["labels"]))
+                self._counters[key] = self._counters.get(key, 0) + c["value"]
+            for h in snapshot["histograms"]:
+                key = (h["name"], _label_key(h["labels"]))
+                hist = self._histograms.get(key)
+                if hist is None:
+                    self._histograms[key] = [
+                        tuple(h["buckets"]),
+                        list(h["counts"]),
+                        h["sum"],
+                        h["count"],
+                    ]
+                    continue
+                if hist[0] != tuple(h["buckets"]):
+                    raise ValueError(f"ヒストグラムの区切りが一致しません: {h['name']}")
+                hist[1] = [a + b for a, b in zip(hist[1], h["counts"])]
+                hist[2] += h["sum"]
+                hist[3] += h["count"]
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), ensure_ascii=False, indent=2)
+
+    def to_prometheus(self, prefix="donut_"):
+        """
+        集計結果を Prometheus のテキスト形式で返します。
+        """
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                lines.append(f"# TYPE {name} {kind}")
+                typed.add(name)
+
+        def fmt_labels(labels, **extra):
+            items = {**labels, **extra}
+            if not items:
+                return ""
+            body = ",".join(f'{k}="{_escape(v)}"' for k, v in items.items())
+            return "{" + body + "}"
+
+        for c in snapshot["counters"]:
+            name = prefix + c["name"]
+            declare(name, "counter")
+            lines.append(f"{name}{fmt_labels(c['labels'])} {c['value']}")
+        for h in snapshot["histograms"]:
+            name = prefix + h["name"]
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, n in zip(h["buckets"], h["counts"]):
+                cumulative += n
+                lines.append(
+                    f"{name}_bucket{fmt_labels(h['labels'], le=bound)} {cumulative}"
+                )
+            lines.append(
+                f"{name}_bucket{fmt_labels(h['labels'], le='+Inf')} {h['count']}"
+            )
+            lines.append(f"{name}_sum{fmt_labels(h['labels'])} {h['sum']}")
+            lines.append(f"{name}_count{fmt_labels(h['labels'])} {h['count']}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """
+        集計結果をファイルに保存します。拡張子が .prom なら Prometheus のテキスト形式、
+        それ以外は JSON で保存します。
+        """
+        text = self.to_prometheus() if path.endswith(".prom") else self.to_json()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    def summary(self):
+        """
+        処理段階ごとの合計・平均時間とカウンタの値を、表示用の文字列で返します。
+        """
+        snapshot = self.snapshot()
+        lines = []
+        stages = [h for h in snapshot["histograms"] if h["name"] == "stage_seconds"]
+        total_all = sum(h["sum"] for h in stages) or 1.0
+        for h in sorted(stages, key=lambda h: -h["sum"]):
+            mean_ms = h["sum"] / max(h["count"], 1) * 1000
+            lines.append(
+                f"{h['labels'].get('stage', '?'):<16} 合計 {h['sum']:8.2f} 秒"
+                f" ({h['sum'] / total_all:6.1%})  平均 {mean_ms:8.2f} ms  x{h['count']}"
+            )
+        for h in snapshot["histograms"]:
+            if h["name"] != "stage_seconds":
+                mean = h["sum"] / max(h["count"], 1)
+                lines.append(f"{h['name']:<16} 平均 {mean:.1f}  x{h['count']}")
+        for c in snapshot["counters"]:
+            labels = ",".join(f"{k}={v}" for k, v in c["labels"].items())
+            name = f"{c['name']}{{{labels}}}" if labels else c["name"]
+            lines.append(f"{name}: {c['value']}")
+        return "\n".join(lines)
+
+
+# プロセス全体で共有する計測レジストリ (既定では無効)
+METRICS = Metrics()
@@ -0,0 +1,175 @@
+import json
+import os
+
+import numpy as np
+
+# 最も細かい段のビンの幅 (ミリ秒)
+LOD_BASE_BIN_MS = 10
+# 1段上がるごとにビンの幅を何倍にするか
+LOD_FACTOR = 4
+
+PYRAMID_META_FILENAME = "lod.json"
+_LEVEL_ARRAYS = ("bin", "from_thread", "to_thread", "count")
+
+
+def _aggregate(bins, from_thread, to_thread, counts, num_threads):
+    # (ビン, 送信元, 送信先) ごとに件数を合計する。bins は昇順に並んでいる前提で、
+    # ビンを密な順位に置き換えてから1つの整数のキーにまとめ、np.unique で集計する
+    if len(bins) == 0:
+        return bins, from_thread, to_thread, counts
+    new_bin = np.empty(len(bins), bool)
+    new_bin[0] = True
+    np.not_equal(bins[1:], bins[:-1], out=new_bin[1:])
+    rank = np.cumsum(new_bin) - 1
+    pairs = num_threads * num_threads
+    key = rank * pairs + from_thread.astype(np.int64) * num_threads + to_thread
+    unique, inverse = np.unique(key, return_inverse=True)
+    summed = np.bincount(inverse.reshape(-1), weights=counts, minlength=len(unique))
+    first_bins = bins[new_bin]
+    pair = unique % pairs
+    return (
+        first_bins[unique // pairs],
+        (pair // num_threads).astype(from_thread.dtype),
+        (pair % num_threads).astype(to_thread.dtype),
+        summed.astype(np.int64),
+    )
+
+
+class LodPyramid:
+    """
+    時間のビンごと・スレッドの組 (送信元 → 送信先) ごとのメッセージ数を、
+    ビンの幅を LOD_FACTOR 倍ずつ広げた複数の段で持つピラミッドです。
+
+    各段は (ビン番号, 送信元, 送信先, 件数) の疎な配列で、ビン番号の昇順に並んでいます。
+    表示範囲と画面の幅から、ビンの数が画面の画素数を超えない最も細かい段を選ぶため、
+    応答の大きさはログの量ではなく画面の解像度で決まります。
+    """
+
+    def __init__(self, origin_ms, base_bin_ms, factor, levels):
+        self.origin_ms = origin_ms
+        self.base_bin_ms = base_bin_ms
+        self.factor = factor
+        self.levels = levels
+
+    @classmethod
+    def build(
+        cls,
+        timestamp_ms,
+        from_thread,
+        to_thread,
+        num_threads,
+        base_bin_ms=LOD_BASE_BIN_MS,
+        factor=LOD_FACTOR,
+    ):
+        """
+        時刻順に並んだログの列からピラミッドを作ります。
+        ビンが1つにまとまる段まで作ります。
+        """
+        num_threads = max(num_threads, 1)
+        origin_ms = int(timestamp_ms[0]) if len(timestamp_ms) else 0
+        bins = (np.asarray(timestamp_ms) - origin_ms) // base_bin_ms
+        level = _aggregate(
+            bins,
+            np.asarray(from_thread),
+            np.asarray(to_thread),
+            np.ones(len(bins), np.int64),
+            num_threads,
+        )
+        levels = [dict(zip(_LEVEL_ARRAYS, level))]
+        while len(level[0]) and level[0][-1] > 0:
+            bins, from_thread, to_thread, counts = level
+            level = _aggregate(
+                bins // factor, from_thread, to_thread, counts, num_threads
+            )
+            levels.append(dict(zip(_LEVEL_ARRAYS, level)))
+        return cls(origin_ms, base_bin_ms, factor, levels)
+
+    def save(self, store_dir):
+        for k, level in enumerate(self.levels):
+            for name in _LEVEL_ARRAYS:
+                np.save(os.path.join(store_dir, f"lod_{k}_{name}.npy"), level[name])
+        meta = {
+            "origin_ms": self.origin_ms,
+            "base_bin_ms": self.base_bin_ms,
+            "factor": self.factor,
+            "levels": len(self.levels),
+        }
+        with open(
+            os.path.join(store_dir, PYRAMID_META_FILENAME), "w", encoding="utf-8"
+        ) as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, store_dir):
+        """
+        save() で保存したピラミッドをメモリマップで開きます。
+        """
+        with open(
+            os.path.join(store_dir, PYRAMID_META_FILENAME), encoding="utf-8"
+        ) as f:
+            meta = json.load(f)
+        levels = [
+            {
+                name: np.load(
+                    os.path.join(store_dir, f"lod_{k}_{name}.npy"), mmap_mode="r"
+                )
+                for name in _LEVEL_ARRAYS
+            }
+            for k in range(meta["levels"])
+        ]
+        return cls(meta["origin_ms"], meta["base_bin_ms"], meta["factor"], levels)
+
+    def bin_ms(self, level):
+        return self.base_bin_ms * self.factor**level
+
+    def choose_level(self, start_ms, end_ms, width):
+        """
+        [start_ms, end_ms] を width 個以下のビンで表せる最も細かい段を返します。
+        """
+        target = max(end_ms - start_ms, 1) / max(width, 1)
+        for k in range(len(self.levels)):
+            if self.bin_ms(k) >= target:
+                return k
+        return len(self.levels) - 1
+
+    def query(self, start_ms, end_ms, width, thread_codes=None):
+        """
+        表示範囲のビンごと・スレッドの組ごとの件数を返します。
+        thread_codes を指定すると、送信元か送信先がそのスレッドの組だけを返します。
+        戻り値は (段, {"bin", "from_thread", "to_thread", "count"} の配列の辞書) です。
+        """
+        k = self.choose_level(start_ms, end_ms, width)
+        level = self.levels[k]
+        bin_ms = self.bin_ms(k)
+        lo = np.searchsorted(level["bin"], (start_ms - self.origin_ms) // bin_ms)
+        hi = np.searchsorted(
+            level["bin"], (end_ms - self.origin_ms) // bin_ms, side="right"
+        )
+        rows = {name: np.asarray(level[name][lo:hi]) for name in _LEVEL_ARRAYS}
+        if thread_codes is not None:
+            mask = np.isin(rows["from_thread"], thread_codes) | np.isin(
+                rows["to_thread"], thread_codes
+            )
+            rows = {name: values[mask] for name, values in rows.items()}
+        return k, rows
+
+
+def thread_counts(rows):
+    """
+    LodPyramid.query() の結果から、ビンごと・送信元スレッドごとの件数を求めます。
+    行は (ビン, 送信元, 送信先) の順に並んでいるため、区切りごとの合計で求まります。
+    """
+    if len(rows["bin"]) == 0:
+        empty = np.empty(0, np.int64)
+        return {"bin": empty, "thread": empty, "count": empty}
+    changed = np.empty(len(rows["bin"]), bool)
+    changed[0] = True
+    changed[1:] = (rows["bin"][1:] != rows["bin"][:-1]) | (
+        rows["from_thread"][1:] != rows["from_thread"][:-1]
+    )
+    starts = np.flatnonzero(changed)
+    return {
+        "bin": rows["bin"][starts],
+        "thread": rows["from_thread"][starts],
+        "count": np.add.reduceat(rows["count"], starts),
+    }
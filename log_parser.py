@@ -0,0 +1,651 @@
+import mmap
+import os
+import re
+from dataclasses import dataclass
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# 区切り文字のないテキスト形式のログの1行から
+# タイムスタンプ / 送信元スレッド / 送信先スレッド / メッセージ を取り出す正規表現 (LogParser の pattern)
+# 名前付きグループ (timestamp, from_thread, to_thread, message) があれば順序や書式は自由に変えられる
+# 書式の例: 2023-10-27 10:00:01.123 DEBUG ThreadA -> ThreadB: Do something
+LOG_PATTERN = (
+    rb"^(?P<timestamp>\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d(?:\.\d{1,6})?)[ \t]+"
+    rb"(?:[A-Z]+:?[ \t]+)?"
+    rb"(?P<from_thread>[^\s]+)[ \t]*->[ \t]*(?P<to_thread>[^\s:]+):[ \t]?"
+    rb"(?P<message>[^\r\n]*)"
+)
+
+# timestamp / from_thread / to_thread / message を区切る1バイトの区切り文字 (既定の書式)
+# 例: 2023-10-27 10:00:01.123<TAB>ThreadA<TAB>ThreadB<TAB>Do something
+LOG_DELIMITER = b"\t"
+
+# 一度に解析するバイト数 (行の途中では区切らない)
+CHUNK_BYTES = 64 * 1024 * 1024
+
+_FIELDS = ("timestamp", "from_thread", "to_thread", "message")
+# "YYYY-MM-DD HH:MM:SS" のうち数字が入る位置
+_TIMESTAMP_DIGITS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+# スレッド名の種類を調べるときに間引く間隔 (見つからなかった名前は後から追加する)
+_THREAD_SAMPLE_STEP = 64
+
+
+def delimiter_pattern(delimiter=b"\t"):
+    """
+    timestamp / from_thread / to_thread / message を delimiter で区切った形式の行に
+    一致する正規表現を返します (メッセージには区切り文字が含まれていても構いません)。
+    """
+    d = re.escape(delimiter)
+    field = rb"[^\r\n" + d.replace(b"\\", b"\\\\") + rb"]*"
+    return (
+        rb"^(?P<timestamp>\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d"
+        + field
+        + rb")"
+        + d
+        + rb"(?P<from_thread>"
+        + field
+        + rb")"
+        + d
+        + rb"(?P<to_thread>"
+        + field
+        + rb")"
+        + d
+        + rb"(?P<message>[^\r\n]*)"
+    )
+
+
+def parse_timestamps_ms(values):
+    """
+    "YYYY-MM-DD HH:MM:SS[.ffffff]" 形式のバイト列のリストを、
+    UNIX エポックからのミリ秒 (int64、タイムゾーンなしの時刻を UTC とみなす) の配列に変換します。
+    文字列の解析は固定位置の数字の演算だけで行い、1行ずつの Python の処理はありません。
+    """
+    if len(values) == 0:
+        return np.empty(0, np.int64)
+    chars = np.array(values, dtype="S26").view(np.uint8).reshape(len(values), 26)
+    return _timestamps_from_chars(chars)
+
+
+def _days_from_civil(d):
+    # d: (行数, 10 以上) の数字の値の配列 ("YYYY-MM-DD")
+    # グレゴリオ暦の日付から 1970-01-01 からの日数を求める (days_from_civil)
+    year = d[:, 0] * 1000 + d[:, 1] * 100 + d[:, 2] * 10 + d[:, 3]
+    month = d[:, 5] * 10 + d[:, 6]
+    day = d[:, 8] * 10 + d[:, 9]
+    y = year - (month <= 2)
+    era = np.floor_divide(y, 400)
+    yoe = y - era * 400
+    mp = (month + 9) % 12
+    doy = (153 * mp + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def _timestamps_from_chars(chars):
+    # chars: (行数, 23 以上) の uint8 配列 (文字列の後ろは 0 埋め)
+    if len(chars) == 0:
+        return np.empty(0, np.int64)
+    # 日付は続く行でほとんど変わらないため、日付が変わる行だけで日数を計算して繰り返す
+    date = np.ascontiguousarray(chars[:, :10])
+    ymd = date[:, :8].copy().view(np.uint64).reshape(-1)
+    dd = date[:, 8:10].copy().view(np.uint16).reshape(-1)
+    changed = np.empty(len(date), bool)
+    changed[0] = True
+    np.not_equal(ymd[1:], ymd[:-1], out=changed[1:])
+    changed[1:] |= dd[1:] != dd[:-1]
+    heads = np.flatnonzero(changed)
+    days = _days_from_civil(date[heads].astype(np.int64) - ord("0"))
+    days = np.repeat(days, np.diff(np.append(heads, len(date))))
+
+    # 時刻は列ごとに連続した int32 の配列にしてから計算する
+    t = chars[:, 11:23].T.astype(np.int32) - ord("0")
+    seconds = (t[0] * 10 + t[1]) * 3600 + (t[3] * 10 + t[4]) * 60 + t[6] * 10 + t[7]
+    # 小数部はミリ秒の桁まで使う (桁が足りない部分は 0 埋めの NUL なので 0 とみなす)
+    frac = t[9:12]
+    frac = np.where((frac >= 0) & (frac <= 9), frac, 0)
+    millis = frac[0] * 100 + frac[1] * 10 + frac[2]
+
+    return (days * 86400 + seconds) * 1000 + millis
+
+
+def _gather_ranges(buffer, starts, lengths):
+    # buffer[starts[i] : starts[i] + lengths[i]] を1回のインデックス参照でつなげる。
+    # 戻り値は (各範囲の開始位置 (末尾に全体の長さ) の int64 配列, 連結したバイト列の配列)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    index = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], lengths)
+    return offsets, np.asarray(buffer[index])
+
+
+def _decode_ranges(buffer, starts, lengths):
+    # 範囲を改行でつないで一度にデコードし、改行で分けて文字列のリストにする
+    # (行単位のログなので、範囲の中に改行は含まれない)
+    if len(starts) == 0:
+        return []
+    offsets, joined = _gather_ranges(buffer, starts, lengths)
+    joined = np.insert(joined, offsets[1:-1], ord("\n"))
+    return joined.tobytes().decode("utf-8", "replace").split("\n")
+
+
+def _string_heap(buffer, starts, lengths):
+    # 範囲をデコードせずに {"offsets", "data"} (UTF-8 のバイト列とその区切り) にする。
+    # バイナリの応答でそのまま型付き配列として読めるよう、収まれば区切りは uint32 にする
+    offsets, data = _gather_ranges(buffer, starts, lengths)
+    if offsets[-1] <= np.iinfo(np.uint32).max:
+        offsets = offsets.astype(np.uint32)
+    return {"offsets": offsets, "data": data}
+
+
+@dataclass
+class LogColumns:
+    """
+    解析済みのログを列ごとの配列で保持します。
+
+    スレッド名は threads のインデックス (カテゴリ番号) で保持し、
+    メッセージは message_heap (UTF-8 のバイト列を連結したもの) と
+    message_offsets (各メッセージの開始位置、末尾に全体の長さ) で保持します。
+    元の行全体 (full_log) は保持せず、必要なときに line_offsets から元ファイルを読みます。
+    """
+
+    timestamp_ms: np.ndarray  # int64
+    from_thread: np.ndarray  # uint16 (スレッド数が 65536 以上なら uint32)
+    to_thread: np.ndarray
+    threads: list
+    message_offsets: np.ndarray  # int64, 長さ n + 1
+    message_heap: np.ndarray  # uint8
+    line_offsets: np.ndarray  # int64, 元ファイル内の行の開始位置
+    line_lengths: np.ndarray  # int32
+    source: str | None = None
+
+    def __len__(self):
+        return len(self.timestamp_ms)
+
+    def message(self, i):
+        start, end = self.message_offsets[i], self.message_offsets[i + 1]
+        return self.message_heap[start:end].tobytes().decode("utf-8", "replace")
+
+    def messages(self, indices=None, heap=False):
+        """
+        メッセージの文字列のリストを返します (indices を指定するとその行だけ)。
+        heap=True なら文字列にせず、{"offsets", "data"} (UTF-8 のバイト列) で返します。
+        """
+        if indices is None:
+            indices = np.arange(len(self))
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.message_offsets[indices]
+        lengths = self.message_offsets[indices + 1] - starts
+        if heap:
+            return _string_heap(self.message_heap, starts, lengths)
+        return _decode_ranges(self.message_heap, starts, lengths)
+
+    def full_logs(self, indices=None, heap=False):
+        """
+        元のログファイルから行全体の文字列を読み込んで返します。
+        heap=True なら messages() と同じく {"offsets", "data"} で返します。
+        """
+        if indices is None:
+            indices = np.arange(len(self))
+        indices = np.asarray(indices, dtype=np.int64)
+        decode = _string_heap if heap else _decode_ranges
+        if len(indices) == 0:
+            return decode(np.empty(0, np.uint8), indices, indices)
+        with open(self.source, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return decode(
+                    np.frombuffer(mm, np.uint8),
+                    self.line_offsets[indices],
+                    self.line_lengths[indices],
+                )
+
+    def thread_names(self, codes):
+        threads = np.array(self.threads, dtype=object)
+        return threads[codes]
+
+    def take(self, indices):
+        """
+        indices の行だけを、その順に並べた新しい LogColumns を返します
+        (メッセージのバイト列も1回のインデックス参照でまとめて並べ替えます)。
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.message_offsets[indices]
+        message_offsets, message_heap = _gather_ranges(
+            self.message_heap, starts, self.message_offsets[indices + 1] - starts
+        )
+        return LogColumns(
+            timestamp_ms=np.asarray(self.timestamp_ms[indices]),
+            from_thread=np.asarray(self.from_thread[indices]),
+            to_thread=np.asarray(self.to_thread[indices]),
+            threads=self.threads,
+            message_offsets=message_offsets,
+            message_heap=message_heap,
+            line_offsets=np.asarray(self.line_offsets[indices]),
+            line_lengths=np.asarray(self.line_lengths[indices]),
+            source=self.source,
+        )
+
+    def to_columnar(self, indices=None, full_log=True, heap=False):
+        """
+        indices の行を、列ごとの並び (API の列形式の応答用) で返します。
+        timestamp はエポックミリ秒の int64 配列、from_thread / to_thread は threads の
+        インデックスの配列で、文字列の列は一度のデコードでまとめて作ります。
+        heap=True なら文字列の列をデコードせず {"offsets", "data"} で返します
+        (バイナリの応答用)。
+        """
+        if indices is None:
+            indices = np.arange(len(self))
+        indices = np.asarray(indices, dtype=np.int64)
+        columns = {
+            "threads": list(self.threads),
+            "timestamp": np.asarray(self.timestamp_ms[indices]),
+            "from_thread": np.asarray(self.from_thread[indices]),
+            "to_thread": np.asarray(self.to_thread[indices]),
+            "message": self.messages(indices, heap),
+        }
+        if full_log:
+            columns["full_log"] = self.full_logs(indices, heap)
+        return columns
+
+    def to_records(self, indices=None):
+        """
+        各行を timestamp (ISO 形式の文字列) / from_thread / to_thread / message / full_log
+        の辞書にしたリストを返します (API の応答用)。
+        """
+        columns = self.to_columnar(indices)
+        timestamps = np.datetime_as_string(
+            columns["timestamp"].astype("datetime64[ms]"), unit="ms"
+        )
+        return [
+            {
+                "timestamp": timestamp,
+                "from_thread": from_thread,
+                "to_thread": to_thread,
+                "message": message,
+                "full_log": full_log,
+            }
+            for timestamp, from_thread, to_thread, message, full_log in zip(
+                timestamps.tolist(),
+                self.thread_names(columns["from_thread"]),
+                self.thread_names(columns["to_thread"]),
+                columns["message"],
+                columns["full_log"],
+            )
+        ]
+
+    @classmethod
+    def concatenate(cls, parts, threads, source=None):
+        """
+        チャンクごとの LogColumns を1つにまとめます (threads は全チャンク共通のものを渡します)。
+        """
+        code_dtype = np.uint16 if len(threads) < 2**16 else np.uint32
+        heap_sizes = [len(p.message_heap) for p in parts]
+        heap_starts = np.concatenate(([0], np.cumsum(heap_sizes)))
+        if parts:
+            message_offsets = np.concatenate(
+                [p.message_offsets[:-1] + s for p, s in zip(parts, heap_starts)]
+                + [heap_starts[-1:]]
+            )
+        else:
+            message_offsets = np.zeros(1, np.int64)
+
+        def cat(name, dtype):
+            arrays = [getattr(p, name) for p in parts]
+            return (
+                np.concatenate(arrays).astype(dtype, copy=False)
+                if arrays
+                else (np.empty(0, dtype))
+            )
+
+        return cls(
+            timestamp_ms=cat("timestamp_ms", np.int64),
+            from_thread=cat("from_thread", code_dtype),
+            to_thread=cat("to_thread", code_dtype),
+            threads=list(threads),
+            message_offsets=message_offsets.astype(np.int64),
+            message_heap=cat("message_heap", np.uint8),
+            line_offsets=cat("line_offsets", np.int64),
+            line_lengths=cat("line_lengths", np.int32),
+            source=source,
+        )
+
+
+class LogParser:
+    """
+    ログファイルをメモリマップし、CHUNK_BYTES ごとに解析するパーサです。
+
+    pattern を指定しない場合は、1バイトの区切り文字 (delimiter) で区切られた行を
+    全て numpy の配列演算で解析します: 改行と区切り文字の位置を一度に求め、
+    各行の最初の3つの区切り文字でフィールドに分けます。タイムスタンプは固定位置の
+    数字の演算で、スレッド名は固定幅に並べたバイト列のハッシュでカテゴリ番号に変換し、
+    メッセージはまとめて1つのバイト列に連結します。1行ごとの Python の処理はありません。
+
+    pattern (名前付きグループを持つ正規表現) を指定すると、任意の書式の行を
+    re.findall でまとめて解析します (区切り文字の形式より遅くなります)。
+    どちらの場合も、一致しない行 (空行や別形式の行) は読み飛ばします。
+    """
+
+    def __init__(self, pattern=None, chunk_bytes=CHUNK_BYTES, delimiter=LOG_DELIMITER):
+        self.pattern = None
+        if pattern is not None:
+            self.pattern = re.compile(pattern, re.MULTILINE)
+            missing = [name for name in _FIELDS if name not in self.pattern.groupindex]
+            if missing:
+                raise ValueError(
+                    f"正規表現に必要な名前付きグループがありません: {missing}"
+                )
+            # findall の結果のタプル内での各フィールドの位置
+            self._columns = [self.pattern.groupindex[name] - 1 for name in _FIELDS]
+        elif len(delimiter) != 1 or delimiter in b"\r\n":
+            raise ValueError(
+                "区切り文字は改行以外の1バイトにしてください"
+                " (複数バイトの場合は delimiter_pattern() を pattern に指定します)"
+            )
+        self.delimiter = delimiter
+        self.chunk_bytes = chunk_bytes
+        self.threads = []
+        self._thread_ids = {}
+
+    def _thread_lookup(self, names):
+        # スレッド名 (bytes) の種類ごとに一度だけ辞書を引き、全体共通の番号の配列を返す
+        # (新しいスレッドには名前順に番号を振るので、解析方法によらず番号が同じになる)
+        for name in sorted(names):
+            if name not in self._thread_ids:
+                self._thread_ids[name] = len(self.threads)
+                self.threads.append(name.decode("utf-8", "replace"))
+        return np.array([self._thread_ids[name] for name in names], np.uint32)
+
+    def _encode_threads(self, values):
+        # チャンク内のスレッド名を np.unique でまとめてから番号に変換する
+        if not values:
+            return np.empty(0, np.uint32)
+        unique, inverse = np.unique(np.array(values), return_inverse=True)
+        return self._thread_lookup(unique.tolist())[inverse.reshape(-1)]
+
+    def _encode_spans(self, windows, starts, lengths):
+        # windows[starts[i], :lengths[i]] のスレッド名を番号に変換する。
+        # 名前を 8 バイト単位の固定幅に並べて 64bit のハッシュにまとめ、間引いた行のハッシュの
+        # 種類から searchsorted で分類する (全行の並べ替えを避ける)。全ての行の名前が
+        # 分類先の代表の名前と一致することを確かめ、ハッシュの衝突があれば
+        # 固定幅のバイト列そのものの np.unique に切り替える
+        if len(starts) == 0:
+            return np.empty(0, np.uint32)
+        width = -(-max(int(lengths.max()), 1) // 8) * 8
+        chars = windows[starts, :width]
+        chars[np.arange(width) >= lengths[:, None]] = 0
+        words = chars.view(np.uint64)
+
+        hashes = np.full(len(starts), 14695981039346656037, np.uint64)
+        prime = np.uint64(1099511628211)
+        with np.errstate(over="ignore"):
+            for j in range(words.shape[1]):
+                hashes = (hashes ^ words[:, j]) * prime
+        unique = np.unique(hashes[::_THREAD_SAMPLE_STEP])
+        inverse = np.minimum(np.searchsorted(unique, hashes), len(unique) - 1)
+        missing = unique[inverse] != hashes
+        if missing.any():
+            unique = np.union1d(unique, hashes[missing])
+            inverse = np.searchsorted(unique, hashes)
+        first = np.empty(len(unique), np.int64)
+        first[inverse[::-1]] = np.arange(len(starts))[::-1]
+        if not np.array_equal(words[first][inverse], words):
+            keys = np.ascontiguousarray(chars).view(f"S{width}").reshape(-1)
+            _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+            inverse = inverse.reshape(-1)
+        names = [chars[i, : lengths[i]].tobytes() for i in first]
+        return self._thread_lookup(names)[inverse]
+
+    def _parse_delimited(self, buf, start, end):
+        view = np.frombuffer(buf, np.uint8, end - start, start)
+        size = len(view)
+        newlines = np.flatnonzero(view == ord("\n"))
+        line_starts = np.concatenate(([0], newlines + 1))
+        line_ends = np.append(newlines, size)
+        if line_starts[-1] == size:
+            line_starts, line_ends = line_starts[:-1], line_ends[:-1]
+        # 行末の CR は行に含めない
+        has_cr = line_ends > line_starts
+        has_cr[has_cr] = view[line_ends[has_cr] - 1] == ord("\r")
+        line_ends = line_ends - has_cr
+
+        # 各行の最初の3つの区切り文字の位置 (足りない行は行末より後ろの位置になる)
+        delimiters = np.flatnonzero(view == self.delimiter[0])
+        padded = np.append(delimiters, [size] * 3)
+        first = np.searchsorted(delimiters, line_starts)
+        d1, d2, d3 = padded[first], padded[first + 1], padded[first + 2]
+        valid = (d3 < line_ends) & (d1 - line_starts >= 19)
+        if not valid.all():
+            line_starts, line_ends = line_starts[valid], line_ends[valid]
+            d1, d2, d3 = d1[valid], d2[valid], d3[valid]
+
+        # 任意の位置から固定幅のバイト列を行として取り出せる、コピーなしの2次元ビュー
+        # (チャンクの後ろに width バイト以上あればそのまま使い、ファイルの末尾では
+        # はみ出さないように 0 で埋めたコピーに対して作る)
+        width = max(23, int((d2 - d1).max(initial=0)), int((d3 - d2).max(initial=0)))
+        width = -(-width // 8) * 8
+        if end + width <= len(buf):
+            source = np.frombuffer(buf, np.uint8, size + width, start)
+        else:
+            source = np.zeros(size + width, np.uint8)
+            source[:size] = view
+        windows = as_strided(source, shape=(size, width), strides=(1, 1))
+
+        # タイムスタンプは行頭から固定幅で取り出し、行頭が日時でない行は読み飛ばす
+        chars = windows[line_starts, :23]
+        chars[np.arange(23) >= (d1 - line_starts)[:, None]] = 0
+        digits = chars[:, _TIMESTAMP_DIGITS]
+        valid = ((digits >= ord("0")) & (digits <= ord("9"))).all(axis=1)
+        if not valid.all():
+            line_starts, line_ends, chars = (
+                line_starts[valid],
+                line_ends[valid],
+                chars[valid],
+            )
+            d1, d2, d3 = d1[valid], d2[valid], d3[valid]
+
+        # メッセージは「区切り文字の後ろから行末まで」の範囲を表す真偽値の並びを
+        # 区間の長さの np.repeat で作り、1回のインデックス参照で連結する
+        message_starts = d3 + 1
+        bounds = np.empty(2 * len(line_starts) + 1, np.int64)
+        bounds[0] = 0
+        bounds[1::2] = message_starts
+        bounds[2::2] = line_ends
+        inside = np.zeros(len(bounds) - 1, bool)
+        inside[1::2] = True
+        mask = np.repeat(inside, np.diff(bounds))
+        heap = view[: len(mask)][mask]
+        message_offsets = np.zeros(len(line_starts) + 1, np.int64)
+        np.cumsum(line_ends - message_starts, out=message_offsets[1:])
+
+        return LogColumns(
+            timestamp_ms=_timestamps_from_chars(chars),
+            from_thread=self._encode_spans(windows, d1 + 1, d2 - d1 - 1),
+            to_thread=self._encode_spans(windows, d2 + 1, d3 - d2 - 1),
+            threads=self.threads,
+            message_offsets=message_offsets,
+            message_heap=heap,
+            line_offsets=(line_starts + start).astype(np.int64),
+            line_lengths=(line_ends - line_starts).astype(np.int32),
+        )
+
+    def _parse_range(self, buf, start, end):
+        matches = self.pattern.findall(buf, start, end)
+        view = np.frombuffer(buf, np.uint8, end - start, start)
+        newlines = np.flatnonzero(view == ord("\n")) + start
+        num_lines = len(newlines) + (end > start and buf[end - 1] != ord("\n"))
+
+        if len(matches) == num_lines:
+            # 全ての行が一致した場合は、改行の位置から行の範囲を求める
+            line_offsets = np.concatenate(([start], newlines + 1))[:num_lines]
+            line_ends = np.append(newlines, end)[:num_lines]
+            line_lengths = line_ends - line_offsets
+        else:
+            # 一致しない行がある場合だけ、一致ごとに位置を取り出す
+            found = list(self.pattern.finditer(buf, start, end))
+            matches = [m.groups() for m in found]
+            line_offsets = np.fromiter((m.start() for m in found), np.int64, len(found))
+            line_lengths = (
+                np.fromiter((m.end() for m in found), np.int64, len(found))
+                - line_offsets
+            )
+
+        columns = list(zip(*matches)) if matches else [(), (), (), ()]
+        ts, src, dst, msg = (columns[i] for i in self._columns)
+
+        lengths = np.fromiter(map(len, msg), np.int64, len(msg))
+        message_offsets = np.zeros(len(msg) + 1, np.int64)
+        np.cumsum(lengths, out=message_offsets[1:])
+        return LogColumns(
+            timestamp_ms=parse_timestamps_ms(ts),
+            from_thread=self._encode_threads(src),
+            to_thread=self._encode_threads(dst),
+            threads=self.threads,
+            message_offsets=message_offsets,
+            message_heap=np.frombuffer(b"".join(msg), np.uint8),
+            line_offsets=line_offsets.astype(np.int64),
+            line_lengths=line_lengths.astype(np.int32),
+        )
+
+    def iter_chunks(self, path):
+        """
+        ファイルを CHUNK_BYTES ごとに解析し、チャンクごとの LogColumns を返すジェネレータです。
+        同時にメモリに置かれるのは1チャンク分の解析結果だけです
+        (ファイル本体はメモリマップなので、必要な部分だけが OS によって読み込まれます)。
+        """
+        size = os.path.getsize(path)
+        if size == 0:
+            return
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                start = 0
+                while start < size:
+                    end = min(start + self.chunk_bytes, size)
+                    if end < size:
+                        # チャンクの境界を直前の改行の直後にそろえる
+                        # (1行がチャンクより長い場合は、その行の終わりまで広げる)
+                        newline = mm.rfind(b"\n", start, end)
+                        if newline < start:
+                            newline = mm.find(b"\n", end)
+                        end = size if newline < 0 else newline + 1
+                    if self.pattern is None:
+                        chunk = self._parse_delimited(mm, start, end)
+                    else:
+                        chunk = self._parse_range(mm, start, end)
+                    chunk.source = path
+                    yield chunk
+                    start = end
+
+    def parse(self, path):
+        """
+        ファイル全体を解析し、1つの LogColumns として返します。
+        """
+        parts = list(self.iter_chunks(path))
+        return LogColumns.concatenate(parts, self.threads, source=path)
+
+
+def load_log_file(path, pattern=None, chunk_bytes=CHUNK_BYTES, delimiter=LOG_DELIMITER):
+    """
+    ログファイルを解析して LogColumns を返します。
+    """
+    return LogParser(pattern, chunk_bytes, delimiter).parse(path)
+
+
+_LOADED = {}
+
+
+def cached_log_file(path, **kwargs):
+    """
+    load_log_file() の結果を、ファイルの更新日時と大きさが変わるまで使い回します
+    (API のリクエストごとにファイル全体を解析し直さないようにするため)。
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), tuple(sorted(kwargs.items())))
+    cached = _LOADED.get(key)
+    if cached is None or cached[0] != (stat.st_mtime_ns, stat.st_size):
+        cached = ((stat.st_mtime_ns, stat.st_size), load_log_file(path, **kwargs))
+        _LOADED[key] = cached
+    return cached[1]
+
+
+def generate_log_file(
+    path, size_bytes, num_threads=15, seed=0, delimiter=LOG_DELIMITER
+):
+    """
+    ベンチマーク用のログファイルを size_bytes 程度の大きさで作成します。
+    delimiter を None にすると、LOG_PATTERN のテキスト形式で書き出します。
+    """
+    rng = np.random.default_rng(seed)
+    threads = [f"Thread{i:02d}" for i in range(num_threads)]
+    levels = ["DEBUG", "INFO", "WARN"]
+    base = np.datetime64("2023-10-27T10:00:00.000", "ms")
+    written = 0
+    start_ms = 0
+    block = 100_000
+    with open(path, "w", encoding="utf-8", newline="\n") as f:
+        while written < size_bytes:
+            offsets = start_ms + np.cumsum(rng.integers(0, 20, block))
+            start_ms = int(offsets[-1])
+            stamps = np.char.replace(
+                np.datetime_as_string(base + offsets, unit="ms"), "T", " "
+            )
+            src = rng.integers(0, num_threads, block)
+            dst = (src + rng.integers(1, num_threads, block)) % num_threads
+            level = rng.integers(0, len(levels), block)
+            ids = rng.integers(0, 10**6, block)
+            if delimiter is None:
+                text = "".join(
+                    f"{stamps[i]} {levels[level[i]]} {threads[src[i]]} -> "
+                    f"{threads[dst[i]]}: Message-{ids[i]} payload={ids[i] * 7 % 9973}\n"
+                    for i in range(block)
+                )
+            else:
+                d = delimiter.decode()
+                text = "".join(
+                    f"{stamps[i]}{d}{threads[src[i]]}{d}{threads[dst[i]]}{d}"
+                    f"{levels[level[i]]} Message-{ids[i]} payload={ids[i] * 7 % 9973}\n"
+                    for i in range(block)
+                )
+            f.write(text)
+            written += len(text)
+    return written
+
+
+if __name__ == "__main__":
+    # 解析速度のベンチマーク:
+    # 既定の書式のログファイルを作成し、1コアでの解析速度 (MB/s) を測ります。
+    # 例: python log_parser.py --size-mb 2048
+    import argparse
+    import tempfile
+    import time
+
+    parser = argparse.ArgumentParser(description="ログファイルの解析速度を測ります。")
+    parser.add_argument(
+        "--size-mb", type=int, default=512, help="作成するログの大きさ (MB)"
+    )
+    parser.add_argument("--path", help="既存のログファイル (指定すると作成しない)")
+    parser.add_argument(
+        "--pattern",
+        action="store_true",
+        help="区切り文字の形式の代わりに LOG_PATTERN のテキスト形式を正規表現で解析する",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = args.path
+        if path is None:
+            path = os.path.join(tmp_dir, "thread_messages.log")
+            start = time.perf_counter()
+            generate_log_file(
+                path,
+                args.size_mb * 1024**2,
+                delimiter=None if args.pattern else LOG_DELIMITER,
+            )
+            print(f"ログを作成しました: {time.perf_counter() - start:.1f} 秒")
+        size = os.path.getsize(path)
+
+        start = time.perf_counter()
+        logs = load_log_file(path, pattern=LOG_PATTERN if args.pattern else None)
+        elapsed = time.perf_counter() - start
+        print(f"ファイルサイズ: {size / 1024**2:.1f} MB, 行数: {len(logs)}")
+        print(f"解析時間: {elapsed:.2f} 秒 ({size / 1024**2 / elapsed:.1f} MB/s)")
+        print(f"スレッド数: {len(logs.threads)}")
@@ -0,0 +1,337 @@
+import gzip
+import json
+import struct
+
+import numpy as np
+
+from result_cache import make_key
+
+# orjson / brotli はあれば使う (なければ標準の json / gzip で同じ形式の応答を返す)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+# Arrow IPC の応答は pyarrow があるときだけ返す
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+# これより小さい応答は圧縮しない (バイト)
+MIN_COMPRESS_BYTES = 1024
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+# 応答の形式: records (行ごとの辞書) / columnar (列ごとの配列の JSON) /
+# binary (型付き配列のバイナリ) / arrow (Arrow IPC ストリーム)
+RESPONSE_FORMATS = ("records", "columnar", "binary", "arrow")
+# 文字列の列をデコードせずに {"offsets", "data"} で返す形式
+BINARY_FORMATS = ("binary", "arrow")
+BINARY_MIMETYPE = "application/x-log-columns"
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+MIMETYPES = {
+    "records": "application/json",
+    "columnar": "application/json",
+    "binary": BINARY_MIMETYPE,
+    "arrow": ARROW_MIMETYPE,
+}
+
+# バイナリ形式: 先頭に BINARY_MAGIC とヘッダ (JSON) の長さ (uint32)、続いてヘッダ、
+# その後に各配列のバイト列をリトルエンディアンで BINARY_ALIGN バイト境界に並べる
+BINARY_MAGIC = b"LOGC"
+BINARY_VERSION = 1
+BINARY_ALIGN = 8
+# ブラウザの型付き配列 (Int8Array ... BigUint64Array, Float32Array, Float64Array) で読める型
+_BINARY_DTYPES = (
+    "int8",
+    "uint8",
+    "int16",
+    "uint16",
+    "int32",
+    "uint32",
+    "int64",
+    "uint64",
+    "float32",
+    "float64",
+)
+
+
+def _default(value):
+    # 標準の json で numpy の配列・数値を変換する
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"JSON に変換できない型です: {type(value).__name__}")
+
+
+def dumps(payload):
+    """
+    応答の辞書を JSON のバイト列にします。numpy の配列はそのまま渡せます
+    (orjson があれば配列を Python のリストにせずに直接書き出します)。
+    """
+    if orjson is not None:
+        return orjson.dumps(
+            payload, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        )
+    return json.dumps(
+        payload, default=_default, ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def choose_format(format_arg=None, accept=None):
+    """
+    クエリの format と Accept ヘッダから応答の形式 (RESPONSE_FORMATS のいずれか) を選びます。
+    format の指定を優先し、なければ Accept がバイナリ / Arrow を求めるときだけそれを返します
+    (既存のクライアントには今までどおり JSON を返します)。
+    Arrow は pyarrow がなければ返せないため、代わりに JSON を返します。
+    """
+    if format_arg not in RESPONSE_FORMATS:
+        accept = (accept or "").lower()
+        if BINARY_MIMETYPE in accept:
+            format_arg = "binary"
+        elif ARROW_MIMETYPE in accept:
+            format_arg = "arrow"
+        else:
+            format_arg = "records"
+    if format_arg == "arrow" and pyarrow is None:
+        return "records"
+    return format_arg
+
+
+def choose_encoding(accept_encoding):
+    """
+    Accept-Encoding ヘッダから使う圧縮方式 ("br" / "gzip" / None) を選びます。
+    """
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.lower()] = quality
+    for encoding in ("br", "gzip"):
+        if encoding == "br" and brotli is None:
+            continue
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    return body
+
+
+def _little_endian(array):
+    # 型付き配列でそのまま読めるよう、連続したリトルエンディアンの配列にする
+    if array.dtype == np.bool_:
+        array = array.view(np.uint8)
+    return np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+
+
+def dumps_binary(payload):
+    """
+    応答の辞書をバイナリ形式 (BINARY_MIMETYPE) のバイト列にします。
+
+    数値の numpy 配列はヘッダの JSON では {"$array": 型, "offset": 位置, "length": 要素数}
+    に置き換え、本体をヘッダの後ろのデータ部に BINARY_ALIGN バイト境界で並べます
+    (offset はデータ部の先頭からの位置)。ブラウザでは
+    new BigInt64Array(buffer, データ部の先頭 + offset, length) などでコピーせずに読めます
+    (文字列の列は LogColumns.to_columnar(heap=True) の {"offsets", "data"} で渡します)。
+    """
+    arrays = []
+    size = 0
+
+    def replace(value):
+        nonlocal size
+        if isinstance(value, dict):
+            return {key: replace(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [replace(item) for item in value]
+        if isinstance(value, np.ndarray) and (
+            value.dtype.name in _BINARY_DTYPES or value.dtype == np.bool_
+        ):
+            array = _little_endian(value)
+            ref = {"$array": array.dtype.name, "offset": size, "length": len(array)}
+            arrays.append(array)
+            size += -(-array.nbytes // BINARY_ALIGN) * BINARY_ALIGN
+            return ref
+        return value
+
+    header = dumps({"version": BINARY_VERSION, "payload": replace(payload)})
+    # データ部が BINARY_ALIGN バイト境界から始まるよう、ヘッダの後ろを空白で埋める
+    # (JSON として読むときは無視される)
+    header += b" " * (-(len(header) + 8) % BINARY_ALIGN)
+    parts = [BINARY_MAGIC, struct.pack("<I", len(header)), header]
+    for array in arrays:
+        parts.append(array.tobytes())
+        parts.append(b"\0" * (-array.nbytes % BINARY_ALIGN))
+    return b"".join(parts)
+
+
+def dumps_arrow(payload):
+    """
+    応答の辞書を Arrow IPC ストリームのバイト列にします (pyarrow が必要です)。
+
+    payload["logs"] の列形式のログを1つのレコードバッチにし、文字列の列は
+    {"offsets", "data"} のバイト列をそのまま Arrow の文字列の列にします。
+    それ以外の項目 (threads や集計表示の counts / edges など) はスキーマの
+    メタデータ "payload" に JSON で入れます。
+    """
+    logs = payload.get("logs")
+    rest = {key: value for key, value in payload.items() if key != "logs"}
+    fields = {}
+    if isinstance(logs, dict):
+        rest["threads"] = logs.get("threads", rest.get("threads"))
+        for name, column in logs.items():
+            if isinstance(column, np.ndarray):
+                fields[name] = pyarrow.array(column)
+            elif isinstance(column, dict):
+                offsets = np.asarray(column["offsets"], dtype=np.int64)
+                fields[name] = pyarrow.LargeStringArray.from_buffers(
+                    len(offsets) - 1,
+                    pyarrow.py_buffer(offsets),
+                    pyarrow.py_buffer(np.ascontiguousarray(column["data"])),
+                )
+    batch = pyarrow.record_batch(
+        fields, metadata={"payload": dumps(rest)} if fields else None
+    )
+    if not fields:
+        batch = pyarrow.RecordBatch.from_pydict({}, metadata={"payload": dumps(rest)})
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
+
+
+def encode_response(payload, accept_encoding=None, response_format="records"):
+    """
+    応答の辞書を response_format の形式のバイト列にし、Accept-Encoding に合わせて圧縮します。
+    戻り値は (本文のバイト列, Content-Encoding または None) です。
+    """
+    if response_format == "binary":
+        body = dumps_binary(payload)
+    elif response_format == "arrow":
+        body = dumps_arrow(payload)
+    else:
+        body = dumps(payload)
+    encoding = choose_encoding(accept_encoding)
+    if encoding is None or len(body) < MIN_COMPRESS_BYTES:
+        return body, None
+    return compress(body, encoding), encoding
+
+
+def error_response(message, status=400):
+    """
+    {"error": message} の JSON を返す Flask のエラーレスポンスを作ります。
+    """
+    from flask import Response
+
+    return Response(
+        dumps({"error": message}), status=status, mimetype="application/json"
+    )
+
+
+def api_response(build, *etag_parts):
+    """
+    build(response_format) の結果を、choose_format() で選んだ形式で返す Flask のレスポンスを作ります。
+
+    ETag は etag_parts (ストアの指紋とクエリなど、応答の内容を決める値) と形式・圧縮方式から
+    作るため、If-None-Match が一致すれば build() を呼ばずに 304 を返します
+    (強い ETag なので、圧縮方式が違えば本文のバイト列と同じく ETag も変わります)。
+    """
+    from flask import Response, request
+
+    response_format = choose_format(
+        request.args.get("format"), request.headers.get("Accept")
+    )
+    accept_encoding = request.headers.get("Accept-Encoding")
+    etag = make_key(response_format, choose_encoding(accept_encoding), *etag_parts)
+    headers = {"ETag": f'"{etag}"', "Vary": "Accept, Accept-Encoding"}
+    if etag in request.if_none_match:
+        return Response(status=304, headers=headers)
+    body, encoding = encode_response(
+        build(response_format), accept_encoding, response_format
+    )
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return Response(body, mimetype=MIMETYPES[response_format], headers=headers)
+
+
+if __name__ == "__main__":
+    # 応答の大きさと作成時間のベンチマーク:
+    # 行ごとの辞書 (従来の形式)、列ごとの配列 (format=columnar)、型付き配列のバイナリ
+    # (format=binary)、Arrow IPC (format=arrow, pyarrow があれば) を、圧縮なし・圧縮ありで比べます。
+    # 例: python log_response.py --rows 1000000
+    import argparse
+    import os
+    import tempfile
+    import time
+
+    from log_parser import generate_log_file
+    from log_store import LogStore
+
+    parser = argparse.ArgumentParser(
+        description="ログ API の応答の大きさと作成時間を測ります。"
+    )
+    parser.add_argument("--rows", type=int, default=1_000_000, help="応答に含める行数")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "thread_messages.log")
+        # 1行はおよそ 75 バイト
+        generate_log_file(path, args.rows * 80)
+        store = LogStore.open(path, os.path.join(tmp_dir, "store"))
+        indices = np.arange(min(args.rows, len(store)))
+        print(f"行数: {len(indices)}, encoder: {'orjson' if orjson else 'json'}")
+
+        cases = [
+            ("行ごとの辞書", lambda: store.records(indices), dumps),
+            ("列ごとの配列", lambda: store.columns.to_columnar(indices), dumps),
+            (
+                "バイナリ",
+                lambda: store.columns.to_columnar(indices, heap=True),
+                dumps_binary,
+            ),
+        ]
+        if pyarrow is not None:
+            cases.append(
+                (
+                    "Arrow",
+                    lambda: store.columns.to_columnar(indices, heap=True),
+                    dumps_arrow,
+                )
+            )
+        for label, build, encode in cases:
+            start = time.perf_counter()
+            payload = {"logs": build(), "categories": store.threads}
+            built = time.perf_counter() - start
+            start = time.perf_counter()
+            body = encode(payload)
+            encoded = time.perf_counter() - start
+            print(
+                f"{label}: 作成 {built * 1000:.0f} ms, 書き出し {encoded * 1000:.0f} ms, "
+                f"{len(body) / 1024**2:.1f} MB"
+            )
+            for encoding in ("gzip", "br"):
+                if encoding == "br" and brotli is None:
+                    continue
+                start = time.perf_counter()
+                compressed = compress(body, encoding)
+                print(
+                    f"  {encoding}: {(time.perf_counter() - start) * 1000:.0f} ms, "
+                    f"{len(compressed) / 1024**2:.1f} MB"
+                )
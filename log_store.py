@@ -0,0 +1,459 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+from log_lod import LodPyramid, thread_counts
+from log_parser import LogColumns, load_log_file
+from result_cache import file_fingerprint
+
+# ストアの形式を変えた場合はこの値を上げる (古いストアは作り直される)
+STORE_VERSION = 2
+# 疎なタイムスタンプ索引で何行ごとに時刻を記録するか
+INDEX_STRIDE = 4096
+# スレッドで絞り込むときに一度に調べる行数 (limit に達したらそこで止める)
+QUERY_BLOCK = 65536
+# 表示範囲のイベント数がこれ以下なら、集計せずに元のイベントをそのまま返す
+RAW_EVENT_LIMIT = 2000
+# 集計表示で返す スレッドの組ごとの件数 (edges) の上限 (件数の多いものから残す)
+MAX_EDGES = 2000
+
+# API で受け付ける時刻 (エポックミリ秒) の絶対値の上限
+# (ブラウザの数値で正確に表せる範囲。ビンの計算で int64 があふれないようにする)
+MAX_TIME_MS = 2**53 - 1
+
+META_FILENAME = "meta.json"
+SPARSE_INDEX_FILENAME = "sparse_index.npy"
+_ARRAYS = (
+    "timestamp_ms",
+    "from_thread",
+    "to_thread",
+    "message_offsets",
+    "message_heap",
+    "line_offsets",
+    "line_lengths",
+)
+
+
+def parse_time(value, name="time"):
+    """
+    API のパラメータの時刻を UNIX エポックからのミリ秒に変換します。
+    整数ならミリ秒そのもの、それ以外は ISO 形式の日時 (タイムゾーンなしは UTC) とみなします。
+    解釈できない値は ValueError (メッセージに name を含む) を送出します。
+    """
+    if value is None or value == "":
+        return None
+    try:
+        ms = int(value)
+    except ValueError:
+        text = str(value).strip().replace(" ", "T")
+        if text.endswith("Z"):
+            text = text[:-1]
+        try:
+            ms = int(np.datetime64(text, "ms").astype(np.int64))
+        except ValueError:
+            raise ValueError(
+                f"{name} はエポックミリ秒か ISO 形式の日時で指定してください: {value!r}"
+            ) from None
+    if abs(ms) > MAX_TIME_MS:
+        raise ValueError(f"{name} の値が範囲外です: {value!r}")
+    return ms
+
+
+def _parse_int(value, name, default, minimum=0):
+    # API のパラメータの整数を読む (省略時は default、minimum 未満や整数でなければ ValueError)
+    if value is None or value == "":
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError(f"{name} は整数で指定してください: {value!r}") from None
+    if number < minimum:
+        raise ValueError(f"{name} は {minimum} 以上で指定してください: {value!r}")
+    return number
+
+
+def parse_query(args, default_limit=None):
+    """
+    API のクエリパラメータ (start, end, threads, limit) を LogStore.query() の引数にします。
+    start / end は parse_time() の形式、threads はカンマ区切りのスレッド名です。
+    値が正しくなければ ValueError を送出します (API では 400 を返します)。
+    """
+    threads = args.get("threads")
+    return {
+        "start": parse_time(args.get("start"), "start"),
+        "end": parse_time(args.get("end"), "end"),
+        "threads": threads.split(",") if threads else None,
+        "limit": _parse_int(args.get("limit"), "limit", default_limit),
+    }
+
+
+def parse_lod_query(args, default_width=1000):
+    """
+    LOD の API のクエリパラメータ (start, end, width, threads, limit, max_edges) を
+    LogStore.lod() の引数にします。limit は元のイベントを返す件数の上限です。
+    値が正しくなければ ValueError を送出します (API では 400 を返します)。
+    """
+    query = parse_query(args)
+    return {
+        "start_ms": query["start"],
+        "end_ms": query["end"],
+        "width": _parse_int(args.get("width"), "width", default_width, minimum=1),
+        "threads": query["threads"],
+        "limit": query["limit"],
+        "max_edges": _parse_int(args.get("max_edges"), "max_edges", MAX_EDGES),
+    }
+
+
+class LogStore:
+    """
+    時刻順に並べ替えたログの列ごとの配列を .npy ファイルとして保存し、
+    メモリマップで開くストアです。
+
+    INDEX_STRIDE 行ごとのタイムスタンプだけを持つ疎な索引 (sparse_index) をメモリに置き、
+    時刻の範囲の検索は 索引の二分探索 → 該当する1ブロック内の二分探索 で行います。
+    検索の計算量はログの行数の対数で、読み込まれるのは索引と1ブロック分のページだけです。
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, META_FILENAME), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        arrays = {
+            name: np.load(os.path.join(store_dir, f"{name}.npy"), mmap_mode="r")
+            for name in _ARRAYS
+        }
+        self.columns = LogColumns(
+            threads=self.meta["threads"], source=self.meta["source"], **arrays
+        )
+        self.sparse_index = np.load(os.path.join(store_dir, SPARSE_INDEX_FILENAME))
+        self.pyramid = LodPyramid.load(store_dir)
+        self._thread_ids = {name: i for i, name in enumerate(self.columns.threads)}
+
+    def __len__(self):
+        return len(self.columns)
+
+    @property
+    def threads(self):
+        return self.columns.threads
+
+    @classmethod
+    def build(cls, logs, store_dir, fingerprint=None):
+        """
+        LogColumns を時刻順に並べ替えてストアとして保存し、開いて返します。
+        """
+        order = np.argsort(logs.timestamp_ms, kind="stable")
+        if np.any(order != np.arange(len(order))):
+            logs = logs.take(order)
+
+        # 書き込み途中のストアを開かないよう、一時ディレクトリに書いてから置き換える
+        # (一時ディレクトリは作るたびに別の名前にし、同時に作っても互いに消し合わないようにする)
+        store_dir = store_dir.rstrip(os.sep)
+        tmp_dir = tempfile.mkdtemp(
+            prefix=f"{os.path.basename(store_dir)}.",
+            suffix=".tmp",
+            dir=os.path.dirname(store_dir) or None,
+        )
+        for name in _ARRAYS:
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), getattr(logs, name))
+        np.save(
+            os.path.join(tmp_dir, SPARSE_INDEX_FILENAME),
+            np.asarray(logs.timestamp_ms[::INDEX_STRIDE]),
+        )
+        LodPyramid.build(
+            logs.timestamp_ms, logs.from_thread, logs.to_thread, len(logs.threads)
+        ).save(tmp_dir)
+        meta = {
+            "version": STORE_VERSION,
+            "index_stride": INDEX_STRIDE,
+            "rows": len(logs),
+            "threads": list(logs.threads),
+            "source": logs.source,
+            "fingerprint": fingerprint,
+        }
+        with open(os.path.join(tmp_dir, META_FILENAME), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        # 別のプロセスが同じログから先にストアを作っていれば、置き換えずにそちらを使う
+        store = cls._open_current(store_dir, fingerprint)
+        if store is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return store
+        shutil.rmtree(store_dir, ignore_errors=True)
+        try:
+            os.replace(tmp_dir, store_dir)
+        except OSError:
+            # 置き換えの直前に別のプロセスがストアを置いた場合は、そちらを開いて使う
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            store = cls._open_current(store_dir, fingerprint)
+            if store is None:
+                raise
+            return store
+        return cls(store_dir)
+
+    @classmethod
+    def _open_current(cls, store_dir, fingerprint):
+        # store_dir に現在の形式・同じ指紋のストアがあれば開いて返す (なければ None)
+        try:
+            store = cls(store_dir)
+        except (OSError, ValueError, KeyError):
+            return None
+        if (
+            store.meta.get("version") == STORE_VERSION
+            and store.meta.get("index_stride") == INDEX_STRIDE
+            and store.meta.get("fingerprint") == fingerprint
+        ):
+            return store
+        return None
+
+    @classmethod
+    def open(cls, log_path, store_dir=None, **parse_kwargs):
+        """
+        log_path のストアを開きます。ストアがない・古い形式・ログファイルが更新されている
+        場合は、ログファイルを解析してストアを作り直します。
+        store_dir を省略すると "<log_path>.store" を使います。
+        """
+        store_dir = store_dir or f"{log_path}.store"
+        fingerprint = file_fingerprint(log_path)
+        store = cls._open_current(store_dir, fingerprint)
+        if store is not None:
+            return store
+        logs = load_log_file(log_path, **parse_kwargs)
+        return cls.build(logs, store_dir, fingerprint=fingerprint)
+
+    def time_range(self):
+        """
+        最初と最後の行のタイムスタンプ (ミリ秒) を返します。空のストアでは None です。
+        """
+        if len(self) == 0:
+            return None
+        return int(self.columns.timestamp_ms[0]), int(self.columns.timestamp_ms[-1])
+
+    def search(self, t_ms, side="left"):
+        """
+        時刻 t_ms を挿入できる行の位置を np.searchsorted と同じ規則で返します。
+        """
+        stride = self.meta["index_stride"]
+        block = int(np.searchsorted(self.sparse_index, t_ms, side))
+        if block == 0:
+            return 0
+        base = (block - 1) * stride
+        timestamps = self.columns.timestamp_ms[base : min(block * stride, len(self))]
+        return base + int(np.searchsorted(timestamps, t_ms, side))
+
+    def thread_codes(self, names):
+        """
+        スレッド名のリストをカテゴリ番号の配列に変換します (ストアにない名前は無視します)。
+        """
+        return np.array(
+            [self._thread_ids[n] for n in names if n in self._thread_ids],
+            dtype=self.columns.from_thread.dtype,
+        )
+
+    def query(self, start_ms=None, end_ms=None, threads=None, limit=None):
+        """
+        start_ms <= 時刻 <= end_ms の行のうち、送信元か送信先が threads に含まれる行の
+        位置 (時刻順) を最大 limit 件返します。省略した条件では絞り込みません。
+        """
+        lo = 0 if start_ms is None else self.search(start_ms, "left")
+        hi = len(self) if end_ms is None else self.search(end_ms, "right")
+        if hi <= lo:
+            return np.empty(0, np.int64)
+        if threads is None:
+            if limit is not None:
+                hi = min(hi, lo + limit)
+            return np.arange(lo, hi, dtype=np.int64)
+
+        # 範囲全体を一度に調べず、ブロックごとに調べて limit に達したら止める
+        codes = self.thread_codes(threads)
+        found = []
+        remaining = limit
+        for block_start in range(lo, hi, QUERY_BLOCK):
+            block_end = min(block_start + QUERY_BLOCK, hi)
+            mask = np.isin(
+                self.columns.from_thread[block_start:block_end], codes
+            ) | np.isin(self.columns.to_thread[block_start:block_end], codes)
+            rows = np.flatnonzero(mask) + block_start
+            if remaining is not None:
+                rows = rows[:remaining]
+                remaining -= len(rows)
+            found.append(rows)
+            if remaining == 0:
+                break
+        return np.concatenate(found).astype(np.int64, copy=False)
+
+    def lod(
+        self,
+        start_ms=None,
+        end_ms=None,
+        width=1000,
+        threads=None,
+        limit=None,
+        max_edges=MAX_EDGES,
+        columnar=False,
+        heap=False,
+    ):
+        """
+        表示範囲 [start_ms, end_ms] を画面の幅 width (画素) で描くためのデータを返します。
+
+        範囲内のイベントが RAW_EVENT_LIMIT 件 (limit を指定すればその件数) 以下なら
+        mode="raw" で元のイベント (records() の形式、columnar なら
+        LogColumns.to_columnar() の列形式、heap も指定すれば文字列の列はデコードしない)
+        を返します。それより多ければ mode="bins" で、ピラミッドから選んだ段の
+        ビンごとの 送信元スレッドごとの件数 (counts) と スレッドの組ごとの件数 (edges) を、
+        時刻 (ビンの開始、エポックミリ秒) 付きで返します。
+        edges は件数の多いものから max_edges 件までに絞ります (edges_truncated が True になります)。
+        """
+        time_range = self.time_range()
+        if time_range is None:
+            return {"mode": "raw", "threads": self.threads, "logs": []}
+        start_ms = time_range[0] if start_ms is None else start_ms
+        end_ms = time_range[1] if end_ms is None else end_ms
+        if self.search(end_ms, "right") - self.search(start_ms, "left") <= (
+            RAW_EVENT_LIMIT if limit is None else limit
+        ):
+            indices = self.query(start_ms, end_ms, threads=threads)
+            return {
+                "mode": "raw",
+                "start": start_ms,
+                "end": end_ms,
+                "threads": self.threads,
+                "logs": (
+                    self.columns.to_columnar(indices, heap=heap)
+                    if columnar
+                    else self.records(indices)
+                ),
+            }
+
+        codes = None if threads is None else self.thread_codes(threads)
+        level, rows = self.pyramid.query(start_ms, end_ms, width, codes)
+        bin_ms = self.pyramid.bin_ms(level)
+        counts = thread_counts(rows)
+        edges_truncated = len(rows["count"]) > max_edges
+        if edges_truncated:
+            keep = np.sort(np.argpartition(-rows["count"], max_edges)[:max_edges])
+            rows = {name: values[keep] for name, values in rows.items()}
+
+        def times(bins):
+            return self.pyramid.origin_ms + bins * bin_ms
+
+        return {
+            "mode": "bins",
+            "start": start_ms,
+            "end": end_ms,
+            "bin_ms": bin_ms,
+            "threads": self.threads,
+            "counts": {
+                "time": times(counts["bin"]),
+                "thread": counts["thread"],
+                "count": counts["count"],
+            },
+            "edges": {
+                "time": times(rows["bin"]),
+                "from_thread": rows["from_thread"],
+                "to_thread": rows["to_thread"],
+                "count": rows["count"],
+            },
+            "edges_truncated": edges_truncated,
+        }
+
+    def records(self, indices):
+        """
+        query() で得た行を API の応答用の辞書のリストにします (LogColumns.to_records)。
+        """
+        return self.columns.to_records(indices)
+
+
+_OPENED = {}
+# 同じストアを複数のスレッドが同時に作らないよう、キーごとのロックで順番に開く
+_OPENED_LOCKS = {}
+_OPENED_LOCKS_LOCK = threading.Lock()
+
+
+def open_log_store(log_path, store_dir=None, **parse_kwargs):
+    """
+    LogStore.open() の結果を、ログファイルが更新されるまで使い回します。
+    複数のスレッドから同時に呼べます (ストアを作るのは1つのスレッドだけです)。
+    """
+    key = (os.path.abspath(log_path), store_dir, tuple(sorted(parse_kwargs.items())))
+    with _OPENED_LOCKS_LOCK:
+        lock = _OPENED_LOCKS.setdefault(key, threading.Lock())
+    with lock:
+        fingerprint = file_fingerprint(log_path)
+        cached = _OPENED.get(key)
+        if cached is None or cached[0] != fingerprint:
+            cached = (fingerprint, LogStore.open(log_path, store_dir, **parse_kwargs))
+            _OPENED[key] = cached
+        return cached[1]
+
+
+if __name__ == "__main__":
+    # 検索速度のベンチマーク:
+    # ログファイルからストアを作り、ランダムな時間範囲の検索にかかる時間を測ります。
+    # 例: python log_store.py --size-mb 1024
+    import argparse
+    import tempfile
+    import time
+
+    from log_parser import generate_log_file
+
+    parser = argparse.ArgumentParser(description="ログストアの検索速度を測ります。")
+    parser.add_argument(
+        "--size-mb", type=int, default=256, help="作成するログの大きさ (MB)"
+    )
+    parser.add_argument("--path", help="既存のログファイル (指定すると作成しない)")
+    parser.add_argument("--queries", type=int, default=1000, help="検索の回数")
+    parser.add_argument("--limit", type=int, default=5000, help="1回の検索の上限件数")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = args.path
+        store_dir = os.path.join(tmp_dir, "store")
+        if path is None:
+            path = os.path.join(tmp_dir, "thread_messages.log")
+            generate_log_file(path, args.size_mb * 1024**2)
+
+        start = time.perf_counter()
+        store = LogStore.open(path, store_dir)
+        print(f"ストアの作成: {time.perf_counter() - start:.1f} 秒, 行数: {len(store)}")
+        start = time.perf_counter()
+        store = LogStore(store_dir)
+        print(f"ストアを開く: {(time.perf_counter() - start) * 1000:.2f} ms")
+
+        first, last = store.time_range()
+        rng = np.random.default_rng(0)
+        starts = rng.integers(first, last, args.queries)
+        spans = rng.integers(1_000, 600_000, args.queries)
+        threads = store.threads[:2]
+        for label, kwargs in (
+            ("時間範囲", {}),
+            (f"時間範囲 + スレッド {threads}", {"threads": threads}),
+        ):
+            rows = 0
+            start = time.perf_counter()
+            for s, span in zip(starts, spans):
+                rows += len(store.query(s, s + span, limit=args.limit, **kwargs))
+            elapsed = time.perf_counter() - start
+            print(
+                f"{label}: 平均 {elapsed / args.queries * 1e6:.1f} µs/回"
+                f" (平均 {rows / args.queries:.0f} 行)"
+            )
+
+        # LOD: 画面の幅 1000 画素で、全体・ランダムな範囲を表示するときの応答の大きさ
+        from log_response import dumps
+
+        for label, ranges in (
+            ("LOD 全体", [(first, last)]),
+            ("LOD ランダムな範囲", list(zip(starts, starts + spans))[:100]),
+        ):
+            sizes = []
+            start = time.perf_counter()
+            for s, e in ranges:
+                sizes.append(len(dumps(store.lod(int(s), int(e), width=1000))))
+            elapsed = time.perf_counter() - start
+            print(
+                f"{label}: 平均 {elapsed / len(ranges) * 1000:.1f} ms/回,"
+                f" 応答 平均 {np.mean(sizes) / 1024:.0f} KB (最大 {max(sizes) / 1024:.0f} KB)"
+            )
@@ -1,9 +1,25 @@
 import glob
 import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import partial
 
 import cv2
 import numpy as np
 
+from image_io import AsyncImageWriter, imread_for_width, imwrite_params, read_ahead
+from mask_store import (
+    LABEL_BODY,
+    LABEL_INNER,
+    LABEL_OUTER,
+    MaskShardWriter,
+    make_record,
+)
+from instrumentation import METRICS
+from result_cache import ResultManifest, StageStore, file_fingerprint, make_key
+
 # --- 設定項目 ---
 # ご自身の環境に合わせて変更してください
 IMAGE_DIR = "your_image_directory"  # 画像が保存されているディレクトリパス
@@ -15,210 +31,953 @@ RESIZE_WIDTH = 800
 # マスクで塗りつぶす色 (BGR形式)
 MASK_COLOR = (0, 0, 0)  # 黒色で塗りつぶす場合
 
+# 検出パラメータ (画像の特性に合わせて調整してください)
+BLUR_KSIZE = (7, 7)  # ガウシアンブラーのカーネルサイズ (画像のノイズに応じて調整)
+THRESH_BLOCK_SIZE = 15  # 適応的閾値処理の blockSize (奇数)
+THRESH_C = 5  # 適応的閾値処理の C
+OPEN_ITERATIONS = 1  # ノイズ除去 (オープニング) の繰り返し回数
+CLOSE_ITERATIONS = 2  # 穴埋め (クロージング) の繰り返し回数
+MIN_HOLE_AREA_RATIO = (
+    0.001  # 内側の穴が画像全体の面積のこの割合より大きければドーナツとみなす
+)
+
+# 並列処理の設定
+# ワーカープロセス数 (1 にすると従来通り逐次処理)
+NUM_WORKERS = os.cpu_count() or 1
+# 1 回のタスク送信でワーカーに渡す画像の枚数 (大きいほどプロセス間通信が減る)
+CHUNK_SIZE = 16
+# 各ワーカー内で OpenCV が使うスレッド数
+# ワーカー数 × OpenCV スレッド数 がコア数を超えると逆に遅くなるため 1 を推奨
+CV2_THREADS_PER_WORKER = 1
+
+# 入出力の設定
+# 出力モード
+#   "png"  : 画像ごとにマスク3枚とマスク適用画像3枚を保存する (従来通り)
+#   "shard": 輪郭だけを SHARD_SIZE 枚ごとに1つの .npz にまとめて保存する
+#            (マスク等は mask_store.MaskShardReader で必要な時に再構成する)
+OUTPUT_MODE = "png"
+# "shard" モードで1つのシャードにまとめる画像の枚数
+SHARD_SIZE = 1000
+# "shard" モードで輪郭に加えてラベル画像の RLE も保存するか
+STORE_LABEL_MASK = False
+# 出力画像の形式 (".png", ".webp", ".tiff", ".bmp" のいずれか。全て可逆圧縮)
+OUTPUT_EXT = ".png"
+# PNG の圧縮レベル (0: 無圧縮・最速 〜 9: 最小サイズ・最遅、None で OpenCV の既定値)
+PNG_COMPRESSION = None
+# JPEG を読み込む際、RESIZE_WIDTH より十分大きければ 1/2, 1/4, 1/8 に縮小しながらデコードする
+# (デコード時間とメモリを削減できる。最後に RESIZE_WIDTH へ正確にリサイズする)
+REDUCED_DECODE = True
+# 画像の読み込み・保存に使うバックグラウンドスレッド数 (各ワーカーごと)
+IO_THREADS = 2
+# 先読みしておく画像の枚数
+READ_AHEAD = 4
+# 保存待ちにできる画像の枚数の上限 (超えると計算側が待たされる)
+WRITE_BACKLOG = 32
+
+# 差分実行 (キャッシュ) の設定
+# True にすると、前回と同じ入力・同じパラメータの画像は処理を省略する
+# (キャッシュは OUTPUT_DIR/.donut_cache に保存される)
+USE_CACHE = True
+# 入力の変更判定に内容のハッシュを使うか (False なら更新時刻とサイズで判定する)
+CACHE_HASH_CONTENT = False
+# 途中段階 (リサイズ後の画像と前処理済みの二値画像) のキャッシュの合計サイズの上限 (バイト)
+CACHE_MAX_BYTES = 2 * 1024**3
+# この日数より長く使われていないキャッシュは削除する
+CACHE_MAX_AGE_DAYS = 30
+
+# 注目領域 (ROI) の設定
+# Grad-CAM などの顕著性マップ (.npy) を置いたディレクトリ。画像と同じベース名 (例: img001.npy) の
+# マップがあれば、値の大きい領域だけを切り出して二値化・輪郭抽出を行う (None の場合は常に画像全体を処理する)
+SALIENCY_DIR = None
+# 顕著性マップの最大値に対してこの割合以上の値を持つ範囲を注目領域とする
+ROI_SALIENCY_THRESHOLD = 0.3
+# 注目領域の周囲に加える余白 (注目領域の幅・高さに対する割合)
+ROI_MARGIN = 0.15
+
+# 計測の設定
+# True にすると、処理段階ごとの時間と輪郭数・失敗件数などを集計する (全ワーカー分を合算)
+METRICS_ENABLED = False
+# 集計結果の保存先 (OUTPUT_DIR からの相対パス。拡張子が .prom なら Prometheus 形式、それ以外は JSON)
+METRICS_FILE = "metrics.json"
+
 # --- 設定項目ここまで ---
 
 
-def create_and_apply_donut_masks(image_path, output_base_dir, resize_width):
+@dataclass
+class DonutDetection:
     """
-    一枚の画像に対してドーナツ型の内側と外側をマスクする処理を行います。
+    detect_donut の処理結果。
+
+    status は "ok" (ドーナツ検出成功), "no_contours" (輪郭なし),
+    "no_donut" (ドーナツ形状の輪郭ペアなし) のいずれかです。
+    検出に失敗した場合、輪郭・マスク・面積は None になります。
     """
-    try:
-        # 1. 画像の読み込み
-        img = cv2.imread(image_path)
-        if img is None:
-            print(f"画像の読み込みに失敗しました: {image_path}")
+
+    status: str
+    resized_img: np.ndarray
+    thresh_cleaned: np.ndarray
+    contours: tuple
+    outer_contour: np.ndarray | None = None
+    inner_contour: np.ndarray | None = None
+    mask_inner: np.ndarray | None = None
+    mask_outer: np.ndarray | None = None
+    mask_donut_body: np.ndarray | None = None
+    label: np.ndarray | None = None  # bbox 内のラベル画像 (外側=0 / 本体=1 / 穴=2)
+    bbox: tuple | None = None  # 外側輪郭の外接矩形 (x, y, w, h)
+    roi: tuple | None = (
+        None  # 二値化・輪郭抽出を行った注目領域 (x, y, w, h)。None は画像全体
+    )
+    area_outer: float | None = None
+    area_inner: float | None = None
+    elapsed: float = 0.0  # detect_donut の処理時間 (秒)
+
+
+def resize_image(img, resize_width):
+    """
+    アスペクト比を維持したまま、画像を指定した幅にリサイズします。
+    """
+    original_height, original_width = img.shape[:2]
+    aspect_ratio = original_height / original_width
+    resized_height = int(resize_width * aspect_ratio)
+    return cv2.resize(img, (resize_width, resized_height), interpolation=cv2.INTER_AREA)
+
+
+# モルフォロジー演算のカーネル (必要に応じて調整)
+MORPH_KERNEL = np.ones((5, 5), np.uint8)
+
+
+class Preprocessor:
+    """
+    グレースケール化・平滑化・二値化・モルフォロジー演算を行い、
+    輪郭抽出用の二値画像を返す前処理器です。
+
+    各ステップの出力先の配列を画像サイズごとに確保して使い回すため、
+    同じサイズの画像が続く限り、2枚目以降は新しい配列を確保しません。
+    戻り値の二値画像は内部の配列そのものなので、次の呼び出しで上書きされます。
+    保持したい場合はコピーしてください。スレッド間で共有しないでください。
+    """
+
+    def __init__(self):
+        self._shape = None
+
+    def _ensure_buffers(self, shape):
+        if self._shape == shape:
             return
+        self.gray = np.empty(shape, np.uint8)
+        self.blurred = np.empty(shape, np.uint8)
+        self.thresh = np.empty(shape, np.uint8)
+        self.opened = np.empty(shape, np.uint8)
+        self.closed = np.empty(shape, np.uint8)
+        self._shape = shape
 
-        # 1a. リサイズ
-        original_height, original_width = img.shape[:2]
-        aspect_ratio = original_height / original_width
-        resized_height = int(resize_width * aspect_ratio)
-        resized_img = cv2.resize(
-            img, (resize_width, resized_height), interpolation=cv2.INTER_AREA
-        )
-        h, w = resized_img.shape[:2]
+    def __call__(self, resized_img):
+        self._ensure_buffers(resized_img.shape[:2])
 
-        # 2. 前処理
-        gray = cv2.cvtColor(resized_img, cv2.COLOR_BGR2GRAY)
-        # ガウシアンブラーで平滑化 (カーネルサイズは画像のノイズに応じて調整)
-        blurred = cv2.GaussianBlur(gray, (7, 7), 0)
+        with METRICS.time("blur"):
+            cv2.cvtColor(resized_img, cv2.COLOR_BGR2GRAY, dst=self.gray)
+            # ガウシアンブラーで平滑化 (カーネルサイズは画像のノイズに応じて調整)
+            cv2.GaussianBlur(self.gray, BLUR_KSIZE, 0, dst=self.blurred)
 
-        # 3. 二値化
         # 適応的閾値処理 (blockSizeとCの値は画像の特性に合わせて調整してください)
         # THRESH_BINARY_INV: 物体を白、背景を黒にする
-        thresh = cv2.adaptiveThreshold(
-            blurred,
-            255,
-            cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-            cv2.THRESH_BINARY_INV,
-            blockSize=15,
-            C=5,
-        )  # blockSizeは奇数
+        with METRICS.time("threshold"):
+            cv2.adaptiveThreshold(
+                self.blurred,
+                255,
+                cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                cv2.THRESH_BINARY_INV,
+                blockSize=THRESH_BLOCK_SIZE,
+                C=THRESH_C,
+                dst=self.thresh,
+            )  # blockSizeは奇数
 
         # モルフォロジー演算でノイズ除去や穴埋め (必要に応じて調整)
-        kernel = np.ones((5, 5), np.uint8)
-        thresh_cleaned = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel, iterations=1)
-        thresh_cleaned = cv2.morphologyEx(
-            thresh_cleaned, cv2.MORPH_CLOSE, kernel, iterations=2
-        )
+        with METRICS.time("morphology"):
+            cv2.morphologyEx(
+                self.thresh,
+                cv2.MORPH_OPEN,
+                MORPH_KERNEL,
+                dst=self.opened,
+                iterations=OPEN_ITERATIONS,
+            )
+            cv2.morphologyEx(
+                self.opened,
+                cv2.MORPH_CLOSE,
+                MORPH_KERNEL,
+                dst=self.closed,
+                iterations=CLOSE_ITERATIONS,
+            )
+        return self.closed
+
+
+def preprocess(resized_img):
+    """
+    Preprocessor と同じ前処理を行い、新しく確保した二値画像を返します。
+    """
+    return Preprocessor()(resized_img)
+
+
+def saliency_roi(saliency, shape, threshold=ROI_SALIENCY_THRESHOLD, margin=ROI_MARGIN):
+    """
+    顕著性マップ (Grad-CAM のヒートマップなど、任意の解像度の2次元配列) から、
+    shape の画像上の注目領域 (x, y, w, h) を求めます。
+    マップの最大値の threshold 倍以上の範囲の外接矩形に、margin の割合の余白を加えます。
+    該当する範囲がない場合は None を返します。
+    """
+    h, w = shape[:2]
+    saliency = np.asarray(saliency, dtype=np.float32)
+    if saliency.ndim != 2 or saliency.size == 0:
+        return None
+    peak = float(saliency.max())
+    if not peak > 0:
+        return None
+
+    # 閾値処理はマップの解像度のまま行い、外接矩形だけを画像の座標に拡大する
+    sx, sy, sw, sh = cv2.boundingRect((saliency >= peak * threshold).astype(np.uint8))
+    scale_x = w / saliency.shape[1]
+    scale_y = h / saliency.shape[0]
+    pad_x = sw * scale_x * margin
+    pad_y = sh * scale_y * margin
+    x0 = max(0, int(np.floor(sx * scale_x - pad_x)))
+    y0 = max(0, int(np.floor(sy * scale_y - pad_y)))
+    x1 = min(w, int(np.ceil((sx + sw) * scale_x + pad_x)))
+    y1 = min(h, int(np.ceil((sy + sh) * scale_y + pad_y)))
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def saliency_path(image_path, saliency_dir=None):
+    """
+    画像に対応する顕著性マップ (.npy) のパスを返します。存在しない場合は None です。
+    saliency_dir を省略した場合は、呼び出し時点の SALIENCY_DIR を使います。
+    """
+    if saliency_dir is None:
+        saliency_dir = SALIENCY_DIR
+    if saliency_dir is None:
+        return None
+    base_filename = os.path.splitext(os.path.basename(image_path))[0]
+    path = os.path.join(saliency_dir, base_filename + ".npy")
+    return path if os.path.exists(path) else None
+
+
+def load_saliency(image_path, saliency_dir=None):
+    """
+    画像に対応する顕著性マップを読み込みます。存在しない・読めない場合は None です。
+    saliency_dir を省略した場合は、呼び出し時点の SALIENCY_DIR を使います。
+    """
+    path = saliency_path(image_path, saliency_dir)
+    if path is None:
+        return None
+    try:
+        return np.load(path)
+    except (OSError, ValueError):
+        return None
+
+
+def find_donut_pair(contours, hierarchy, image_area):
+    """
+    輪郭の階層構造からドーナツの輪郭ペアを探し、最大のものを返します。
+    見つからない場合は None を返します。
+    戻り値: (外側輪郭, 内側輪郭, 外側面積, 内側面積)
+    """
+    # hierarchy[0][i] = [Next, Previous, First_Child, Parent]
+    hier = hierarchy[0]
+    first_child = hier[:, 2]
+    parent = hier[:, 3]
+
+    # 外側の輪郭である候補 (親がいない or 親も外側の輪郭) かつ、子を持つ (つまり穴がある)
+    # 親がいない (-1) 場合の参照先はダミーとして 0 にしておく
+    grandparent = np.where(parent != -1, parent[np.maximum(parent, 0)], -1)
+    is_outer = (first_child != -1) & ((parent == -1) | (grandparent == -1))
+    # その最初の子を内側輪郭候補とし、さらに子を持たないことを確認（単純な穴の場合）
+    outer_idx = np.flatnonzero(is_outer)
+    inner_idx = first_child[outer_idx]
+    simple_hole = first_child[inner_idx] == -1
+    outer_idx = outer_idx[simple_hole]
+    inner_idx = inner_idx[simple_hole]
+    METRICS.observe("candidate_pairs", outer_idx.size)
+    if outer_idx.size == 0:
+        return None
+
+    # 面積は候補ごとに一度だけ計算する
+    area_outer = np.array([cv2.contourArea(contours[i]) for i in outer_idx])
+    area_inner = np.array([cv2.contourArea(contours[i]) for i in inner_idx])
+
+    # 面積である程度フィルタリング（外側が内側より大きく、内側もある程度の面積を持つ）
+    # この閾値 (MIN_HOLE_AREA_RATIO) は画像の内容によって調整が必要
+    valid = (area_outer > area_inner) & (area_inner > image_area * MIN_HOLE_AREA_RATIO)
+    if not valid.any():
+        return None
+
+    # 複数のドーナツが見つかった場合、最大の面積を持つものを選択
+    # (同じ面積なら輪郭の並び順で先のもの)
+    best = np.flatnonzero(valid)[np.argmax(area_outer[valid])]
+    return (
+        contours[outer_idx[best]],
+        contours[inner_idx[best]],
+        float(area_outer[best]),
+        float(area_inner[best]),
+    )
+
+
+def rasterize_labels(outer_contour, inner_contour):
+    """
+    外側輪郭の外接矩形の範囲だけに 外側=0 / 本体=1 / 穴=2 のラベル画像を描画します。
+    戻り値: (ラベル画像, 外接矩形 (x, y, w, h))
+    """
+    x, y, bw, bh = cv2.boundingRect(outer_contour)
+    label = np.zeros((bh, bw), dtype=np.uint8)
+    offset = (-x, -y)
+    cv2.drawContours(
+        label, [outer_contour], -1, LABEL_BODY, thickness=cv2.FILLED, offset=offset
+    )
+    cv2.drawContours(
+        label, [inner_contour], -1, LABEL_INNER, thickness=cv2.FILLED, offset=offset
+    )
+    return label, (x, y, bw, bh)
+
+
+def masks_from_labels(shape, label, bbox):
+    """
+    rasterize_labels のラベル画像から 内側・外側・ドーナツ本体 の3つのマスクを作成します。
+    外接矩形の外側は値が決まっているため、矩形内だけを書き込みます。
+    """
+    h, w = shape[:2]
+    x, y, bw, bh = bbox
+    roi = (slice(y, y + bh), slice(x, x + bw))
+
+    # 内側マスク (ドーナツの穴の部分)
+    mask_inner = np.zeros((h, w), dtype=np.uint8)
+    mask_inner[roi] = cv2.compare(label, LABEL_INNER, cv2.CMP_EQ)
+
+    # 外側マスク (画像全体 - ドーナツの外側の輪郭の内側)
+    mask_outer = np.full((h, w), 255, dtype=np.uint8)
+    mask_outer[roi] = cv2.compare(label, LABEL_OUTER, cv2.CMP_EQ)
+
+    # ドーナツ本体のマスク (外側輪郭の内側 - 内側輪郭の内側)
+    mask_donut_body = np.zeros((h, w), dtype=np.uint8)
+    mask_donut_body[roi] = cv2.compare(label, LABEL_BODY, cv2.CMP_EQ)
+
+    return mask_inner, mask_outer, mask_donut_body
+
+
+def create_masks(shape, outer_contour, inner_contour):
+    """
+    選択された輪郭ペアから 内側・外側・ドーナツ本体 の3つのマスクを作成します。
+    """
+    label, bbox = rasterize_labels(outer_contour, inner_contour)
+    return masks_from_labels(shape, label, bbox)
+
+
+def apply_mask(img, mask, color=MASK_COLOR):
+    """
+    mask が 255 の領域を指定色で塗りつぶした画像のコピーを返します。
+    """
+    masked = img.copy()
+    masked[mask == 255] = color
+    return masked
+
+
+def compose_masked_image(img, label, bbox, kind, color=MASK_COLOR, out=None):
+    """
+    ラベル画像を使ってマスク適用画像を作成します。
+    kind は "masked_inner_area" / "masked_outer_area" / "donut_only" のいずれかです。
+
+    out に img と同じ形の配列を渡すとそこに書き込みます (使い回しによる確保の削減用)。
+    外接矩形の外側は 元画像のまま か 塗りつぶし色 のどちらかに決まるため、
+    マスクを参照するのは矩形内だけです。
+    """
+    if out is None:
+        out = np.empty_like(img)
+    x, y, bw, bh = bbox
+    roi = (slice(y, y + bh), slice(x, x + bw))
+
+    if kind == "masked_inner_area":
+        # ドーナツの穴だけを塗りつぶす
+        np.copyto(out, img)
+        out[roi][label == LABEL_INNER] = color
+    elif kind == "masked_outer_area":
+        # 外側輪郭の内側だけ元画像を残す
+        out[...] = color
+        np.copyto(out[roi], img[roi], where=(label != LABEL_OUTER)[..., None])
+    elif kind == "donut_only":
+        # ドーナツ本体だけ元画像を残す
+        out[...] = color
+        np.copyto(out[roi], img[roi], where=(label == LABEL_BODY)[..., None])
+    else:
+        raise ValueError(f"不明なマスク適用画像の種類です: {kind}")
+    return out
+
+
+def detect_donut(img, resize_width=RESIZE_WIDTH, preprocessor=None, saliency=None):
+    """
+    デコード済みの画像 (BGR の ndarray) からドーナツの輪郭とマスクを求めます。
+    ファイルの読み書きは行わず、結果を DonutDetection として返します。
+    preprocessor に Preprocessor を渡すと前処理の配列を使い回します
+    (その場合、結果の thresh_cleaned は次の呼び出しで上書きされます)。
+
+    saliency に顕著性マップを渡すと、その注目領域 (saliency_roi) だけを二値化・輪郭抽出します。
+    処理する画素が減り、注目領域の外のノイズの輪郭も最初から除外されます。
+    輪郭・マスクは画像全体の座標のままですが、thresh_cleaned は注目領域の部分だけになります。
+    """
+    start = time.perf_counter()
+
+    # 1. リサイズ
+    with METRICS.time("resize"):
+        resized_img = resize_image(img, resize_width)
+
+    # 2-3. 前処理・二値化 (顕著性マップがあれば注目領域だけ)
+    roi = None
+    target = resized_img
+    if saliency is not None:
+        roi = saliency_roi(saliency, resized_img.shape)
+        if roi is not None:
+            x, y, w, h = roi
+            target = resized_img[y : y + h, x : x + w]
+    if preprocessor is None:
+        thresh_cleaned = preprocess(target)
+    else:
+        thresh_cleaned = preprocessor(target)
+
+    # 4-5. 輪郭抽出・マスク作成
+    detection = find_donut(resized_img, thresh_cleaned, roi)
+    detection.elapsed = time.perf_counter() - start
+    return detection
+
+
+def find_donut(resized_img, thresh_cleaned, roi=None):
+    """
+    前処理済みの二値画像から輪郭を抽出し、ドーナツの輪郭ペアとマスクを求めます。
+    roi (x, y, w, h) を指定した場合、thresh_cleaned はその領域の部分の二値画像です。
+    """
+    start = time.perf_counter()
+    h, w = resized_img.shape[:2]
+    offset = (0, 0) if roi is None else (roi[0], roi[1])
 
-        # 4. 輪郭抽出
-        # cv2.RETR_CCOMP: 全ての輪郭を抽出し、2レベルの階層構造を構成（外側輪郭と内側輪郭のペアを見つけやすい）
+    # cv2.RETR_CCOMP: 全ての輪郭を抽出し、2レベルの階層構造を構成（外側輪郭と内側輪郭のペアを見つけやすい）
+    # 注目領域の二値画像の場合は、offset で画像全体の座標に戻す
+    with METRICS.time("find_contours"):
         contours, hierarchy = cv2.findContours(
-            thresh_cleaned, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE
+            thresh_cleaned, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE, offset=offset
         )
+    METRICS.observe("contours", len(contours))
 
-        if hierarchy is None or len(hierarchy) == 0:
-            print(f"輪郭が見つかりませんでした: {image_path}")
-            # デバッグ用に二値化画像を保存
-            debug_thresh_path = os.path.join(output_base_dir, "debug_thresh")
-            os.makedirs(debug_thresh_path, exist_ok=True)
-            cv2.imwrite(
-                os.path.join(
-                    debug_thresh_path,
-                    f"{os.path.splitext(os.path.basename(image_path))[0]}_thresh.png",
-                ),
-                thresh_cleaned,
-            )
-            return
-
-        # ドーナツの輪郭ペア (外側輪郭, 内側輪郭) を探す
-        donut_contours_pairs = []
-        # hierarchy[0][i] = [Next, Previous, First_Child, Parent]
-        for i in range(len(contours)):
-            # i 番目の輪郭が外側の輪郭である候補 (親がいない or 親も外側の輪郭)
-            # かつ、子を持つ (つまり穴がある)
-            if hierarchy[0][i][2] != -1 and (
-                hierarchy[0][i][3] == -1 or hierarchy[0][hierarchy[0][i][3]][3] == -1
-            ):
-                outer_contour_candidate = contours[i]
-                # その最初の子を内側輪郭候補とする
-                inner_contour_idx = hierarchy[0][i][2]
-                inner_contour_candidate = contours[inner_contour_idx]
-
-                # 内側の輪郭候補がさらに子を持たないことを確認（単純な穴の場合）
-                if hierarchy[0][inner_contour_idx][2] == -1:
-                    area_outer = cv2.contourArea(outer_contour_candidate)
-                    area_inner = cv2.contourArea(inner_contour_candidate)
-                    # 面積である程度フィルタリング（外側が内側より大きく、内側もある程度の面積を持つ）
-                    # この閾値は画像の内容によって調整が必要
-                    if area_outer > area_inner and area_inner > (
-                        w * h * 0.001
-                    ):  # 内側の穴が画像の0.1%以上など
-                        donut_contours_pairs.append(
-                            (outer_contour_candidate, inner_contour_candidate)
-                        )
-
-        if not donut_contours_pairs:
-            print(f"ドーナツ形状の輪郭ペアが見つかりませんでした: {image_path}")
-            # デバッグ用に輪郭描画画像を保存
-            debug_contour_path = os.path.join(output_base_dir, "debug_contours")
-            os.makedirs(debug_contour_path, exist_ok=True)
-            img_with_contours = resized_img.copy()
-            cv2.drawContours(img_with_contours, contours, -1, (0, 255, 0), 2)
-            cv2.imwrite(
-                os.path.join(
-                    debug_contour_path,
-                    f"{os.path.splitext(os.path.basename(image_path))[0]}_contours.png",
-                ),
-                img_with_contours,
-            )
-            return
+    if hierarchy is None or len(hierarchy) == 0:
+        return DonutDetection(
+            status="no_contours",
+            resized_img=resized_img,
+            thresh_cleaned=thresh_cleaned,
+            contours=contours,
+            roi=roi,
+            elapsed=time.perf_counter() - start,
+        )
 
-        # 複数のドーナツが見つかった場合、最大の面積を持つものを選択
-        donut_contours_pairs.sort(
-            key=lambda pair: cv2.contourArea(pair[0]), reverse=True
+    # ドーナツの輪郭ペア (外側輪郭, 内側輪郭) を探す
+    with METRICS.time("pair_selection"):
+        pair = find_donut_pair(contours, hierarchy, w * h)
+    if pair is None:
+        return DonutDetection(
+            status="no_donut",
+            resized_img=resized_img,
+            thresh_cleaned=thresh_cleaned,
+            contours=contours,
+            roi=roi,
+            elapsed=time.perf_counter() - start,
         )
-        selected_outer_contour, selected_inner_contour = donut_contours_pairs[0]
+    outer_contour, inner_contour, area_outer, area_inner = pair
 
-        # 5. マスク作成
-        # 内側マスク (ドーナツの穴の部分)
-        mask_inner = np.zeros((h, w), dtype=np.uint8)
-        cv2.drawContours(
-            mask_inner, [selected_inner_contour], -1, 255, thickness=cv2.FILLED
+    # マスク作成 (外側輪郭の外接矩形内だけを描画し、3つのマスクを1枚のラベル画像から作る)
+    with METRICS.time("mask_draw"):
+        label, bbox = rasterize_labels(outer_contour, inner_contour)
+        mask_inner, mask_outer, mask_donut_body = masks_from_labels(
+            resized_img.shape, label, bbox
         )
 
-        # 外側マスク (画像全体 - ドーナツの外側の輪郭の内側)
-        mask_outer = np.full((h, w), 255, dtype=np.uint8)  # 画像全体を白(255)で初期化
-        cv2.drawContours(
-            mask_outer, [selected_outer_contour], -1, 0, thickness=cv2.FILLED
-        )  # 外側輪郭の内側を黒(0)で塗りつぶす
+    return DonutDetection(
+        status="ok",
+        resized_img=resized_img,
+        thresh_cleaned=thresh_cleaned,
+        contours=contours,
+        outer_contour=outer_contour,
+        inner_contour=inner_contour,
+        mask_inner=mask_inner,
+        mask_outer=mask_outer,
+        mask_donut_body=mask_donut_body,
+        label=label,
+        bbox=bbox,
+        area_outer=area_outer,
+        area_inner=area_inner,
+        roi=roi,
+        elapsed=time.perf_counter() - start,
+    )
+
 
-        # ドーナツ本体のマスク (外側輪郭の内側 - 内側輪郭の内側)
-        mask_donut_body = np.zeros((h, w), dtype=np.uint8)
-        cv2.drawContours(
-            mask_donut_body, [selected_outer_contour], -1, 255, thickness=cv2.FILLED
+def save_detection(detection, base_filename, output_base_dir, write=None, ext=None):
+    """
+    detect_donut の結果を従来と同じディレクトリ構成で保存します。
+    write には (パス, 画像) を受け取る保存関数を指定できます (省略時は cv2.imwrite)。
+    ext を省略した場合は、呼び出し時点の OUTPUT_EXT を使います。
+    """
+    if ext is None:
+        ext = OUTPUT_EXT
+    if write is None:
+        params = imwrite_params(ext, PNG_COMPRESSION)
+
+        def write(path, img):
+            cv2.imwrite(path, img, params)
+
+    if detection.status == "no_contours":
+        # デバッグ用に二値化画像を保存
+        debug_thresh_path = os.path.join(output_base_dir, "debug_thresh")
+        os.makedirs(debug_thresh_path, exist_ok=True)
+        write(
+            os.path.join(debug_thresh_path, f"{base_filename}_thresh{ext}"),
+            # 前処理の配列は使い回される場合があるため、非同期保存用にコピーする
+            detection.thresh_cleaned.copy(),
         )
-        cv2.drawContours(
-            mask_donut_body, [selected_inner_contour], -1, 0, thickness=cv2.FILLED
+        return
+
+    if detection.status == "no_donut":
+        # デバッグ用に輪郭描画画像を保存
+        debug_contour_path = os.path.join(output_base_dir, "debug_contours")
+        os.makedirs(debug_contour_path, exist_ok=True)
+        img_with_contours = detection.resized_img.copy()
+        cv2.drawContours(img_with_contours, detection.contours, -1, (0, 255, 0), 2)
+        write(
+            os.path.join(debug_contour_path, f"{base_filename}_contours{ext}"),
+            img_with_contours,
         )
+        return
 
-        # 6. 結果の保存
-        base_filename = os.path.splitext(os.path.basename(image_path))[0]
+    resized_img = detection.resized_img
+    mask_inner = detection.mask_inner
+    mask_outer = detection.mask_outer
 
-        # モノクロマスク画像の保存先ディレクトリ
-        output_mono_masks_dir = os.path.join(output_base_dir, "monochrome_masks")
-        os.makedirs(output_mono_masks_dir, exist_ok=True)
-        cv2.imwrite(
-            os.path.join(
-                output_mono_masks_dir, f"{base_filename}_mask_inner_monochrome.png"
-            ),
-            mask_inner,
-        )
-        cv2.imwrite(
-            os.path.join(
-                output_mono_masks_dir, f"{base_filename}_mask_outer_monochrome.png"
-            ),
-            mask_outer,
+    # モノクロマスク画像の保存先ディレクトリ
+    output_mono_masks_dir = os.path.join(output_base_dir, "monochrome_masks")
+    os.makedirs(output_mono_masks_dir, exist_ok=True)
+    write(
+        os.path.join(
+            output_mono_masks_dir, f"{base_filename}_mask_inner_monochrome{ext}"
+        ),
+        mask_inner,
+    )
+    write(
+        os.path.join(
+            output_mono_masks_dir, f"{base_filename}_mask_outer_monochrome{ext}"
+        ),
+        mask_outer,
+    )
+    write(
+        os.path.join(
+            output_mono_masks_dir, f"{base_filename}_mask_donut_body_monochrome{ext}"
+        ),
+        detection.mask_donut_body,
+    )
+
+    # マスク適用画像の保存先ディレクトリ
+    output_masked_images_dir = os.path.join(output_base_dir, "masked_images")
+    os.makedirs(output_masked_images_dir, exist_ok=True)
+
+    # 保存は非同期に行われることがあるため、マスク適用画像は毎回新しい配列に作成する
+    # (np.empty で確保するため、ゼロ埋めやコピーの余分な書き込みは発生しない)
+    for kind in ("masked_inner_area", "masked_outer_area", "donut_only"):
+        write(
+            os.path.join(output_masked_images_dir, f"{base_filename}_{kind}{ext}"),
+            compose_masked_image(resized_img, detection.label, detection.bbox, kind),
         )
-        cv2.imwrite(
-            os.path.join(
-                output_mono_masks_dir, f"{base_filename}_mask_donut_body_monochrome.png"
-            ),
-            mask_donut_body,
+
+
+def _detect_and_save(
+    image_path,
+    img,
+    output_base_dir,
+    resize_width,
+    write=None,
+    output_mode="png",
+    preprocessor=None,
+    stage=None,
+    stage_key=None,
+    stage_store=None,
+    saliency=None,
+):
+    """
+    読み込み済みの画像を処理して保存し、(結果のメッセージ, シャード用レコード, 状態) を返します。
+    output_mode が "shard" の場合、検出に成功した画像は PNG を書かずにレコードだけを返します
+    (失敗時のデバッグ画像は従来通り保存します)。"png" の場合のレコードは None です。
+    状態は DonutDetection.status で、読み込みエラーや例外の場合は None です。
+
+    stage にキャッシュ済みの途中段階 (resized_img, thresh_cleaned) を渡すと、
+    読み込み・リサイズ・前処理を省略します。stage_store と stage_key を渡すと、
+    新たに計算した途中段階をキャッシュに保存します。
+    saliency には detect_donut に渡す顕著性マップを指定できます。
+    """
+    try:
+        if stage is not None:
+            start = time.perf_counter()
+            roi = tuple(int(v) for v in stage["roi"]) if "roi" in stage else None
+            detection = find_donut(stage["resized_img"], stage["thresh_cleaned"], roi)
+            detection.elapsed = time.perf_counter() - start
+        else:
+            if img is None:
+                METRICS.count("images_total", status="read_error")
+                return f"画像の読み込みに失敗しました: {image_path}", None, None
+            detection = detect_donut(img, resize_width, preprocessor, saliency)
+            if stage_store is not None and stage_key is not None:
+                arrays = {
+                    "resized_img": detection.resized_img,
+                    "thresh_cleaned": detection.thresh_cleaned,
+                }
+                if detection.roi is not None:
+                    arrays["roi"] = np.array(detection.roi)
+                with METRICS.time("cache_save"):
+                    stage_store.save(stage_key, **arrays)
+
+        base_filename = os.path.splitext(os.path.basename(image_path))[0]
+        record = None
+        if output_mode == "shard":
+            record = make_record(base_filename, detection, STORE_LABEL_MASK)
+        if output_mode != "shard" or detection.status != "ok":
+            # 非同期保存の場合は、書き込み待ちの列が空くまで待った時間も含む
+            with METRICS.time("save"):
+                save_detection(detection, base_filename, output_base_dir, write=write)
+        METRICS.count("images_total", status=detection.status)
+
+        if detection.status == "no_contours":
+            message = f"輪郭が見つかりませんでした: {image_path}"
+        elif detection.status == "no_donut":
+            message = f"ドーナツ形状の輪郭ペアが見つかりませんでした: {image_path}"
+        else:
+            message = f"処理完了: {image_path}"
+        return message, record, detection.status
+
+    except Exception as e:
+        METRICS.count("images_total", status="error")
+        return f"エラー発生 ({image_path}): {e}", None, None
+
+
+def create_and_apply_donut_masks(image_path, output_base_dir, resize_width):
+    """
+    一枚の画像に対してドーナツ型の内側と外側をマスクする処理を行います。
+    画像を読み込んで detect_donut を呼び出し、結果を保存する薄いラッパーです。
+    処理結果のメッセージを返します (表示は呼び出し側で行います)。
+    """
+    img = imread_for_width(image_path, resize_width if REDUCED_DECODE else None)
+    message, _, _ = _detect_and_save(
+        image_path,
+        img,
+        output_base_dir,
+        resize_width,
+        saliency=load_saliency(image_path),
+    )
+    return message
+
+
+def upstream_params(resize_width):
+    """
+    途中段階 (リサイズ後の画像と前処理済みの二値画像) の結果を左右するパラメータです。
+    """
+    return {
+        "resize_width": resize_width,
+        "reduced_decode": REDUCED_DECODE,
+        "blur_ksize": BLUR_KSIZE,
+        "thresh_block_size": THRESH_BLOCK_SIZE,
+        "thresh_c": THRESH_C,
+        "morph_kernel": MORPH_KERNEL.tolist(),
+        "open_iterations": OPEN_ITERATIONS,
+        "close_iterations": CLOSE_ITERATIONS,
+        "saliency_dir": SALIENCY_DIR,
+        "roi_saliency_threshold": ROI_SALIENCY_THRESHOLD,
+        "roi_margin": ROI_MARGIN,
+    }
+
+
+def downstream_params(output_mode):
+    """
+    途中段階より後 (輪郭ペアの選択・マスク作成・保存) の結果を左右するパラメータです。
+    これらだけを変えた場合、キャッシュ済みの途中段階から処理を再開できます。
+    """
+    return {
+        "min_hole_area_ratio": MIN_HOLE_AREA_RATIO,
+        "mask_color": MASK_COLOR,
+        "output_mode": output_mode,
+        "output_ext": OUTPUT_EXT,
+        "png_compression": PNG_COMPRESSION,
+        "store_label_mask": STORE_LABEL_MASK,
+    }
+
+
+def _iter_results(jobs, output_base_dir, resize_width, output_mode, cache_dir=None):
+    """
+    画像の読み込み・保存をバックグラウンドで行いながら複数の画像を処理し、
+    (メッセージ, レコード, 状態) を入力順に返すジェネレータです。
+    読み込みは READ_AHEAD 枚先まで先読みし、保存は WRITE_BACKLOG 枚まで溜めて
+    非同期に行うため、計算がディスクの待ち時間で止まりにくくなります。
+    各画像の結果はその画像の保存が終わってから返し、保存に失敗した画像は
+    状態を None にします (ジョブ1件につき結果は必ず1件です)。
+
+    jobs は (画像パス, 途中段階のキャッシュキー) のリストです。
+    cache_dir を指定すると、キャッシュ済みの途中段階は画像の代わりにそちらを読み込みます。
+    """
+    stage_store = StageStore(cache_dir) if cache_dir is not None else None
+    target_width = resize_width if REDUCED_DECODE else None
+
+    def load(job):
+        image_path, stage_key = job
+        if stage_store is not None and stage_key is not None:
+            with METRICS.time("cache_load"):
+                stage = stage_store.load(stage_key)
+            if stage is not None:
+                METRICS.count("cache_total", result="stage_hit")
+                return None, stage, None
+        with METRICS.time("decode"):
+            img = imread_for_width(image_path, target_width)
+        return img, None, load_saliency(image_path)
+
+    writer = AsyncImageWriter(
+        num_threads=IO_THREADS,
+        max_pending=WRITE_BACKLOG,
+        params=imwrite_params(OUTPUT_EXT, PNG_COMPRESSION),
+    )
+    # 前処理の配列はこのジェネレータ (= ワーカー) の中で使い回す
+    preprocessor = Preprocessor()
+    # 保存が終わっていない画像の (画像パス, 結果, 保存の Future のリスト)。
+    # 結果は保存の成否が確定してから入力順に返す
+    pending = deque()
+
+    def finish(image_path, result, futures):
+        failed = [future for future in futures if not future.result()]
+        if not failed:
+            return result
+        # 保存に失敗した画像は状態を None にして、処理済みとして記録させない
+        return f"保存に失敗しました ({len(failed)} 件): {image_path}", None, None
+
+    try:
+        for (image_path, stage_key), (img, stage, saliency) in read_ahead(
+            jobs, num_threads=IO_THREADS, prefetch=READ_AHEAD, loader=load
+        ):
+            futures = []
+            result = _detect_and_save(
+                image_path,
+                img,
+                output_base_dir,
+                resize_width,
+                write=lambda path, image, futures=futures: futures.append(
+                    writer.write(path, image)
+                ),
+                output_mode=output_mode,
+                preprocessor=preprocessor,
+                stage=stage,
+                stage_key=stage_key,
+                stage_store=stage_store,
+                saliency=saliency,
+            )
+            pending.append((image_path, result, futures))
+            # 保存が終わった画像と、WRITE_BACKLOG 枚より古い画像の結果を返す
+            while pending and (
+                len(pending) > WRITE_BACKLOG
+                or all(future.done() for future in pending[0][2])
+            ):
+                yield finish(*pending.popleft())
+        while pending:
+            yield finish(*pending.popleft())
+    finally:
+        writer.close()
+
+
+def _process_chunk(jobs, output_base_dir, resize_width, output_mode, cache_dir):
+    """
+    ワーカープロセスで画像のまとまりを処理し、
+    ((メッセージ, レコード, 状態) のリスト, このチャンクの計測結果) を返します。
+    """
+    results = list(
+        _iter_results(jobs, output_base_dir, resize_width, output_mode, cache_dir)
+    )
+    # 計測結果は親プロセスで合算するため、チャンクごとに取り出してリセットする
+    return results, METRICS.collect() if METRICS.enabled else None
+
+
+def _init_worker(cv2_threads, metrics_enabled=False):
+    """
+    ワーカープロセスの初期化。OpenCV 内部のスレッド数を制限し、計測の有効/無効を揃えます。
+    """
+    cv2.setNumThreads(cv2_threads)
+    # fork で親プロセスの集計結果が複製されるため、合算で二重に数えないよう空にする
+    METRICS.reset()
+    METRICS.enabled = metrics_enabled
+
+
+def process_images(
+    image_files,
+    output_base_dir,
+    resize_width,
+    num_workers=None,
+    chunk_size=None,
+    cv2_threads=None,
+    output_mode=None,
+    use_cache=None,
+):
+    """
+    複数の画像を処理し、各画像の結果メッセージを入力と同じ順序で返すジェネレータです。
+    num_workers が 2 以上の場合はプロセスプールで並列処理します。
+    output_mode が "shard" の場合、輪郭は output_base_dir/mask_shards 以下の
+    シャードファイルにまとめて保存されます (書き込みは親プロセスのみが行います)。
+
+    use_cache が True の場合、前回と同じ入力・同じパラメータで処理済みの画像は省略し、
+    後段のパラメータだけが変わった画像はキャッシュ済みの途中段階から処理します。
+
+    省略した引数には、呼び出し時点の設定値 (NUM_WORKERS など) を使います。
+    """
+    if num_workers is None:
+        num_workers = NUM_WORKERS
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    if cv2_threads is None:
+        cv2_threads = CV2_THREADS_PER_WORKER
+    if output_mode is None:
+        output_mode = OUTPUT_MODE
+    if use_cache is None:
+        use_cache = USE_CACHE
+    if not use_cache:
+        jobs = [(image_path, None) for image_path in image_files]
+        results = _run_jobs(
+            jobs,
+            output_base_dir,
+            resize_width,
+            num_workers,
+            chunk_size,
+            cv2_threads,
+            output_mode,
+            None,
         )
+        for message, _, _ in _collect(results, output_base_dir, output_mode):
+            yield message
+        return
 
-        # マスク適用画像の保存先ディレクトリ
-        output_masked_images_dir = os.path.join(output_base_dir, "masked_images")
-        os.makedirs(output_masked_images_dir, exist_ok=True)
+    cache_dir = os.path.join(output_base_dir, ".donut_cache")
+    upstream = upstream_params(resize_width)
+    downstream = downstream_params(output_mode)
+    with ResultManifest(os.path.join(cache_dir, "manifest.sqlite")) as manifest:
+        # 入力ごとにキャッシュキーを求め、処理済みのものを除外する
+        entries = []
+        jobs = []
+        for image_path in image_files:
+            try:
+                fingerprint = file_fingerprint(image_path, CACHE_HASH_CONTENT)
+                # 顕著性マップを使う場合は、マップの変更も入力の変更とみなす
+                saliency_file = saliency_path(image_path)
+                if saliency_file is not None:
+                    fingerprint += "|" + file_fingerprint(
+                        saliency_file, CACHE_HASH_CONTENT
+                    )
+            except OSError:
+                # 読めないファイルは通常の処理に回してエラーを報告させる
+                entries.append((image_path, None, False))
+                jobs.append((image_path, None))
+                continue
+            stage_key = make_key(fingerprint, upstream)
+            result_key = make_key(stage_key, downstream)
+            done = manifest.get(result_key) is not None
+            entries.append((image_path, result_key, done))
+            if done:
+                METRICS.count("cache_total", result="skipped")
+            else:
+                jobs.append((image_path, stage_key))
 
-        # 内側をマスクした画像 (ドーナツの穴を指定色で塗りつぶし)
-        img_masked_inner_area = resized_img.copy()
-        img_masked_inner_area[mask_inner == 255] = MASK_COLOR
-        cv2.imwrite(
-            os.path.join(
-                output_masked_images_dir, f"{base_filename}_masked_inner_area.png"
+        results = _collect(
+            _run_jobs(
+                jobs,
+                output_base_dir,
+                resize_width,
+                num_workers,
+                chunk_size,
+                cv2_threads,
+                output_mode,
+                os.path.join(cache_dir, "stages"),
             ),
-            img_masked_inner_area,
+            output_base_dir,
+            output_mode,
         )
+        # 省略した画像と処理した画像のメッセージを入力順に並べて返す
+        for image_path, result_key, done in entries:
+            if done:
+                yield f"変更がないため省略しました: {image_path}"
+                continue
+            message, _, status = next(results)
+            # 検出結果が確定した画像だけを処理済みとして記録する (エラーは次回再試行)
+            if status is not None and result_key is not None:
+                manifest.put(result_key, image_path, message)
+            yield message
+        manifest.commit()
 
-        # 外側をマスクした画像 (ドーナツの外側背景を指定色で塗りつぶし)
-        img_masked_outer_area = resized_img.copy()
-        img_masked_outer_area[mask_outer == 255] = MASK_COLOR
-        cv2.imwrite(
-            os.path.join(
-                output_masked_images_dir, f"{base_filename}_masked_outer_area.png"
-            ),
-            img_masked_outer_area,
+        # 古いキャッシュと容量超過分を削除する
+        max_age_seconds = CACHE_MAX_AGE_DAYS * 24 * 60 * 60
+        StageStore(os.path.join(cache_dir, "stages")).evict(
+            CACHE_MAX_BYTES, max_age_seconds
         )
+        manifest.evict(max_age_seconds)
+
 
-        # ドーナツ本体のみの画像 (内側と外側の両方をマスク)
-        img_donut_only = resized_img.copy()
-        # ドーナツ本体以外の領域を示すマスク (内側マスクと外側マスクのOR)
-        mask_not_donut_body = cv2.bitwise_or(mask_inner, mask_outer)
-        img_donut_only[mask_not_donut_body == 255] = MASK_COLOR
-        # もしくは、ドーナツ本体のマスクを使ってAND演算でも可
-        # img_donut_only = cv2.bitwise_and(resized_img, resized_img, mask=mask_donut_body)
-        # img_donut_only[mask_donut_body == 0] = MASK_COLOR # ドーナツ以外の部分を塗りつぶし
-        cv2.imwrite(
-            os.path.join(output_masked_images_dir, f"{base_filename}_donut_only.png"),
-            img_donut_only,
+def _run_jobs(
+    jobs,
+    output_base_dir,
+    resize_width,
+    num_workers,
+    chunk_size,
+    cv2_threads,
+    output_mode,
+    cache_dir,
+):
+    """
+    jobs を逐次またはプロセスプールで処理し、(メッセージ, レコード, 状態) を入力順に返します。
+    """
+    if num_workers <= 1:
+        yield from _iter_results(
+            jobs, output_base_dir, resize_width, output_mode, cache_dir
         )
+        return
+
+    # チャンク単位でワーカーに渡し、ワーカー内では入出力をパイプライン化する
+    chunk_size = max(1, chunk_size)
+    chunks = [jobs[i : i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+    task = partial(
+        _process_chunk,
+        output_base_dir=output_base_dir,
+        resize_width=resize_width,
+        output_mode=output_mode,
+        cache_dir=cache_dir,
+    )
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        initializer=_init_worker,
+        initargs=(cv2_threads, METRICS.enabled),
+    ) as executor:
+        # executor.map は入力順に結果を返すため、出力順序は決定的になる
+        for chunk, metrics in executor.map(task, chunks):
+            if metrics is not None:
+                METRICS.merge(metrics)
+            yield from chunk
 
-        print(f"処理完了: {image_path}")
 
-    except Exception as e:
-        print(f"エラー発生 ({image_path}): {e}")
+def _collect(results, output_base_dir, output_mode):
+    """
+    (メッセージ, レコード, 状態) の列をそのまま返しつつ、レコードをシャードに書き出します。
+    """
+    if output_mode != "shard":
+        yield from results
+        return
+
+    with MaskShardWriter(
+        os.path.join(output_base_dir, "mask_shards"),
+        shard_size=SHARD_SIZE,
+        store_label_mask=STORE_LABEL_MASK,
+    ) as shard_writer:
+        for result in results:
+            if result[1] is not None:
+                with METRICS.time("shard_write"):
+                    shard_writer.add(result[1])
+            yield result
 
 
 def main():
@@ -233,6 +992,8 @@ def main():
     image_files = []
     for ext in image_extensions:
         image_files.extend(glob.glob(os.path.join(IMAGE_DIR, ext)))
+    # 処理順序と結果の表示順序を実行ごとに揃えるためソートする
+    image_files.sort()
 
     if not image_files:
         print(f"指定されたディレクトリに画像が見つかりません: {IMAGE_DIR}")
@@ -241,22 +1002,48 @@ def main():
         )
         return
 
-    print(f"{len(image_files)} 件の画像を処理します...")
+    # 表示と処理で同じ値を使うよう、設定はここで一度だけ読んで明示的に渡す
+    num_workers = NUM_WORKERS
+    output_mode = OUTPUT_MODE
+    output_ext = OUTPUT_EXT
+    print(
+        f"{len(image_files)} 件の画像を処理します "
+        f"(ワーカー数: {num_workers}, 出力形式: {output_mode})..."
+    )
 
-    for image_file_path in image_files:
-        create_and_apply_donut_masks(image_file_path, OUTPUT_DIR, RESIZE_WIDTH)
+    METRICS.enabled = METRICS_ENABLED
+    for message in process_images(
+        image_files,
+        OUTPUT_DIR,
+        RESIZE_WIDTH,
+        num_workers=num_workers,
+        chunk_size=CHUNK_SIZE,
+        cv2_threads=CV2_THREADS_PER_WORKER,
+        output_mode=output_mode,
+        use_cache=USE_CACHE,
+    ):
+        print(message)
 
     print("-" * 30)
     print("全ての処理が完了しました。")
     print(f"結果は {OUTPUT_DIR} に保存されています。")
+    if METRICS_ENABLED:
+        metrics_path = os.path.join(OUTPUT_DIR, METRICS_FILE)
+        METRICS.dump(metrics_path)
+        print("処理段階ごとの計測結果:")
+        print(METRICS.summary())
+        print(f"計測結果の詳細: {metrics_path}")
+    if output_mode == "shard":
+        print(f"輪郭のシャード: {os.path.join(OUTPUT_DIR, 'mask_shards')}")
+        return
     print(
-        f"内側をマスクした画像: {os.path.join(OUTPUT_DIR, 'masked_images', 'FILENAME_masked_inner_area.png')}"
+        f"内側をマスクした画像: {os.path.join(OUTPUT_DIR, 'masked_images', 'FILENAME_masked_inner_area' + output_ext)}"
     )
     print(
-        f"外側をマスクした画像: {os.path.join(OUTPUT_DIR, 'masked_images', 'FILENAME_masked_outer_area.png')}"
+        f"外側をマスクした画像: {os.path.join(OUTPUT_DIR, 'masked_images', 'FILENAME_masked_outer_area' + output_ext)}"
     )
     print(
-        f"ドーナツ本体のみの画像: {os.path.join(OUTPUT_DIR, 'masked_images', 'FILENAME_donut_only.png')}"
+        f"ドーナツ本体のみの画像: {os.path.join(OUTPUT_DIR, 'masked_images', 'FILENAME_donut_only' + output_ext)}"
     )
     print(f"モノクロマスク画像: {os.path.join(OUTPUT_DIR, 'monochrome_masks')}")
 
@@ -269,6 +1056,7 @@ if __name__ == "__main__":
     #    このフォルダはスクリプト実行時に自動的に作成されます（存在しない場合）。
     #    例: OUTPUT_DIR = '/path/to/your/output_folder'
     # 3. `RESIZE_WIDTH` や `MASK_COLOR` も必要に応じて調整してください。
+    #    `NUM_WORKERS` で並列処理のワーカー数を指定できます (1 で逐次処理)。
     # 4. 画像の特性によっては、`cv2.GaussianBlur`のカーネルサイズ、`cv2.adaptiveThreshold`の`blockSize`や`C`の値、
     #    モルフォロジー演算のカーネルサイズや繰り返し回数の調整が必要になる場合があります。
     #    これらはコメントで `調整してください` と記載のある箇所です。
@@ -0,0 +1,271 @@
+import json
+import os
+
+import cv2
+import numpy as np
+
+# 保存するステータスのコード (DonutDetection.status と対応)
+STATUS_CODES = {"ok": 0, "no_contours": 1, "no_donut": 2}
+STATUS_NAMES = {code: name for name, code in STATUS_CODES.items()}
+
+# ラベル画像の値
+LABEL_OUTER = 0  # ドーナツの外側
+LABEL_BODY = 1  # ドーナツ本体
+LABEL_INNER = 2  # ドーナツの穴
+
+# 再構成できるマスクの種類
+MASK_KINDS = ("inner", "outer", "donut_body")
+# 再構成できるマスク適用画像の種類
+MASKED_IMAGE_KINDS = ("masked_inner_area", "masked_outer_area", "donut_only")
+
+INDEX_FILENAME = "index.jsonl"
+
+
+def encode_rle(label):
+    """
+    ラベル画像を行優先でランレングス符号化し、(値, 長さ) の配列を返します。
+    """
+    flat = label.ravel()
+    if flat.size == 0:
+        return np.empty(0, np.uint8), np.empty(0, np.uint32)
+    change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    starts = np.concatenate(([0], change))
+    lengths = np.diff(np.concatenate((starts, [flat.size])))
+    return flat[starts].astype(np.uint8), lengths.astype(np.uint32)
+
+
+def decode_rle(values, lengths, shape):
+    """
+    encode_rle で符号化したラベル画像を復元します。
+    """
+    return np.repeat(values, lengths).reshape(shape)
+
+
+def label_from_contours(shape, outer_contour, inner_contour):
+    """
+    輪郭ペアから 外側=0 / 本体=1 / 穴=2 のラベル画像を作成します。
+    """
+    label = np.zeros(shape[:2], dtype=np.uint8)
+    cv2.drawContours(label, [outer_contour], -1, LABEL_BODY, thickness=cv2.FILLED)
+    cv2.drawContours(label, [inner_contour], -1, LABEL_INNER, thickness=cv2.FILLED)
+    return label
+
+
+def make_record(name, detection, store_label_mask=False):
+    """
+    DonutDetection から、シャードに保存する最小限の情報を取り出します。
+    画像やマスクそのものは持たないため、プロセス間で受け渡しても軽量です。
+    """
+    h, w = detection.resized_img.shape[:2]
+    record = {
+        "name": name,
+        "status": detection.status,
+        "shape": (h, w),
+        "outer": None,
+        "inner": None,
+        "rle": None,
+    }
+    if detection.status == "ok":
+        record["outer"] = detection.outer_contour.reshape(-1, 2).astype(np.int32)
+        record["inner"] = detection.inner_contour.reshape(-1, 2).astype(np.int32)
+        if store_label_mask:
+            record["rle"] = encode_rle(
+                label_from_contours(
+                    (h, w), detection.outer_contour, detection.inner_contour
+                )
+            )
+    return record
+
+
+def _concat_ragged(arrays, dtype, width=None):
+    """
+    長さの異なる配列を1つに連結し、(データ, 開始位置) を返します。
+    """
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([0 if a is None else len(a) for a in arrays])
+    shape = (int(offsets[-1]),) if width is None else (int(offsets[-1]), width)
+    data = np.empty(shape, dtype=dtype)
+    for a, start, end in zip(arrays, offsets[:-1], offsets[1:]):
+        if a is not None:
+            data[start:end] = a
+    return data, offsets
+
+
+class MaskShardWriter:
+    """
+    画像ごとのドーナツ輪郭 (と任意でラベル画像の RLE) を、
+    shard_size 枚ごとに1つの .npz ファイルにまとめて保存するライタです。
+
+    出力ディレクトリには shard_XXXXX.npz と、画像名からシャードと位置を引くための
+    index.jsonl が作成されます。
+    """
+
+    def __init__(self, output_dir, shard_size=1000, store_label_mask=False):
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.store_label_mask = store_label_mask
+        self._records = []
+        os.makedirs(output_dir, exist_ok=True)
+        self._shard_id = len(
+            [f for f in os.listdir(output_dir) if f.startswith("shard_")]
+        )
+
+    def add(self, record):
+        self._records.append(record)
+        if len(self._records) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        """
+        溜まっているレコードを新しいシャードとして書き出します。
+        """
+        if not self._records:
+            return
+        records = self._records
+        shard_name = f"shard_{self._shard_id:05d}.npz"
+
+        outer, outer_offsets = _concat_ragged(
+            [r["outer"] for r in records], np.int32, 2
+        )
+        inner, inner_offsets = _concat_ragged(
+            [r["inner"] for r in records], np.int32, 2
+        )
+        arrays = {
+            "names": np.array([r["name"] for r in records]),
+            "status": np.array(
+                [STATUS_CODES[r["status"]] for r in records], dtype=np.uint8
+            ),
+            "shapes": np.array([r["shape"] for r in records], dtype=np.int32),
+            "outer": outer,
+            "outer_offsets": outer_offsets,
+            "inner": inner,
+            "inner_offsets": inner_offsets,
+        }
+        if self.store_label_mask:
+            rle = [r["rle"] for r in records]
+            arrays["rle_values"], arrays["rle_offsets"] = _concat_ragged(
+                [None if x is None else x[0] for x in rle], np.uint8
+            )
+            arrays["rle_lengths"], _ = _concat_ragged(
+                [None if x is None else x[1] for x in rle], np.uint32
+            )
+
+        np.savez_compressed(os.path.join(self.output_dir, shard_name), **arrays)
+        with open(
+            os.path.join(self.output_dir, INDEX_FILENAME), "a", encoding="utf-8"
+        ) as f:
+            for position, r in enumerate(records):
+                f.write(
+                    json.dumps(
+                        {
+                            "name": r["name"],
+                            "shard": shard_name,
+                            "position": position,
+                            "status": r["status"],
+                        },
+                        ensure_ascii=False,
+                    )
+                    + "\n"
+                )
+
+        self._shard_id += 1
+        self._records = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class MaskShardReader:
+    """
+    MaskShardWriter で保存したシャードから、マスクやマスク適用画像を再構成します。
+    """
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        self.index = {}
+        with open(os.path.join(shard_dir, INDEX_FILENAME), encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                self.index[entry["name"]] = entry
+        self._cache_name = None
+        self._cache = None
+
+    def names(self):
+        return list(self.index)
+
+    def _shard(self, shard_name):
+        # 同じシャードを続けて読むことが多いため、直前のシャードだけ保持する
+        if self._cache_name != shard_name:
+            with np.load(os.path.join(self.shard_dir, shard_name)) as data:
+                self._cache = {key: data[key] for key in data.files}
+            self._cache_name = shard_name
+        return self._cache
+
+    def load(self, name):
+        """
+        画像名に対応するステータス・画像サイズ・外側/内側輪郭を返します。
+        輪郭は cv2.drawContours にそのまま渡せる (N, 1, 2) の形です。
+        """
+        entry = self.index[name]
+        data = self._shard(entry["shard"])
+        i = entry["position"]
+        status = STATUS_NAMES[int(data["status"][i])]
+        shape = tuple(int(v) for v in data["shapes"][i])
+        if status != "ok":
+            return status, shape, None, None
+        outer = data["outer"][data["outer_offsets"][i] : data["outer_offsets"][i + 1]]
+        inner = data["inner"][data["inner_offsets"][i] : data["inner_offsets"][i + 1]]
+        return status, shape, outer.reshape(-1, 1, 2), inner.reshape(-1, 1, 2)
+
+    def label(self, name):
+        """
+        外側=0 / 本体=1 / 穴=2 のラベル画像を返します。
+        RLE が保存されていればそれを、なければ輪郭から描画して復元します。
+        """
+        status, shape, outer, inner = self.load(name)
+        if status != "ok":
+            raise ValueError(f"ドーナツが検出されていない画像です: {name} ({status})")
+        data = self._shard(self.index[name]["shard"])
+        if "rle_values" in data:
+            i = self.index[name]["position"]
+            start, end = data["rle_offsets"][i], data["rle_offsets"][i + 1]
+            return decode_rle(
+                data["rle_values"][start:end], data["rle_lengths"][start:end], shape
+            )
+        return label_from_contours(shape, outer, inner)
+
+    def mask(self, name, kind):
+        """
+        "inner" / "outer" / "donut_body" のモノクロマスク (0 または 255) を返します。
+        """
+        if kind not in MASK_KINDS:
+            raise ValueError(f"不明なマスクの種類です: {kind}")
+        label = self.label(name)
+        target = {"inner": LABEL_INNER, "outer": LABEL_OUTER, "donut_body": LABEL_BODY}[
+            kind
+        ]
+        return np.where(label == target, 255, 0).astype(np.uint8)
+
+    def masked_image(self, name, kind, resized_img, color=(0, 0, 0)):
+        """
+        "masked_inner_area" / "masked_outer_area" / "donut_only" の
+        マスク適用画像を返します。resized_img にはリサイズ済みの元画像を渡してください。
+        """
+        if kind not in MASKED_IMAGE_KINDS:
+            raise ValueError(f"不明なマスク適用画像の種類です: {kind}")
+        label = self.label(name)
+        if kind == "masked_inner_area":
+            fill = label == LABEL_INNER
+        elif kind == "masked_outer_area":
+            fill = label == LABEL_OUTER
+        else:
+            fill = label != LABEL_BODY
+        masked = resized_img.copy()
+        masked[fill] = color
+        return masked
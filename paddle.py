@@ -1,3 +1,13 @@
+import itertools
+import multiprocessing
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import cv2
+import numpy as np
 import torch
 from PIL import Image
 from transformers import AutoModelForCausalLM, AutoProcessor
@@ -9,88 +19,751 @@ dtype = torch.bfloat16 if torch.cuda.is_available() else torch.float32
 # モデルID
 MODEL_ID = "PaddlePaddle/PaddleOCR-VL"
 
-def run_paddleocr_vl(image_path, task="ocr"):
+# 同時にメモリに保持しておくモデルの数 (モデルID・デバイス・dtype の組ごと)
+MODEL_CACHE_SIZE = 2
+
+# まとめて生成する画像の枚数の上限と、まとめるために次の画像を待つ最大時間 (秒)
+MAX_BATCH_SIZE = 8
+MAX_WAIT_SECONDS = 0.05
+# OCRWorker がワーカープロセスの終了を確認する間隔 (秒)
+WORKER_POLL_SECONDS = 1.0
+
+# 大きな画像を分割して認識する場合のタイルの一辺の長さ (ピクセル) と、隣り合うタイルの重なり
+TILE_SIZE = 1024
+TILE_OVERLAP = 128
+# タイルの結果をつなげる際、前のタイルとの重複を探す最大の行数
+MERGE_MAX_OVERLAP_LINES = 5
+# 文字・表の領域を探す際に画像を縮小する幅と、領域とみなす最小の面積 (画像全体に対する割合)
+REGION_DETECT_WIDTH = 1600
+REGION_MIN_AREA_RATIO = 0.001
+
+# タスクごとのプロンプト定義
+PROMPTS = {
+    "ocr": "OCR:",
+    "table": "Table Recognition:",
+    "formula": "Formula Recognition:",
+    "chart": "Chart Recognition:",
+}
+
+# 読み込み済みの (プロセッサ, モデル)。最後に使った順に並ぶ
+_MODEL_CACHE = OrderedDict()
+_MODEL_CACHE_LOCK = threading.Lock()
+
+
+def load_model(model_id=MODEL_ID, device=DEVICE, model_dtype=dtype):
+    """
+    (プロセッサ, モデル) を返します。同じモデルID・デバイス・dtype の組は一度だけ読み込み、
+    以降はキャッシュしたものを返します。MODEL_CACHE_SIZE を超えると最も古く使われたものを解放します。
+    """
+    key = (model_id, str(device), str(model_dtype))
+    with _MODEL_CACHE_LOCK:
+        if key in _MODEL_CACHE:
+            _MODEL_CACHE.move_to_end(key)
+            return _MODEL_CACHE[key]
+
+        print(f"Loading model: {model_id} ({device}, {model_dtype})...")
+
+        # 1. プロセッサの読み込み (画像とテキストの前処理用)
+        processor = AutoProcessor.from_pretrained(
+            model_id,
+            trust_remote_code=True
+        )
+
+        # 2. モデルの読み込み
+        model = AutoModelForCausalLM.from_pretrained(
+            model_id,
+            trust_remote_code=True,
+            torch_dtype=model_dtype,
+            low_cpu_mem_usage=True
+        ).to(device).eval()
+
+        _MODEL_CACHE[key] = (processor, model)
+        while len(_MODEL_CACHE) > MODEL_CACHE_SIZE:
+            _MODEL_CACHE.popitem(last=False)
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        return processor, model
+
+
+def _open_image(image):
+    # 画像のパスか PIL 画像を RGB の PIL 画像にそろえる
+    if isinstance(image, Image.Image):
+        return image.convert("RGB")
+    return Image.open(image).convert("RGB")
+
+
+def _strip_prompt(generated_text, prompt_text):
+    # プロンプト自体が出力に含まれている場合、除去すると見やすくなります
+    if generated_text.startswith(prompt_text):
+        return generated_text[len(prompt_text):].strip()
+    return generated_text
+
+
+def _image_area(image):
+    # 画像の画素数 (画像トークン数の目安)。パスの場合はヘッダだけを読む
+    if isinstance(image, Image.Image):
+        return image.width * image.height
+    with Image.open(image) as img:
+        return img.width * img.height
+
+
+def group_by_length(images, batch_size):
+    """
+    画像を画素数の順に並べて batch_size 枚ずつに分け、各バッチの元の位置のリストを返します。
+    画像トークン数の近い画像同士をまとめることで、パディングの無駄を減らします。
+    """
+    order = sorted(range(len(images)), key=lambda i: _image_area(images[i]))
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def tile_boxes(width, height, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, offset=(0, 0)):
+    """
+    width x height の範囲を、隣と overlap ピクセルずつ重なる tile_size 四方のタイルに分け、
+    (left, top, right, bottom) のリストを上の行から順に返します。
+    端のタイルは範囲の端にそろえるため、どのタイルも tile_size を超えません。
+    """
+    stride = tile_size - overlap
+    if stride <= 0:
+        raise ValueError(f"overlap ({overlap}) は tile_size ({tile_size}) より小さくしてください")
+
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        return list(range(0, length - tile_size, stride)) + [length - tile_size]
+
+    ox, oy = offset
+    return [
+        (ox + x, oy + y, ox + min(x + tile_size, width), oy + min(y + tile_size, height))
+        for y in starts(height)
+        for x in starts(width)
+    ]
+
+
+def region_boxes(page, detect_width=REGION_DETECT_WIDTH, min_area_ratio=REGION_MIN_AREA_RATIO):
+    """
+    ページ画像 (PIL 画像) から文字や表のまとまった領域を findContours で探し、
+    (left, top, right, bottom) のリストを上から (同じ高さなら左から) の順に返します。
+    重なる領域は1つにまとめるため、返す領域同士は重なりません。
+    検出は縮小した画像で行い、座標だけを元の大きさに戻します。
+    """
+    width, height = page.size
+    scale = min(1.0, detect_width / width)
+    small = page.convert("L")
+    if scale < 1.0:
+        small = small.resize((max(1, round(width * scale)), max(1, round(height * scale))))
+    gray = np.asarray(small)
+
+    # 文字を白、背景を黒にして、膨張で文字同士をつなげて段落や表の塊にする
+    binary = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 15, 10)
+    binary = cv2.dilate(binary, np.ones((5, 5), np.uint8), iterations=3)
+    contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    boxes = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if w * h < gray.size * min_area_ratio:
+            continue
+        boxes.append((
+            int(x / scale),
+            int(y / scale),
+            min(width, int(np.ceil((x + w) / scale))),
+            min(height, int(np.ceil((y + h) / scale))),
+        ))
+    return sorted(_merge_overlapping(boxes), key=lambda box: (box[1], box[0]))
+
+
+def _merge_overlapping(boxes):
+    # 重なる領域は1つの外接矩形にまとめる (重なり部分を二度認識しないため)。
+    # まとめた矩形が別の領域と新たに重なることがあるため、重なりがなくなるまで繰り返す
+    boxes = list(boxes)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    boxes[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+
+def _text_lines(text):
+    return [line.rstrip() for line in text.splitlines() if line.strip()]
+
+
+def _join_words(left, right):
+    # 左右に隣り合うタイルの同じ行をつなげる。左右の重なり部分で読まれた語
+    # (左の末尾と右の先頭で一致する語) は一度だけ残す
+    left_words, right_words = left.split(), right.split()
+    for k in range(min(len(left_words), len(right_words)), 0, -1):
+        if left_words[-k:] == right_words[:k]:
+            right_words = right_words[k:]
+            break
+    return " ".join(left_words + right_words)
+
+
+def _join_row(texts):
+    # 同じ行のタイル (左から順) の認識結果を、行ごとに左から右へつなげる。
+    # 認識結果には行の位置がないため、行数がそろっている (同じ高さの範囲で同じ行を
+    # 読んだとみなせる) 場合だけ行番号で対応させる。行数が違う場合はどの行同士が
+    # 同じ高さか分からないので、タイルごとの行を崩さずに左のタイルから順に並べる
+    tile_lines = [_text_lines(text) for text in texts]
+    tile_lines = [lines for lines in tile_lines if lines]
+    if not tile_lines:
+        return []
+    if len({len(lines) for lines in tile_lines}) > 1:
+        return [line for lines in tile_lines for line in lines]
+    joined = tile_lines[0]
+    for lines in tile_lines[1:]:
+        joined = [_join_words(left, right) for left, right in zip(joined, lines)]
+    return joined
+
+
+def merge_tile_texts(rows, max_overlap_lines=MERGE_MAX_OVERLAP_LINES):
+    """
+    タイルごとの認識結果をつなげます。rows はタイルの行 (上から順) ごとの、
+    左から順に並んだ認識結果のリストです (文字列を渡した場合は1枚だけの行とみなします)。
+
+    各行のタイルを先に左から右へつなげ、その後で上の行と比べます。タイルの上下の重なり部分で
+    読まれた行が上の行の末尾と一致する場合は、重複として取り除きます
+    (同じ入力なら常に同じ結果になります)。
+
+    左右のタイルを行ごとにつなげるのは、同じ行のタイルの行数がすべて等しい場合だけです。
+    行数が違う場合 (片方のタイルにだけ余白がある場合など) は行の高さを対応させられないため、
+    各タイルの行をそのまま左のタイルから順に並べます (左右の重なり部分の重複は残ります)。
+
+    >>> merge_tile_texts([["a b c\\nline2", "c d\\nline2 e"], ["line2 e\\nx"]])
+    'a b c d\\nline2 e\\nx'
+    >>> merge_tile_texts([["a b c\\nline2\\nline3", "c d"]])
+    'a b c\\nline2\\nline3\\nc d'
+    """
+    merged = []
+    for row in rows:
+        lines = _join_row([row] if isinstance(row, str) else row)
+        overlap = 0
+        for k in range(min(len(merged), len(lines), max_overlap_lines), 0, -1):
+            if merged[-k:] == lines[:k]:
+                overlap = k
+                break
+        merged.extend(lines[overlap:])
+    return "\n".join(merged)
+
+
+class OCREngine:
+    """
+    PaddleOCR-VL のモデルを一度だけ読み込み、何枚の画像にも使い回す OCR エンジンです。
+    モデルは最初の recognize() (または load()) で読み込まれます。
+    """
+
+    def __init__(self, model_id=MODEL_ID, device=DEVICE, model_dtype=dtype, max_new_tokens=1024):
+        self.model_id = model_id
+        self.device = device
+        self.dtype = model_dtype
+        self.max_new_tokens = max_new_tokens  # 出力の長さに応じて調整してください
+        self.processor = None
+        self.model = None
+
+    def load(self):
+        if self.model is None:
+            self.processor, self.model = load_model(self.model_id, self.device, self.dtype)
+            # まとめて生成する場合、デコーダのみのモデルでは左側をパディングする必要がある
+            tokenizer = getattr(self.processor, "tokenizer", None)
+            if tokenizer is not None:
+                tokenizer.padding_side = "left"
+        return self
+
+    def _recognize_one(self, image, prompt_text):
+        # 3. 入力データの作成
+        # このモデルはテキストプロンプトと一緒に画像を入力します
+        inputs = self.processor(
+            text=prompt_text,
+            images=_open_image(image),
+            return_tensors="pt"
+        ).to(self.device)
+
+        # dtypeをモデルに合わせる（processorがfloat32を返すことがあるため）
+        if inputs["pixel_values"].dtype != self.dtype:
+            inputs["pixel_values"] = inputs["pixel_values"].to(self.dtype)
+
+        # 4. 生成実行
+        with torch.no_grad():
+            generated_ids = self.model.generate(
+                **inputs,
+                max_new_tokens=self.max_new_tokens,
+                do_sample=False,      # 決定論的な出力にする場合
+                # num_beams=5         # 精度を上げたい場合はビームサーチを有効化
+            )
+
+        # 5. 結果のデコード
+        generated_text = self.processor.batch_decode(generated_ids, skip_special_tokens=True)[0]
+        return _strip_prompt(generated_text, prompt_text)
+
+    def _recognize_batch(self, images, prompt_text):
+        # 同じタスクの複数の画像をパディングして1回の generate で処理する
+        if len(images) == 1:
+            return [self._recognize_one(images[0], prompt_text)]
+        inputs = self.processor(
+            text=[prompt_text] * len(images),
+            images=[_open_image(image) for image in images],
+            padding=True,
+            return_tensors="pt"
+        ).to(self.device)
+        if inputs["pixel_values"].dtype != self.dtype:
+            inputs["pixel_values"] = inputs["pixel_values"].to(self.dtype)
+
+        with torch.no_grad():
+            generated_ids = self.model.generate(
+                **inputs,
+                max_new_tokens=self.max_new_tokens,
+                do_sample=False,
+            )
+
+        # 出力が入力を含む場合は、画像ごとに入力 (プロンプト) 部分を取り除いてからデコードする
+        input_ids = inputs["input_ids"]
+        input_length = input_ids.shape[1]
+        if generated_ids.shape[1] >= input_length and torch.equal(generated_ids[:, :input_length], input_ids):
+            generated_ids = generated_ids[:, input_length:]
+        generated_texts = self.processor.batch_decode(generated_ids, skip_special_tokens=True)
+        return [_strip_prompt(text.strip(), prompt_text) for text in generated_texts]
+
+    def recognize(self, images, task="ocr", batch_size=1):
+        """
+        画像 (パスまたは PIL 画像) のリストを認識し、結果の文字列のリストを入力順に返します。
+        画像を1枚だけ渡した場合は文字列を返します。
+        batch_size が 2 以上の場合は、画素数の近い画像を batch_size 枚ずつまとめて生成します。
+
+        タスクの種類:
+        - 'ocr': 文字認識
+        - 'table': 表認識
+        - 'formula': 数式認識
+        - 'chart': グラフ・チャート認識
+        """
+        self.load()
+        single = not isinstance(images, (list, tuple))
+        if single:
+            images = [images]
+        prompt_text = PROMPTS.get(task, "OCR:")
+        if batch_size <= 1:
+            results = [self._recognize_one(image, prompt_text) for image in images]
+        else:
+            results = [None] * len(images)
+            for group in group_by_length(images, batch_size):
+                outputs = self._recognize_batch([images[i] for i in group], prompt_text)
+                for i, text in zip(group, outputs):
+                    results[i] = text
+        return results[0] if single else results
+
+    def recognize_tiled(
+        self,
+        image,
+        task="ocr",
+        tile_size=TILE_SIZE,
+        overlap=TILE_OVERLAP,
+        batch_size=MAX_BATCH_SIZE,
+        use_regions=False,
+    ):
+        """
+        大きなページ画像を重なりのあるタイルに分けて認識し、つなげた文字列を返します。
+        use_regions が True の場合は、先に region_boxes で文字や表の領域を探し、
+        その領域だけをタイルに分けます (余白を認識しないため速くなります)。
+
+        タイルは batch_size 枚ずつ切り出して認識するため、モデルに渡す画像の大きさと
+        同時に保持するタイルの数は、ページの大きさによらず一定です。
+        """
+        page = _open_image(image)
+        width, height = page.size
+        regions = region_boxes(page) if use_regions else []
+        if not regions:
+            regions = [(0, 0, width, height)]
+
+        # タイルは領域ごとに上の行から (行の中は左から) 並ぶ。行の区切りを覚えておき、
+        # 認識結果を行ごとにつなげてから上下の重なりを取り除く
+        boxes = []
+        row_sizes = []
+        for left, top, right, bottom in regions:
+            region_tiles = tile_boxes(right - left, bottom - top, tile_size, overlap, offset=(left, top))
+            for _, row in itertools.groupby(region_tiles, key=lambda box: box[1]):
+                row = list(row)
+                boxes.extend(row)
+                row_sizes.append(len(row))
+
+        texts = []
+        for start in range(0, len(boxes), batch_size):
+            tiles = [page.crop(box) for box in boxes[start:start + batch_size]]
+            texts.extend(self.recognize(tiles, task, batch_size=batch_size))
+        ends = list(itertools.accumulate(row_sizes))
+        rows = [texts[end - size:end] for size, end in zip(row_sizes, ends)]
+        return merge_tile_texts(rows)
+
+
+def _num_images(images):
+    return len(images) if isinstance(images, (list, tuple)) else 1
+
+
+def _collect_batch(request_queue, max_batch_size, max_wait):
+    """
+    最初のジョブが届くまで待ち、その後 max_wait 秒以内に届いたジョブを
+    画像が max_batch_size 枚になるまで集めます。
+    戻り値: (ジョブのリスト, 終了の合図 (None) を受け取ったか)
+    """
+    job = request_queue.get()
+    if job is None:
+        return [], True
+    jobs = [job]
+    count = _num_images(job[1])
+    deadline = time.monotonic() + max_wait
+    while count < max_batch_size:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            job = request_queue.get(timeout=remaining)
+        except queue.Empty:
+            break
+        if job is None:
+            return jobs, True
+        jobs.append(job)
+        count += _num_images(job[1])
+    return jobs, False
+
+
+def _run_batched(engine, jobs, max_batch_size):
+    """
+    (ジョブID, 画像, タスク) のジョブをタスクごとにまとめて認識し、
+    (ジョブID, 結果, エラー) のリストを返します。
+    まとめて処理した画像のどれかで例外が起きた場合、そのタスクのジョブは全てエラーになります。
+    """
+    by_task = {}
+    for job in jobs:
+        by_task.setdefault(job[2], []).append(job)
+
+    responses = []
+    for task, task_jobs in by_task.items():
+        flat = []
+        spans = []
+        for job_id, images, _ in task_jobs:
+            single = not isinstance(images, (list, tuple))
+            start = len(flat)
+            flat.extend([images] if single else images)
+            spans.append((job_id, start, len(flat), single))
+        try:
+            results = engine.recognize(flat, task, batch_size=max_batch_size)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            responses.extend((job_id, None, error) for job_id, _, _, _ in spans)
+            continue
+        for job_id, start, end, single in spans:
+            responses.append((job_id, results[start] if single else results[start:end], None))
+    return responses
+
+
+class DynamicBatcher:
+    """
+    同じプロセス内で使う動的バッチ処理器です。submit() された画像を、
+    max_batch_size 枚に達するか max_wait 秒経つまで集めてから、まとめて認識します。
+    """
+
+    def __init__(self, engine=None, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_WAIT_SECONDS):
+        self.engine = engine or OCREngine()
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._requests = queue.Queue()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        # バッチ処理のスレッドが止まった理由 (止まると設定される)
+        self._error = None
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        try:
+            while True:
+                jobs, stop = _collect_batch(self._requests, self.max_batch_size, self.max_wait)
+                for job_id, result, error in _run_batched(self.engine, jobs, self.max_batch_size):
+                    with self._lock:
+                        future = self._pending.pop(job_id)
+                    if error is None:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(RuntimeError(error))
+                if stop:
+                    self._fail_pending(RuntimeError("DynamicBatcher は終了しています"))
+                    return
+        except Exception as e:
+            self._fail_pending(RuntimeError(f"バッチ処理が停止しました: {type(e).__name__}: {e}"))
+
+    def _fail_pending(self, error):
+        # OCRWorker._fail_pending と同じく、以降の submit() を失敗させ、
+        # 結果を待っている Future をすべて error で終わらせる
+        with self._lock:
+            if self._error is None:
+                self._error = error
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(error)
+
+    def submit(self, images, task="ocr"):
+        """
+        認識ジョブを送り、OCREngine.recognize() と同じ結果を返す Future を返します。
+        close() の後やバッチ処理のスレッドが停止した後は RuntimeError を送出します。
+        """
+        future = Future()
+        with self._lock:
+            if self._error is not None:
+                raise RuntimeError(f"DynamicBatcher を使えません: {self._error}") from self._error
+            job_id = next(self._ids)
+            self._pending[job_id] = future
+        self._requests.put((job_id, images, task))
+        return future
+
+    def close(self):
+        self._requests.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _worker_loop(request_queue, response_queue, engine_kwargs, max_batch_size, max_wait):
+    # ワーカープロセスの本体: モデルを一度だけ読み込み、届いたジョブを動的にまとめて処理する
+    engine = OCREngine(**engine_kwargs)
+    try:
+        engine.load()
+        response_queue.put(("ready", None, None))
+    except Exception as e:
+        response_queue.put(("ready", None, f"{type(e).__name__}: {e}"))
+        return
+    while True:
+        jobs, stop = _collect_batch(request_queue, max_batch_size, max_wait)
+        for response in _run_batched(engine, jobs, max_batch_size):
+            response_queue.put(response)
+        if stop:
+            break
+
+
+class OCRWorker:
+    """
+    モデルを読み込んだまま常駐するローカルのワーカープロセスです。
+    submit() でジョブをキューに送り、結果は Future で受け取ります。
+    複数のスレッドから同時に使えます。ワーカーは max_wait 秒以内に届いたジョブを
+    max_batch_size 枚までまとめて生成します (max_batch_size=1 で1枚ずつ処理します)。
+    画像はパスで渡すと、プロセス間で画像データを送らずに済みます。
+    モデルの読み込みに失敗した場合やワーカーが終了した場合は、結果を待っている
+    Future は RuntimeError で終わります。
+    """
+
+    def __init__(
+        self,
+        model_id=MODEL_ID,
+        device=DEVICE,
+        model_dtype=dtype,
+        max_new_tokens=1024,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_wait=MAX_WAIT_SECONDS,
+    ):
+        # CUDA を使うため、ワーカーは fork ではなく spawn で起動する
+        context = multiprocessing.get_context("spawn")
+        self._requests = context.Queue()
+        self._responses = context.Queue()
+        self._process = context.Process(
+            target=_worker_loop,
+            args=(
+                self._requests,
+                self._responses,
+                {"model_id": model_id, "device": device, "model_dtype": model_dtype, "max_new_tokens": max_new_tokens},
+                max_batch_size,
+                max_wait,
+            ),
+            daemon=True,
+        )
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._ready = Future()
+        # モデルの読み込みの失敗やワーカーの終了の理由 (使えなくなると設定される)
+        self._error = None
+        self._process.start()
+        self._receiver = threading.Thread(target=self._receive, daemon=True)
+        self._receiver.start()
+
+    def _receive(self):
+        # ワーカーからの結果を対応する Future に渡す。ワーカーが終了したら (close() でも異常終了でも)
+        # パイプに残った結果を受け取り、まだ結果のない Future を失敗させて終わる
+        # (終了したワーカーが応答のキューのロックを持ったままの場合があるため、
+        # 親プロセスからは応答のキューに書き込まない)
+        while True:
+            try:
+                response = self._responses.get(timeout=WORKER_POLL_SECONDS)
+            except queue.Empty:
+                if self._process.is_alive():
+                    continue
+                while True:
+                    try:
+                        self._dispatch(*self._responses.get_nowait())
+                    except queue.Empty:
+                        break
+                self._fail_pending(
+                    RuntimeError(f"ワーカープロセスが終了しました (終了コード: {self._process.exitcode})")
+                )
+                break
+            self._dispatch(*response)
+
+    def _dispatch(self, job_id, result, error):
+        if job_id == "ready":
+            if error is None:
+                self._ready.set_result(True)
+            else:
+                self._fail_pending(RuntimeError(f"モデルの読み込みに失敗しました: {error}"))
+            return
+        with self._lock:
+            future = self._pending.pop(job_id, None)
+        if future is None:
+            return
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(RuntimeError(error))
+
+    def _fail_pending(self, error):
+        # 以降の submit() を失敗させ、結果を待っている Future をすべて error で終わらせる
+        with self._lock:
+            if self._error is None:
+                self._error = error
+            pending, self._pending = self._pending, {}
+        if not self._ready.done():
+            self._ready.set_exception(error)
+        for future in pending.values():
+            future.set_exception(error)
+
+    def wait_ready(self, timeout=None):
+        """
+        ワーカーがモデルを読み込み終えるまで待ちます。
+        """
+        return self._ready.result(timeout)
+
+    def submit(self, images, task="ocr"):
+        """
+        認識ジョブを送り、OCREngine.recognize() と同じ結果を返す Future を返します。
+        モデルの読み込みに失敗した後やワーカーが終了した後は RuntimeError を送出します。
+        """
+        future = Future()
+        with self._lock:
+            if self._error is not None:
+                raise RuntimeError(f"ワーカーを使えません: {self._error}") from self._error
+            job_id = next(self._ids)
+            self._pending[job_id] = future
+        self._requests.put((job_id, images, task))
+        return future
+
+    def recognize(self, images, task="ocr"):
+        return self.submit(images, task).result()
+
+    def close(self):
+        self._requests.put(None)
+        self._process.join()
+        # 受信側はワーカーの終了を検知して、残りの結果を受け取ってから止まる
+        self._receiver.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# run_paddleocr_vl から使うエンジン (最初の呼び出しでモデルを読み込む)
+_default_engine = None
+
+
+def run_paddleocr_vl(image_path, task="ocr", tiled=False):
     """
     タスクの種類:
     - 'ocr': 文字認識
     - 'table': 表認識
     - 'formula': 数式認識
     - 'chart': グラフ・チャート認識
+
+    モデルは最初の呼び出しでだけ読み込まれ、2回目以降は使い回されます。
+    tiled が True の場合は、大きな画像をタイルに分けて認識します (OCREngine.recognize_tiled)。
     """
-    
-    print(f"Loading model: {MODEL_ID}...")
-    
-    # 1. プロセッサの読み込み (画像とテキストの前処理用)
-    processor = AutoProcessor.from_pretrained(
-        MODEL_ID, 
-        trust_remote_code=True
-    )
-    
-    # 2. モデルの読み込み
-    model = AutoModelForCausalLM.from_pretrained(
-        MODEL_ID,
-        trust_remote_code=True,
-        torch_dtype=dtype,
-        low_cpu_mem_usage=True
-    ).to(DEVICE).eval()
-
-    # タスクごとのプロンプト定義
-    prompts = {
-        "ocr": "OCR:",
-        "table": "Table Recognition:",
-        "formula": "Formula Recognition:",
-        "chart": "Chart Recognition:",
-    }
-    
-    prompt_text = prompts.get(task, "OCR:")
-    
-    # 画像を開く
-    image = Image.open(image_path).convert("RGB")
-    
-    # 3. 入力データの作成
-    # このモデルはテキストプロンプトと一緒に画像を入力します
-    inputs = processor(
-        text=prompt_text,
-        images=image,
-        return_tensors="pt"
-    ).to(DEVICE)
-    
-    # dtypeをモデルに合わせる（processorがfloat32を返すことがあるため）
-    if torch.cuda.is_available():
-        inputs["pixel_values"] = inputs["pixel_values"].to(dtype)
-
-    print("Generating...")
-    
-    # 4. 生成実行
-    with torch.no_grad():
-        generated_ids = model.generate(
-            **inputs,
-            max_new_tokens=1024,  # 出力の長さに応じて調整してください
-            do_sample=False,      # 決定論的な出力にする場合
-            # num_beams=5         # 精度を上げたい場合はビームサーチを有効化
-        )
+    global _default_engine
+    if _default_engine is None:
+        _default_engine = OCREngine()
+    if tiled:
+        return _default_engine.recognize_tiled(image_path, task)
+    return _default_engine.recognize(image_path, task)
 
-    # 5. 結果のデコード
-    # 入力プロンプト部分を除去して出力だけを取り出す処理が含まれる場合があります
-    generated_text = processor.batch_decode(generated_ids, skip_special_tokens=True)[0]
-    
-    # プロンプト自体が出力に含まれている場合、除去する処理を入れると見やすくなります
-    if generated_text.startswith(prompt_text):
-        generated_text = generated_text[len(prompt_text):].strip()
 
-    return generated_text
+def measure_latency(image_path, task="ocr", runs=3):
+    """
+    モデルの読み込みを含む初回 (コールドスタート) と、読み込み済みの2回目以降 (ウォーム) の
+    1枚あたりの処理時間 (秒) を測ります。
+    """
+    _MODEL_CACHE.clear()
+    engine = OCREngine()
+    start = time.perf_counter()
+    engine.recognize(image_path, task)
+    cold = time.perf_counter() - start
+
+    warm = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        engine.recognize(image_path, task)
+        warm.append(time.perf_counter() - start)
+    return {"cold_seconds": cold, "warm_seconds": sum(warm) / len(warm)}
+
+
+def measure_throughput(image_paths, task="ocr", batch_sizes=(1, 4, 8)):
+    """
+    1枚ずつ処理する場合と、batch_size 枚ずつまとめて処理する場合の処理速度 (枚/秒) を比較します。
+    モデルの読み込み時間は含みません。
+    """
+    engine = OCREngine().load()
+    engine.recognize(image_paths[:1], task) # ウォームアップ
+    throughput = {}
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        engine.recognize(list(image_paths), task, batch_size=batch_size)
+        throughput[batch_size] = len(image_paths) / (time.perf_counter() - start)
+    return throughput
 
 # ==========================================
 # 実行例
 # ==========================================
 if __name__ == "__main__":
     # テストする画像のパス
-    img_path = "test_image.png" 
-    
+    img_path = "test_image.png"
+
     # タスクを選択: 'ocr', 'table', 'formula', 'chart'
     result = run_paddleocr_vl(img_path, task="ocr")
-    
+
     print("-" * 30)
     print("Result:")
     print(result)
-    print("-" * 30)
\ No newline at end of file
+    print("-" * 30)
+
+    # コールドスタートとウォーム時の処理時間の比較
+    latency = measure_latency(img_path, task="ocr")
+    print(f"初回 (モデル読み込みを含む): {latency['cold_seconds']:.2f} 秒")
+    print(f"2回目以降の平均: {latency['warm_seconds']:.2f} 秒")
+
+    # 大きなスキャン画像をタイルに分けて認識する場合
+    # print(run_paddleocr_vl("large_scan.png", task="ocr", tiled=True))
+
+    # 1枚ずつとまとめて処理する場合の処理速度の比較
+    # print(measure_throughput(["a.png", "b.png", "c.png", "d.png"], task="ocr"))
+
+    # 常駐ワーカーを使う場合 (複数の画像で1つのモデルを共有し、届いた画像をまとめて生成する)
+    # with OCRWorker() as worker:
+    #     worker.wait_ready()
+    #     futures = [worker.submit(path, "ocr") for path in ["a.png", "b.png"]]
+    #     print([f.result() for f in futures])
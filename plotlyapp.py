@@ -1,55 +1,39 @@
-import pandas as pd
-from flask import Flask, jsonify, render_template
-import numpy as np # サンプルデータ生成用
+from flask import Flask, render_template, request
+from log_response import BINARY_FORMATS, api_response, error_response
+from log_store import open_log_store, parse_lod_query, parse_query
+
+# --- 設定項目 ---
+LOG_FILE = "thread_messages.log" # 解析するログファイル (書式は log_parser.LOG_DELIMITER / LOG_PATTERN を参照)
+STORE_DIR = None # 時刻順に並べたログのストア (None の場合は "<LOG_FILE>.store")
+DEFAULT_LIMIT = 100000 # limit を指定しない場合に返す最大件数
+# --- 設定項目ここまで ---
 
 app = Flask(__name__)
 
-def get_log_data_for_plotly():
+def get_log_data_for_plotly(start=None, end=None, threads=None, limit=DEFAULT_LIMIT, columnar=False, heap=False):
     """
-    ログデータを生成し、Plotlyでの描画に必要な情報をまとめて返す
+    ログのストアから指定した時間範囲 (とスレッド) のログを取り出し、
+    Plotlyでの描画に必要な情報をまとめて返す
     """
-    # --- サンプルデータ生成 (2000件) ---
-    # 実際にはここでログファイルを読み込んでください
-    num_records = 2000
-    threads = [f"Thread{chr(65+i)}" for i in range(15)] # ThreadA, ThreadB, ...
-    
-    timestamps = pd.to_datetime(np.sort(np.random.uniform(
-        pd.Timestamp('2023-10-27 10:00:00').timestamp(),
-        pd.Timestamp('2023-10-27 11:00:00').timestamp(),
-        num_records
-    )), unit='s')
-
-    from_threads = np.random.choice(threads, num_records)
-    to_threads = np.random.choice(threads, num_records)
-    
-    # fromとtoが同じにならないようにする
-    for i in range(num_records):
-        while from_threads[i] == to_threads[i]:
-            to_threads[i] = np.random.choice(threads)
-            
-    data = {
-        'timestamp': timestamps,
-        'from_thread': from_threads,
-        'to_thread': to_threads,
-        'message': [f"Message-{i}" for i in range(num_records)],
-        'full_log': [f"Full log details for event {i}..." for i in range(num_records)]
-    }
-    df = pd.DataFrame(data)
-    # ------------------------------------
+    # ストアはログファイルが更新されるまで使い回す (検索は時刻の索引の二分探索のみ)
+    store = open_log_store(LOG_FILE, STORE_DIR)
+    indices = store.query(start, end, threads=threads, limit=limit)
 
     # Y軸の並び順を固定するため、全スレッドのリストを作成
-    all_threads_sorted = sorted(threads, reverse=True)
+    all_threads_sorted = sorted(store.threads, reverse=True)
 
-    # フロントエンドで直接使えるように、辞書のリストに変換
-    logs_as_dict = df.to_dict(orient='records')
-    
-    # タイムスタンプをPlotlyが解釈できるISO形式の文字列に変換
-    for log in logs_as_dict:
-        log['timestamp'] = log['timestamp'].isoformat()
+    if columnar:
+        # 列形式: timestamp はエポックミリ秒、from_thread / to_thread は threads のインデックスの配列
+        # (heap ならバイナリの応答用に、文字列の列をデコードせずに UTF-8 のバイト列で返す)
+        logs = store.columns.to_columnar(indices, heap=heap)
+    else:
+        # フロントエンドで直接使えるように、辞書のリストに変換
+        # (タイムスタンプはPlotlyが解釈できるISO形式の文字列)
+        logs = store.records(indices)
 
     # ログデータと、Y軸のカテゴリ情報を両方返す
     return {
-        'logs': logs_as_dict,
+        'logs': logs,
         'y_axis_categories': all_threads_sorted
     }
 
@@ -59,8 +43,41 @@ def index():
 
 @app.route('/api/logs')
 def get_logs_endpoint():
-    data = get_log_data_for_plotly()
-    return jsonify(data)
+    # start / end (ISO形式の日時かエポックミリ秒), threads (カンマ区切り), limit で絞り込む
+    # 形式は format (columnar / binary / arrow) か Accept ヘッダで選ぶ (既定は行ごとの JSON)
+    # ETag はストアの指紋とクエリから作る
+    # 解釈できないパラメータは 400 で返す
+    try:
+        query = parse_query(request.args, DEFAULT_LIMIT)
+    except ValueError as e:
+        return error_response(str(e))
+    store = open_log_store(LOG_FILE, STORE_DIR)
+    return api_response(
+        lambda response_format: get_log_data_for_plotly(
+            columnar=response_format != 'records',
+            heap=response_format in BINARY_FORMATS,
+            **query
+        ),
+        store.meta['fingerprint'], store.meta['version'], request.path, query
+    )
+
+@app.route('/api/logs/lod')
+def get_logs_lod_endpoint():
+    # 表示範囲 (start / end) と画面の幅 (width, 画素) に合わせて、ピラミッドから
+    # ビンごとの件数を返す (ズームしてイベントが少なくなれば元のイベントを返す)
+    try:
+        query = parse_lod_query(request.args)
+    except ValueError as e:
+        return error_response(str(e))
+    store = open_log_store(LOG_FILE, STORE_DIR)
+    return api_response(
+        lambda response_format: store.lod(
+            columnar=response_format != 'records',
+            heap=response_format in BINARY_FORMATS,
+            **query
+        ),
+        store.meta['fingerprint'], store.meta['version'], request.path, query
+    )
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
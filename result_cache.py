@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+# キャッシュの形式を変えた場合はこの値を上げる (古いキャッシュは使われなくなる)
+CACHE_VERSION = 1
+
+
+def file_fingerprint(path, hash_content=False):
+    """
+    入力ファイルが変わったかどうかを判定するための文字列を返します。
+    hash_content が True なら内容の SHA-256、False なら更新時刻とサイズを使います。
+    """
+    if hash_content:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return f"sha256:{digest.hexdigest()}"
+    stat = os.stat(path)
+    return f"stat:{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def make_key(*parts):
+    """
+    JSON に変換できる値の組から、キャッシュのキーとなるハッシュ値を作ります。
+    """
+    payload = json.dumps([CACHE_VERSION, *parts], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# 二値画像を np.packbits で保存するときの配列名の接尾辞
+_PACKED = ".packed"
+_PACKED_SHAPE = ".packed_shape"
+
+
+def _is_binary(array):
+    """
+    値が 0 と 255 だけの uint8 配列かどうかを返します。
+    """
+    if array.dtype != np.uint8 or array.size == 0:
+        return False
+    return not np.any((array != 0) & (array != 255))
+
+
+def _unpack_binary(packed, shape):
+    count = int(np.prod(shape))
+    bits = np.unpackbits(packed, count=count)
+    return (bits * np.uint8(255)).reshape(shape)
+
+
+class StageStore:
+    """
+    途中段階の配列 (リサイズ後の画像や前処理済みの二値画像など) を
+    キーごとに1つの .npz ファイルとして保存するストアです。
+
+    ファイル単位で完結しているため、複数のワーカープロセスから同時に使えます。
+    読み込んだファイルは更新時刻を更新し、削除時の優先度 (LRU) に使います。
+
+    圧縮すると保存に時間がかかり、読み込みが再計算とほとんど変わらなくなるため、
+    無圧縮で保存します。値が 0 と 255 だけの uint8 配列 (二値画像) は
+    np.packbits で 1/8 の大きさにして保存し、読み込み時に元の形に戻します。
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def load(self, key):
+        """
+        保存済みの配列を辞書で返します。存在しない・壊れている場合は None です。
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                arrays = {}
+                for name in data.files:
+                    if name.endswith(_PACKED_SHAPE):
+                        continue
+                    if name.endswith(_PACKED):
+                        base = name[: -len(_PACKED)]
+                        shape = tuple(data[base + _PACKED_SHAPE])
+                        arrays[base] = _unpack_binary(data[name], shape)
+                    else:
+                        arrays[name] = data[name]
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        return arrays
+
+    def save(self, key, **arrays):
+        stored = {}
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            if _is_binary(array):
+                stored[name + _PACKED] = np.packbits(array, axis=None)
+                stored[name + _PACKED_SHAPE] = np.array(array.shape, dtype=np.int64)
+            else:
+                stored[name] = array
+        # 書き込み途中のファイルを他のプロセスが読まないよう、一時ファイルから置き換える
+        tmp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **stored)
+        os.replace(tmp_path, self._path(key))
+
+    def evict(self, max_bytes=None, max_age_seconds=None):
+        """
+        max_age_seconds より古いファイルを削除し、さらに合計サイズが max_bytes を
+        超えている間は最も古く使われたファイルから削除します。削除した件数を返します。
+        """
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(".npz"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+
+        removed = 0
+        now = time.time()
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            too_old = max_age_seconds is not None and now - mtime > max_age_seconds
+            too_big = max_bytes is not None and total > max_bytes
+            if not (too_old or too_big):
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+
+class ResultManifest:
+    """
+    処理済みの (入力, パラメータ) の組を記録するマニフェストです (SQLite)。
+    親プロセスからのみ使う想定です。
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, image_path TEXT, message TEXT, updated REAL)"
+        )
+
+    def get(self, key):
+        """
+        処理済みならそのときのメッセージを、未処理なら None を返します。
+        """
+        row = self._conn.execute(
+            "SELECT message FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, key, image_path, message):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+            (key, image_path, message, time.time()),
+        )
+
+    def commit(self):
+        self._conn.commit()
+
+    def evict(self, max_age_seconds):
+        """
+        max_age_seconds より前に記録されたエントリを削除し、削除した件数を返します。
+        """
+        cursor = self._conn.execute(
+            "DELETE FROM results WHERE updated < ?", (time.time() - max_age_seconds,)
+        )
+        self._conn.commit()
+        return cursor.rowcount
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,206 @@
+import os
+import queue
+import threading
+import time
+
+import cv2
+
+from main import RESIZE_WIDTH, find_donut, preprocess, resize_image, save_detection
+
+# --- 設定項目 ---
+# 入力ソース: 動画ファイルのパス、連番画像のパターン (例: "frames/img_%05d.png")、
+# またはカメラ番号 (例: 0)
+VIDEO_SOURCE = "your_video.mp4"
+OUTPUT_DIR = "output_stream_directory"  # フレームごとの結果を保存するディレクトリパス
+
+# 各ステージ間のキューに溜められるフレーム数の上限
+# 下流が詰まると上流は待たされるため、メモリ使用量が一定に保たれる
+QUEUE_SIZE = 8
+
+# 何フレームごとに結果を保存するか (0 にすると保存しない)
+SAVE_EVERY = 1
+
+# 処理速度 (fps) を表示する間隔 (フレーム数)
+REPORT_INTERVAL = 100
+
+# --- 設定項目ここまで ---
+
+# ストリームの終端を表す目印
+_END = object()
+
+
+def _put(out_queue, item, stop_event):
+    """
+    キューが空くまで待ちつつ、停止要求があれば諦めて False を返します。
+    """
+    while not stop_event.is_set():
+        try:
+            out_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _read_frames(source, out_queue, stop_event):
+    """
+    cv2.VideoCapture からフレームを読み込み、(フレーム番号, 画像) をキューに流します。
+    """
+    cap = cv2.VideoCapture(source)
+    try:
+        if not cap.isOpened():
+            _put(
+                out_queue, RuntimeError(f"入力を開けませんでした: {source}"), stop_event
+            )
+            return
+        index = 0
+        while not stop_event.is_set():
+            ok, frame = cap.read()
+            if not ok:
+                break
+            if not _put(out_queue, (index, frame), stop_event):
+                break
+            index += 1
+    finally:
+        cap.release()
+        _put(out_queue, _END, stop_event)
+
+
+def _run_stage(func, in_queue, out_queue, stop_event):
+    """
+    in_queue から要素を取り出して func を適用し、out_queue に流します。
+    例外は下流にそのまま渡し、最終的に呼び出し側で送出されます。
+    """
+    while not stop_event.is_set():
+        try:
+            item = in_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _END or isinstance(item, Exception):
+            _put(out_queue, item, stop_event)
+            return
+        try:
+            result = func(item)
+        except Exception as e:
+            _put(out_queue, e, stop_event)
+            return
+        if not _put(out_queue, result, stop_event):
+            return
+
+
+def _preprocess_stage(resize_width):
+    def stage(item):
+        index, frame = item
+        start = time.perf_counter()
+        resized_img = resize_image(frame, resize_width)
+        thresh_cleaned = preprocess(resized_img)
+        return index, resized_img, thresh_cleaned, time.perf_counter() - start
+
+    return stage
+
+
+def _detect_stage(item):
+    index, resized_img, thresh_cleaned, preprocess_elapsed = item
+    detection = find_donut(resized_img, thresh_cleaned)
+    detection.elapsed += preprocess_elapsed
+    return index, detection
+
+
+def _write_stage(output_base_dir, save_every):
+    def stage(item):
+        index, detection = item
+        if save_every > 0 and index % save_every == 0:
+            save_detection(detection, f"frame_{index:06d}", output_base_dir)
+        return item
+
+    return stage
+
+
+def stream_detections(
+    source,
+    resize_width=RESIZE_WIDTH,
+    output_base_dir=None,
+    save_every=SAVE_EVERY,
+    queue_size=QUEUE_SIZE,
+):
+    """
+    動画・連番画像・カメラからフレームを読み込み、(フレーム番号, DonutDetection) を
+    フレーム順に返すジェネレータです。
+
+    読み込み → 前処理 → 輪郭検出 → 保存 の各ステージは別スレッドで動き、
+    サイズ上限付きのキューでつながっています。OpenCV の処理中は GIL が解放されるため、
+    ステージ同士が並行して進みます。output_base_dir が None の場合は保存しません。
+    """
+    stop_event = threading.Event()
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(4)]
+
+    stages = [_preprocess_stage(resize_width), _detect_stage]
+    if output_base_dir is not None:
+        stages.append(_write_stage(output_base_dir, save_every))
+    else:
+        queues.pop()
+
+    threads = [
+        threading.Thread(
+            target=_read_frames, args=(source, queues[0], stop_event), daemon=True
+        )
+    ]
+    for i, func in enumerate(stages):
+        threads.append(
+            threading.Thread(
+                target=_run_stage,
+                args=(func, queues[i], queues[i + 1], stop_event),
+                daemon=True,
+            )
+        )
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # 途中で打ち切られた場合も各スレッドを止める
+        stop_event.set()
+        for thread in threads:
+            thread.join(timeout=1.0)
+
+
+def main():
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    save_dir = OUTPUT_DIR if SAVE_EVERY > 0 else None
+
+    print(f"ストリーム処理を開始します: {VIDEO_SOURCE}")
+    start = time.perf_counter()
+    frame_count = 0
+    donut_count = 0
+    for index, detection in stream_detections(VIDEO_SOURCE, output_base_dir=save_dir):
+        frame_count += 1
+        if detection.status == "ok":
+            donut_count += 1
+        if frame_count % REPORT_INTERVAL == 0:
+            fps = frame_count / (time.perf_counter() - start)
+            print(f"{frame_count} フレーム処理済み ({fps:.1f} fps)")
+
+    elapsed = time.perf_counter() - start
+    print("-" * 30)
+    print(f"全 {frame_count} フレームの処理が完了しました ({elapsed:.1f} 秒)。")
+    if elapsed > 0:
+        print(f"平均処理速度: {frame_count / elapsed:.1f} fps")
+    print(f"ドーナツを検出したフレーム数: {donut_count}")
+
+
+if __name__ == "__main__":
+    # VIDEO_SOURCE と OUTPUT_DIR を実際の値に設定してから実行してください。
+    # カメラを使う場合は VIDEO_SOURCE = 0 のように番号を指定します。
+    if VIDEO_SOURCE == "your_video.mp4" or OUTPUT_DIR == "output_stream_directory":
+        print(
+            "スクリプトの先頭にある VIDEO_SOURCE と OUTPUT_DIR を実際の値に設定してください。"
+        )
+    else:
+        main()